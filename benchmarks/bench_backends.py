@@ -0,0 +1,62 @@
+"""
+Benchmark the throughput of the storage backends.
+
+Runs 2k UsageLimitTool invocations spread over 100 users once against the
+session storage, represented by the in-memory stand-in with the simulated
+round-trip latency of the Dify daemon, and once against a SQLite database in
+WAL mode in a temporary directory.
+
+Run with `python -m benchmarks.bench_backends`.
+"""
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage, open_backend
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 2_000
+USERS = 100
+LATENCY_SECONDS = 0.0002
+STRATEGIES = ("fixed", "sliding", "gcra")
+
+
+def _run(session, strategy: str, backend_parameters: dict) -> float:
+    runtime = MagicMock()
+    start = time.perf_counter()
+    for i in range(INVOCATIONS):
+        tool = UsageLimitTool(runtime=runtime, session=session)
+        tool.create_json_message = dict
+        list(tool._invoke({  # pylint: disable=protected-access
+            'user_id': f'user{i % USERS}',
+            'tracking_method': 'app-user',
+            'limit': '1000000',
+            'duration_seconds': '3600',
+            'limit_strategy': strategy,
+            **backend_parameters
+        }))
+    return INVOCATIONS / (time.perf_counter() - start)
+
+
+def main():
+    """Print the throughput of every backend and strategy."""
+    print(f"{'strategy':>10} {'backend':>22} {'ops/sec':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for strategy in STRATEGIES:
+            session = MagicMock()
+            session.app_id = "app123"
+            session.storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+            path = os.path.join(directory, f"{strategy}.sqlite3")
+            backends = (
+                (f"session ({LATENCY_SECONDS * 1000:.1f} ms)", {}),
+                ("sqlite", {'storage_backend': 'sqlite', 'storage_path': path}),
+            )
+            for name, backend_parameters in backends:
+                throughput = _run(session, strategy, backend_parameters)
+                print(f"{strategy:>10} {name:>22} {throughput:>10.0f}")
+            open_backend(session, "sqlite", path).close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark storage round-trips with and without the record cache.
+
+Runs 10k UsageLimitTool invocations spread over 100 users against an in-memory
+storage stand-in and counts the storage calls that reach it. The "allowed"
+traffic stays under the limit, the "denied" traffic is mostly over it.
+
+Run with `python -m benchmarks.bench_cache`.
+"""
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.cache import RECORD_CACHE
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 10_000
+USERS = 100
+TRAFFIC = (("allowed", 1_000_000), ("denied", 10))
+
+
+def _run(limit: int, cache_seconds: float) -> InMemoryStorage:
+    storage = InMemoryStorage()
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    RECORD_CACHE.clear()
+    for i in range(INVOCATIONS):
+        tool = UsageLimitTool(runtime=MagicMock(), session=session)
+        tool.create_json_message = MagicMock()
+        try:
+            list(tool._invoke({  # pylint: disable=protected-access
+                'user_id': f'user{i % USERS}',
+                'tracking_method': 'app-user',
+                'limit': str(limit),
+                'duration_seconds': '3600',
+                'limit_strategy': 'sliding',
+                'record_cache_seconds': str(cache_seconds)
+            }))
+        except Exception:  # pylint: disable=broad-except
+            pass
+    return storage
+
+
+def main():
+    """Print storage round-trips per 10k invocations with the cache off and on."""
+    print(f"{'traffic':>8} {'cache':>6} {'gets':>7} {'sets':>7} {'total':>7} {'hit rate':>9}")
+    for traffic, limit in TRAFFIC:
+        for cache_seconds in (0, 60):
+            storage = _run(limit, cache_seconds)
+            stats = RECORD_CACHE.stats()
+            lookups = stats["hits"] + stats["misses"]
+            hit_rate = stats["hits"] / lookups if lookups else 0.0
+            print(f"{traffic:>8} {'on' if cache_seconds else 'off':>6} "
+                  f"{storage.calls['get']:>7} {storage.calls['set']:>7} "
+                  f"{sum(storage.calls.values()):>7} {hit_rate:>9.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark concurrent fixed window updates of one hot key.
+
+Runs 1, 8 and 64 concurrent callers against an in-memory storage stand-in with
+simulated round-trip latency, once with plain get/set (the behaviour before
+version stamps) and once through `UsageLimitTool._invoke`. Reports lost
+updates and throughput for both.
+
+Run with `python -m benchmarks.bench_concurrency`.
+"""
+import threading
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.storage import VersionedStorage
+from tools.usage_limit import UsageLimitTool
+
+CALLERS = (1, 8, 64)
+INVOCATIONS = 1280
+LATENCY_SECONDS = 0.0002
+PARAMETERS = {
+    'user_id': 'user789',
+    'tracking_method': 'app',
+    'limit': str(INVOCATIONS + 1),
+    'duration_seconds': '3600',
+    'limit_strategy': 'fixed',
+}
+
+
+def _tool(storage) -> UsageLimitTool:
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    tool = UsageLimitTool(runtime=MagicMock(), session=session)
+    tool.create_json_message = MagicMock()
+    return tool
+
+
+def _unprotected(storage):
+    tool = _tool(storage)
+    # Bypass the version stamps and the retry loop
+    tool.__dict__["_storage"] = storage
+    tool._fixed_window_usage("app123", INVOCATIONS + 1, 3600)  # pylint: disable=protected-access
+
+
+def _versioned(storage):
+    list(_tool(storage)._invoke(PARAMETERS))  # pylint: disable=protected-access
+
+
+def _run(invoke, callers: int) -> tuple[int, float]:
+    storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    per_caller = INVOCATIONS // callers
+
+    def caller():
+        for _ in range(per_caller):
+            invoke(storage)
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    count = int(VersionedStorage(storage).get("app123").split(b":")[0])
+    return per_caller * callers - count, per_caller * callers / elapsed
+
+
+def main():
+    """Print lost updates and throughput for each number of callers."""
+    print(f"{'callers':>8} {'mode':>12} {'lost updates':>13} {'ops/sec':>10}")
+    for callers in CALLERS:
+        for name, invoke in (("unprotected", _unprotected), ("versioned", _versioned)):
+            lost, throughput = _run(invoke, callers)
+            print(f"{callers:>8} {name:>12} {lost:>13} {throughput:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark the latency of denied invocations with and without the deny cache.
+
+Runs 2k UsageLimitTool invocations of users that are already over their limit
+against an in-memory storage stand-in with simulated round-trip latency, and
+reports the mean latency per denial and the storage calls that reached it.
+
+Run with `python -m benchmarks.bench_deny`.
+"""
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.cache import DENY_CACHE
+from tools.exceptions import UsageLimitExceededException
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 2_000
+USERS = 20
+LIMIT = 5
+LATENCY_SECONDS = 0.0002
+STRATEGIES = ("fixed", "sliding", "sliding-counter", "sliding-buckets", "gcra")
+
+
+def _invoke(session, user: int, strategy: str, deny_cache: bool) -> None:
+    tool = UsageLimitTool(runtime=MagicMock(), session=session)
+    tool.create_json_message = MagicMock()
+    list(tool._invoke({  # pylint: disable=protected-access
+        'user_id': f'user{user}',
+        'tracking_method': 'app-user',
+        'limit': str(LIMIT),
+        'duration_seconds': '3600',
+        'limit_strategy': strategy,
+        'deny_cache': deny_cache
+    }))
+
+
+def _run(strategy: str, deny_cache: bool) -> tuple[float, int]:
+    storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    DENY_CACHE.clear()
+    for user in range(USERS):
+        for _ in range(LIMIT):
+            _invoke(session, user, strategy, deny_cache)
+    storage.calls.clear()
+
+    start = time.perf_counter()
+    for i in range(INVOCATIONS):
+        try:
+            _invoke(session, i % USERS, strategy, deny_cache)
+        except UsageLimitExceededException:
+            pass
+    elapsed = time.perf_counter() - start
+    return elapsed / INVOCATIONS, sum(storage.calls.values())
+
+
+def main():
+    """Print the mean latency of a denial and the storage calls with the cache off and on."""
+    print(f"{'strategy':>16} {'cache':>6} {'latency us':>11} {'storage calls':>14}")
+    for strategy in STRATEGIES:
+        for deny_cache in (False, True):
+            latency, calls = _run(strategy, deny_cache)
+            print(f"{strategy:>16} {'on' if deny_cache else 'off':>6} "
+                  f"{latency * 1_000_000:>11.1f} {calls:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark the sliding window record encodings.
+
+Compares the legacy comma separated record against the binary record for
+bytes stored per identifier and the decode + encode time of one call.
+
+Run with `python -m benchmarks.bench_encoding`.
+"""
+import timeit
+
+from tools.encoding import decode_timestamps, encode_timestamps
+
+LIMITS = (100, 10_000, 100_000)
+YEAR_SECONDS = 31536000
+START = 1_700_000_000
+
+
+def _timestamps(limit: int) -> list[int]:
+    step = YEAR_SECONDS // limit
+    return [START + i * step for i in range(limit)]
+
+
+def _legacy_encode(timestamps: list[int]) -> bytes:
+    return ','.join(map(str, timestamps)).encode()
+
+
+def _legacy_decode(record: bytes) -> list[int]:
+    return list(map(int, record.decode().split(',')))
+
+
+def _per_call(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    """Print bytes per identifier and parse time per call for each limit."""
+    print(f"{'limit':>8} {'format':>7} {'bytes':>10} {'decode us':>11} {'round trip us':>14}")
+    for limit in LIMITS:
+        timestamps = _timestamps(limit)
+        number = max(1, 100_000 // limit)
+        for name, encode, decode in (
+            ("csv", _legacy_encode, _legacy_decode),
+            ("binary", encode_timestamps, decode_timestamps),
+        ):
+            record = encode(timestamps)
+            decode_time = _per_call(lambda: decode(record), number)
+            round_trip = _per_call(lambda: encode(decode(record)), number)
+            print(f"{limit:>8} {name:>7} {len(record):>10} "
+                  f"{decode_time * 1e6:>11.1f} {round_trip * 1e6:>14.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark querying the usage of many users one by one and through the query endpoint.
+
+Queries 2k users against the session storage stand-in with simulated round-trip
+latency, once by invoking the Usage Limit tool in peek mode for one user after the
+other, and once with one batch request to the query endpoint, which keeps the
+reads of several users in flight. Reports the total time and the time per user.
+
+Run with `python -m benchmarks.bench_endpoint`.
+"""
+import json
+import time
+from unittest.mock import MagicMock
+
+from werkzeug.test import EnvironBuilder
+
+from endpoints.query_usage import QueryUsageEndpoint
+from tools.backends import InMemoryStorage
+from tools.usage_limit import UsageLimitTool
+
+USERS = 2_000
+LATENCY_SECONDS = 0.0002
+PARAMETERS = {'tracking_method': 'app-user', 'limit': '100', 'app_id': 'app123'}
+
+
+def _sequential(session) -> float:
+    start = time.perf_counter()
+    for user in range(USERS):
+        tool = UsageLimitTool(runtime=MagicMock(), session=session)
+        tool.create_json_message = dict
+        list(tool._invoke({  # pylint: disable=protected-access
+            **PARAMETERS, 'user_id': f'user{user}', 'mode': 'peek'}))
+    return time.perf_counter() - start
+
+
+def _endpoint(session) -> float:
+    r = EnvironBuilder(method="POST", headers={"X-Api-Key": "key"}, json={
+        "defaults": PARAMETERS,
+        "items": [{"user_id": f"user{user}"} for user in range(USERS)],
+    }).get_request()
+    start = time.perf_counter()
+    response = QueryUsageEndpoint(session).invoke(r, {}, {"api_key": "key"})
+    assert len(json.loads(response.get_data())["results"]) == USERS
+    return time.perf_counter() - start
+
+
+def main():
+    """Print the total and per-user time of both ways to query usage."""
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    print(f"{'query':>12} {'total s':>8} {'per user ms':>12}")
+    for name, run in (("sequential", _sequential), ("endpoint", _endpoint)):
+        elapsed = run(session)
+        print(f"{name:>12} {elapsed:>8.3f} {elapsed / USERS * 1000:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Benchmark the overhead of collecting metrics.
+
+Runs 20k invocations spread over 100 users against the session storage stand-in
+without simulated latency, so the time spent in the plugin itself dominates, in three
+configurations: with `collect_metrics` disabled, with it enabled but every hook
+stubbed by a no-op, and with it enabled. The stubbed run separates the cost of reaching
+the hooks, i.e. reading the clock and building the labels, from the cost of recording
+the metrics. The configurations alternate within every round, and the median latency per
+invocation of the rounds is reported with the deltas between the medians.
+
+Code without any instrumentation cannot be run, so the disabled run is compared to it
+by counting the disabled checks, i.e. the executed lines testing whether metrics are
+collected, of one invocation, and timing such a check on its own. Their product is the
+whole overhead of disabled instrumentation.
+
+Run with `python -m benchmarks.bench_metrics`.
+"""
+import os
+import statistics
+import sys
+import time
+import timeit
+from types import SimpleNamespace
+from typing import Any, Callable, TypeVar
+from unittest.mock import MagicMock, patch
+
+import tools
+from tools.backends import InMemoryStorage
+from tools.metrics import Metrics, logger
+from tools.usage_limit import UsageLimitTool
+
+T = TypeVar("T")
+
+INVOCATIONS = 20_000
+USERS = 100
+ROUNDS = 7
+STRATEGIES = ("fixed", "sliding", "sliding-counter", "gcra")
+CHECK_MARKERS = ("metrics is None", "metrics is not None", '"collect_metrics"')
+
+
+class _StubMetrics(Metrics):
+    """Metrics whose hooks are called but record nothing."""
+
+    def increment(self, name: str, labels: dict[str, str] | None = None, amount: float = 1) -> None:
+        pass
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...],
+                labels: dict[str, str] | None = None) -> None:
+        pass
+
+    def timed(self, operation: str, func: Callable[..., T], *args: Any) -> T:
+        return func(*args)
+
+    def maybe_log(self, now: float) -> bool:
+        return False
+
+
+def _session() -> MagicMock:
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = InMemoryStorage()
+    return session
+
+
+def _tool(session: MagicMock, runtime: MagicMock) -> UsageLimitTool:
+    tool = UsageLimitTool(runtime=runtime, session=session)
+    tool.create_json_message = dict
+    return tool
+
+
+def _parameters(strategy: str, collect_metrics: bool) -> dict[str, Any]:
+    return {'tracking_method': 'app-user', 'limit': '1000000', 'limit_strategy': strategy,
+            'collect_metrics': collect_metrics}
+
+
+def _run(strategy: str, collect_metrics: bool) -> float:
+    session, runtime = _session(), MagicMock()
+    parameters = _parameters(strategy, collect_metrics)
+    start = time.perf_counter()
+    for i in range(INVOCATIONS):
+        list(_tool(session, runtime)._invoke({  # pylint: disable=protected-access
+            **parameters, 'user_id': f'user{i % USERS}'}))
+    return (time.perf_counter() - start) / INVOCATIONS
+
+
+def _run_stubbed(strategy: str) -> float:
+    with patch('tools.usage_limit.METRICS', _StubMetrics()):
+        return _run(strategy, True)
+
+
+def _disabled_checks(strategy: str) -> int:
+    """Count the disabled checks executed by one invocation, after a warm-up one."""
+    tool = _tool(_session(), MagicMock())
+    parameters = {**_parameters(strategy, False), 'user_id': 'user0'}
+    list(tool._invoke(parameters))  # pylint: disable=protected-access
+    package = os.path.dirname(tools.__file__)
+    sources: dict[str, list[str]] = {}
+    checks = 0
+
+    def trace(frame, event, _):
+        nonlocal checks
+        filename = frame.f_code.co_filename
+        if not filename.startswith(package):
+            return None
+        if event == "line":
+            if filename not in sources:
+                with open(filename, encoding="utf-8") as file:
+                    sources[filename] = file.read().splitlines()
+            line = sources[filename][frame.f_lineno - 1]
+            checks += any(marker in line for marker in CHECK_MARKERS)
+        return trace
+
+    sys.settrace(trace)
+    try:
+        list(tool._invoke(parameters))  # pylint: disable=protected-access
+    finally:
+        sys.settrace(None)
+    return checks
+
+
+def _check_seconds() -> float:
+    """Return the median time of one disabled check, an attribute read and a comparison."""
+    owner = SimpleNamespace(metrics=None)
+    number = 1_000_000
+
+    def median(statement: str) -> float:
+        return statistics.median(timeit.repeat(
+            statement, globals={"owner": owner}, number=number, repeat=ROUNDS)) / number
+    # The loop of timeit is not part of the check
+    return max(0.0, median("if owner.metrics is not None:\n    pass") - median("pass"))
+
+
+def main():
+    """Print the latency per invocation with metrics disabled, stubbed and enabled."""
+    check = _check_seconds()
+    print(f"{'strategy':>16} {'disabled us':>12} {'stubbed us':>11} {'enabled us':>11} "
+          f"{'hooks':>7} {'record':>7} {'checks':>7} {'disabled':>9}")
+    # The periodic snapshot of the enabled runs would be logged into the table
+    with patch.object(logger, "disabled", True):
+        for strategy in STRATEGIES:
+            runs = {"disabled": [], "stubbed": [], "enabled": []}
+            for _ in range(ROUNDS):
+                runs["disabled"].append(_run(strategy, False))
+                runs["stubbed"].append(_run_stubbed(strategy))
+                runs["enabled"].append(_run(strategy, True))
+            disabled, stubbed, enabled = (
+                statistics.median(runs[name]) for name in ("disabled", "stubbed", "enabled"))
+            checks = _disabled_checks(strategy)
+            print(f"{strategy:>16} {disabled * 1e6:>12.2f} {stubbed * 1e6:>11.2f} "
+                  f"{enabled * 1e6:>11.2f} {stubbed / disabled - 1:>7.1%} "
+                  f"{enabled / stubbed - 1:>7.1%} {checks:>7} "
+                  f"{checks * check / disabled:>9.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark windows timed in seconds against windows timed in milliseconds.
+
+Both resolutions store 4-byte offsets from a base epoch, so a record of the same
+limit has the same size, and an update is the same bisection and append. Measures
+one allowed sliding window update at growing limits and one full tool invocation
+of a 10 second window, and prints the record size of each resolution.
+
+Run with `python -m benchmarks.bench_precision`.
+"""
+import bisect
+import timeit
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.clock import VirtualClock
+from tools.encoding import append_timestamp, encode_timestamps, timestamp_offsets
+from tools.usage_limit import UsageLimitTool
+
+LIMITS = (10, 1_000, 100_000)
+DURATION_SECONDS = 86400
+START = 1_700_000_000
+
+
+def _record(limit: int, milliseconds: bool) -> bytes:
+    scale = 1000 if milliseconds else 1
+    step = DURATION_SECONDS * scale // limit
+    return encode_timestamps(
+        [START * scale + i * step for i in range(limit - 1)], milliseconds)
+
+
+def _update(record: bytes, now: int, duration: int, milliseconds: bool) -> bytes:
+    base, offsets = timestamp_offsets(record, milliseconds)
+    start = bisect.bisect_right(offsets, now - duration - base)
+    return append_timestamp(record, start, now, milliseconds)
+
+
+def _per_call(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def _invocation(milliseconds: bool) -> float:
+    session = MagicMock()
+    session.storage = InMemoryStorage()
+    clock = VirtualClock(START)
+    tool = UsageLimitTool(runtime=MagicMock(), session=session)
+    tool.clock = clock
+    tool.create_json_message = dict
+    window = {'duration_milliseconds': '10000'} if milliseconds else {'duration_seconds': '10'}
+    parameters = {'user_id': 'user', 'tracking_method': 'workspace-user',
+                  'limit': '1000000', **window}
+
+    def invoke():
+        clock.advance(0.001)
+        list(tool._invoke(parameters))  # pylint: disable=protected-access
+    return _per_call(invoke, 2000)
+
+
+def main():
+    """Print the time per update and the record size of both resolutions."""
+    print(f"{'limit':>8} {'s us':>8} {'ms us':>8} {'s bytes':>9} {'ms bytes':>9}")
+    for limit in LIMITS:
+        number = max(10, 1_000_000 // limit)
+        results = []
+        for milliseconds in (False, True):
+            scale = 1000 if milliseconds else 1
+            record = _record(limit, milliseconds)
+            now = (START + DURATION_SECONDS - 1) * scale
+            results.append((_per_call(
+                lambda r=record, n=now, d=DURATION_SECONDS * scale, m=milliseconds:
+                _update(r, n, d, m), number), len(record)))
+        (seconds, seconds_bytes), (millis, millis_bytes) = results
+        print(f"{limit:>8} {seconds * 1e6:>8.2f} {millis * 1e6:>8.2f} "
+              f"{seconds_bytes:>9} {millis_bytes:>9}")
+    print(f"invocation of a 10 s window: {_invocation(False) * 1e6:.1f} us, "
+          f"10000 ms window: {_invocation(True) * 1e6:.1f} us")
+
+
+if __name__ == '__main__':
+    main()
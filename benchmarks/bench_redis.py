@@ -0,0 +1,87 @@
+"""
+Benchmark the latency of the Redis backend against the session storage.
+
+Runs 1k UsageLimitTool invocations spread over 100 users against the session
+storage stand-in and against Redis, both with the same simulated round-trip
+latency. Redis is served in-process by fakeredis unless `--redis-url` points to a
+live server, where the keys are prefixed with "bench-". Fixed and sliding windows
+run as one server-side script on Redis; the gcra strategy is included for
+comparison, as it still uses separate reads and writes.
+
+Run with `python -m benchmarks.bench_redis`.
+"""
+import argparse
+import statistics
+import time
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+
+from tools.backends import InMemoryStorage, RedisStorage
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 1_000
+USERS = 100
+LATENCY_SECONDS = 0.0002
+STRATEGIES = ("fixed", "sliding", "gcra")
+
+
+class _LatencyFakeRedis(fakeredis.FakeRedis):
+    """In-process Redis that simulates the network round-trip of every command."""
+
+    round_trips = 0
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        time.sleep(LATENCY_SECONDS)
+        return super().execute_command(*args, **options)
+
+
+def _run(session, strategy: str, redis: RedisStorage | None) -> tuple[float, float]:
+    runtime = MagicMock()
+    latencies = []
+    with patch('tools.usage_limit.backend_from_parameters',
+               return_value=redis or session.storage):
+        for i in range(INVOCATIONS):
+            tool = UsageLimitTool(runtime=runtime, session=session)
+            tool.create_json_message = dict
+            start = time.perf_counter()
+            list(tool._invoke({  # pylint: disable=protected-access
+                'user_id': f'user{i % USERS}',
+                'tracking_method': 'app-user',
+                'limit': '1000000',
+                'duration_seconds': '3600',
+                'limit_strategy': strategy,
+                'storage_backend': 'redis' if redis else 'session',
+            }))
+            latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies), sorted(latencies)[int(0.99 * len(latencies))]
+
+
+def main():
+    """Print p50/p99 latency and round-trips per call of both backends."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--redis-url", help="benchmark a live Redis server instead of fakeredis")
+    args = parser.parse_args()
+
+    print(f"{'strategy':>10} {'backend':>8} {'p50 ms':>8} {'p99 ms':>8} {'trips':>6}")
+    for strategy in STRATEGIES:
+        session = MagicMock()
+        session.app_id = f"bench-{strategy}-"
+        session.storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+        p50, p99 = _run(session, strategy, None)
+        trips = sum(session.storage.calls.values()) / INVOCATIONS
+        print(f"{strategy:>10} {'session':>8} {p50 * 1000:>8.3f} {p99 * 1000:>8.3f} {trips:>6.1f}")
+
+        if args.redis_url:
+            import redis  # pylint: disable=import-outside-toplevel
+            client = redis.Redis.from_url(args.redis_url)
+        else:
+            client = _LatencyFakeRedis()
+        p50, p99 = _run(session, strategy, RedisStorage(client))
+        trips = f"{client.round_trips / INVOCATIONS:.1f}" if not args.redis_url else "-"
+        print(f"{strategy:>10} {'redis':>8} {p50 * 1000:>8.3f} {p99 * 1000:>8.3f} {trips:>6}")
+
+
+if __name__ == '__main__':
+    main()
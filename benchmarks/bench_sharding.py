@@ -0,0 +1,68 @@
+"""
+Benchmark contended throughput of sharded fixed window counters.
+
+Runs 64 concurrent callers on one app-wide identifier against an in-memory
+storage stand-in with simulated round-trip latency, comparing the single-key
+path with 8 shards, with and without the cached aggregate of other shards.
+
+Run with `python -m benchmarks.bench_sharding`.
+"""
+import threading
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.sharding import SHARD_COUNTS
+from tools.usage_limit import UsageLimitTool
+
+CALLERS = 64
+INVOCATIONS_PER_CALLER = 20
+LATENCY_SECONDS = 0.0002
+MODES = (
+    ("single key", {}),
+    ("8 shards", {'shard_count': '8', 'shard_by': 'random'}),
+    ("8 shards, cached", {'shard_count': '8', 'shard_by': 'random', 'shard_cache_seconds': '1'}),
+)
+
+
+def _run(extra_parameters: dict) -> tuple[float, int]:
+    storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    SHARD_COUNTS.invalidate("app123")
+
+    def caller(index: int):
+        for _ in range(INVOCATIONS_PER_CALLER):
+            tool = UsageLimitTool(runtime=MagicMock(), session=session)
+            tool.create_json_message = MagicMock()
+            list(tool._invoke({  # pylint: disable=protected-access
+                'user_id': f'user{index}',
+                'tracking_method': 'app',
+                'limit': '1000000',
+                'duration_seconds': '3600',
+                'limit_strategy': 'fixed',
+                **extra_parameters
+            }))
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(CALLERS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return CALLERS * INVOCATIONS_PER_CALLER / elapsed, storage.calls["get"]
+
+
+def main():
+    """Print throughput and storage reads per call for each mode."""
+    print(f"{'mode':>18} {'ops/sec':>10} {'reads/call':>11}")
+    for name, extra_parameters in MODES:
+        throughput, reads = _run(extra_parameters)
+        print(f"{name:>18} {throughput:>10.0f} "
+              f"{reads / (CALLERS * INVOCATIONS_PER_CALLER):>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
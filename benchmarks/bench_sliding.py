@@ -0,0 +1,65 @@
+"""
+Benchmark one sliding window update at growing limits.
+
+Compares rebuilding the timestamp list on every call, as the sliding window did
+before, against finding the expired prefix with `bisect` and slicing it off the
+stored record. Each record holds `limit - 1` timestamps, so the call is allowed,
+and is measured once with nothing expired and once with the oldest timestamp
+expired.
+
+Run with `python -m benchmarks.bench_sliding`.
+"""
+import bisect
+import timeit
+
+from tools.encoding import (
+    append_timestamp,
+    decode_timestamps,
+    encode_timestamps,
+    timestamp_offsets,
+)
+
+LIMITS = (1_000, 10_000, 100_000)
+DURATION_SECONDS = 31536000
+START = 1_700_000_000
+
+
+def _record(limit: int) -> bytes:
+    step = DURATION_SECONDS // limit
+    return encode_timestamps([START + i * step for i in range(limit - 1)])
+
+
+def _rebuild(record: bytes, now: int) -> bytes:
+    window_start = now - DURATION_SECONDS
+    timestamps = [t for t in decode_timestamps(record) if t > window_start]
+    timestamps.append(now)
+    return encode_timestamps(timestamps)
+
+
+def _bisect(record: bytes, now: int) -> bytes:
+    base, offsets = timestamp_offsets(record)
+    start = bisect.bisect_right(offsets, now - DURATION_SECONDS - base)
+    return append_timestamp(record, start, now)
+
+
+def _per_call(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    """Print the time per call of both engines for each limit."""
+    print(f"{'limit':>8} {'expired':>8} {'rebuild us':>11} {'bisect us':>10}")
+    for limit in LIMITS:
+        record = _record(limit)
+        number = max(10, 1_000_000 // limit)
+        for expired, now in ((0, START + DURATION_SECONDS - 1),
+                             (1, START + DURATION_SECONDS)):
+            assert decode_timestamps(_rebuild(record, now)) == \
+                decode_timestamps(_bisect(record, now))
+            rebuild = _per_call(lambda r=record, n=now: _rebuild(r, n), number)
+            sliced = _per_call(lambda r=record, n=now: _bisect(r, n), number)
+            print(f"{limit:>8} {expired:>8} {rebuild * 1e6:>11.2f} {sliced * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+Benchmark suite for the UsageLimitTool and ResetUsageTool hot paths.
+
+Drives both tools against an in-memory storage stand-in with configurable
+simulated round-trip latency, for every strategy, a range of limits and window
+lengths, and two traffic shapes:
+
+- "hot": every invocation updates the same app-wide identifier.
+- "many": invocations are spread over many app-user identifiers.
+
+Records are prefilled to half of their limit before measuring, so the record
+sizes and the decode/encode work match a window in steady use. For each case it
+reports throughput, p50/p99 latency, storage round-trips and bytes stored per
+identifier, and the peak memory allocated by one call.
+
+Run with `python -m benchmarks.bench_suite`, or with `--json results.json` to write
+machine-readable results for tracking regressions. `--help` lists all options.
+"""
+import argparse
+import json
+import math
+import statistics
+import time
+import tracemalloc
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.encoding import (
+    encode_arrival_time,
+    encode_buckets,
+    encode_counter,
+    encode_timestamps,
+)
+from tools.exceptions import UsageLimitExceededException
+from tools.reset_usage import ResetUsageTool
+from tools.usage_limit import UsageLimitTool
+
+STRATEGIES = ("fixed", "sliding", "sliding-counter", "sliding-buckets", "gcra")
+LIMITS = (10, 1_000, 100_000)
+WINDOWS = (60, 3600, 86400)
+SHAPES = ("hot", "many")
+MANY_KEYS = 100
+BUCKET_COUNT = 24
+ALLOCATION_SAMPLES = 50
+# Shared by all tools, so mock construction is not measured
+RUNTIME = MagicMock()
+
+
+def _session(storage: InMemoryStorage) -> MagicMock:
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    return session
+
+
+def _parameters(strategy: str, limit: int, window: int, shape: str, index: int) -> dict:
+    return {
+        'user_id': f'user{index % MANY_KEYS}',
+        'tracking_method': 'app' if shape == "hot" else 'app-user',
+        'limit': str(limit),
+        'duration_seconds': str(window),
+        'limit_strategy': strategy,
+        'bucket_count': str(BUCKET_COUNT),
+    }
+
+
+def _identifiers(shape: str) -> list[str]:
+    if shape == "hot":
+        return ["app123"]
+    return [f"app123user{index}" for index in range(MANY_KEYS)]
+
+
+def _prefill(strategy: str, limit: int, window: int, now: int) -> bytes:
+    """Return a record that holds half of `limit` spread over the current window."""
+    usage = limit // 2
+    if strategy == "fixed":
+        return f"{usage}:{now - window // 2}".encode()
+    if strategy == "sliding":
+        return encode_timestamps([now - window + 1 + i * window // max(usage, 1)
+                                  for i in range(usage)])
+    if strategy == "sliding-counter":
+        return encode_counter(now - now % window - window, usage, 0)
+    if strategy == "sliding-buckets":
+        bucket_seconds = -(-window // BUCKET_COUNT)
+        counts = [usage // BUCKET_COUNT] * BUCKET_COUNT
+        return encode_buckets(bucket_seconds, now // bucket_seconds, counts)
+    emission_interval = -(-window * 1_000_000 // limit)
+    return encode_arrival_time(now * 1_000_000 + usage * emission_interval)
+
+
+def _invoke(tool, parameters: dict) -> None:
+    tool.create_json_message = dict
+    try:
+        list(tool._invoke(parameters))  # pylint: disable=protected-access
+    except UsageLimitExceededException:
+        pass
+
+
+def _percentile(latencies: list[float], percentile: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, math.ceil(percentile * len(ordered)) - 1)]
+
+
+def run_case(strategy: str, limit: int, window: int, shape: str,
+             operations: int, latency_seconds: float) -> dict:
+    """Measure one strategy, limit, window and traffic shape."""
+    storage = InMemoryStorage(latency_seconds=latency_seconds)
+    session = _session(storage)
+    identifiers = _identifiers(shape)
+    now = int(time.time())
+    for identifier in identifiers:
+        storage.set(identifier, _prefill(strategy, limit, window, now))
+    storage.calls.clear()
+
+    latencies = []
+    start = time.perf_counter()
+    for index in range(operations):
+        parameters = _parameters(strategy, limit, window, shape, index)
+        call_start = time.perf_counter()
+        _invoke(UsageLimitTool(runtime=RUNTIME, session=session), parameters)
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    round_trips = sum(storage.calls.values())
+
+    peaks = []
+    tracemalloc.start()
+    for index in range(ALLOCATION_SAMPLES):
+        parameters = _parameters(strategy, limit, window, shape, operations + index)
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        _invoke(UsageLimitTool(runtime=RUNTIME, session=session), parameters)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    return {
+        "tool": "usage-limit",
+        "strategy": strategy,
+        "limit": limit,
+        "window_seconds": window,
+        "shape": shape,
+        "operations": operations,
+        "ops_per_second": operations / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "round_trips_per_call": round_trips / operations,
+        "bytes_per_identifier": statistics.mean(
+            len(storage.get(identifier)) for identifier in identifiers),
+        "alloc_peak_bytes_per_call": statistics.median(peaks),
+    }
+
+
+def run_reset_case(shape: str, operations: int, latency_seconds: float) -> dict:
+    """Measure ResetUsageTool on existing records."""
+    storage = InMemoryStorage(latency_seconds=latency_seconds)
+    session = _session(storage)
+    identifiers = _identifiers(shape)
+    latencies = []
+    start = time.perf_counter()
+    for index in range(operations):
+        parameters = _parameters("fixed", 10, 60, shape, index)
+        storage.set(identifiers[index % len(identifiers)], b"1:0")
+        call_start = time.perf_counter()
+        tool = ResetUsageTool(runtime=RUNTIME, session=session)
+        tool.create_json_message = dict
+        list(tool._invoke(parameters))  # pylint: disable=protected-access
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    return {
+        "tool": "reset-usage",
+        "shape": shape,
+        "operations": operations,
+        "ops_per_second": operations / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    """Run the benchmark matrix and print a table, optionally writing JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--operations", type=int, default=200,
+                        help="invocations measured per case")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="simulated storage round-trip latency")
+    parser.add_argument("--strategies", nargs="+", default=STRATEGIES, choices=STRATEGIES)
+    parser.add_argument("--limits", nargs="+", type=int, default=LIMITS)
+    parser.add_argument("--windows", nargs="+", type=int, default=WINDOWS)
+    parser.add_argument("--shapes", nargs="+", default=SHAPES, choices=SHAPES)
+    parser.add_argument("--json", metavar="PATH", help="write the results to PATH as JSON")
+    args = parser.parse_args()
+    latency_seconds = args.latency_ms / 1000
+
+    results = []
+    print(f"{'strategy':>16} {'limit':>7} {'window':>6} {'shape':>5} {'ops/sec':>9} "
+          f"{'p50 ms':>7} {'p99 ms':>7} {'trips':>6} {'bytes':>8} {'alloc B':>8}")
+    for strategy in args.strategies:
+        for limit in args.limits:
+            for window in args.windows:
+                for shape in args.shapes:
+                    result = run_case(strategy, limit, window, shape,
+                                      args.operations, latency_seconds)
+                    results.append(result)
+                    print(f"{strategy:>16} {limit:>7} {window:>6} {shape:>5} "
+                          f"{result['ops_per_second']:>9.0f} {result['p50_ms']:>7.3f} "
+                          f"{result['p99_ms']:>7.3f} {result['round_trips_per_call']:>6.1f} "
+                          f"{result['bytes_per_identifier']:>8.0f} "
+                          f"{result['alloc_peak_bytes_per_call']:>8.0f}")
+    for shape in args.shapes:
+        result = run_reset_case(shape, args.operations, latency_seconds)
+        results.append(result)
+        print(f"{'reset-usage':>16} {'':>7} {'':>6} {shape:>5} "
+              f"{result['ops_per_second']:>9.0f} {result['p50_ms']:>7.3f} "
+              f"{result['p99_ms']:>7.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"latency_ms": args.latency_ms, "results": results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark per-minute, per-day and per-month limits as separate nodes and as tiers.
+
+Runs 1k invocations spread over 100 users against the session storage stand-in
+with simulated round-trip latency, enforcing 20/minute, 500/day and 5000/month
+once with three chained Usage Limit nodes, and once with one node holding all
+three windows in a single record. Reports the mean latency and the storage
+round-trips per message.
+
+Run with `python -m benchmarks.bench_tiers`.
+"""
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 1_000
+USERS = 100
+LATENCY_SECONDS = 0.0002
+WINDOWS = ((20, 60), (500, 86400), (5000, 2592000))
+
+
+def _node_parameters(tiers: bool) -> list[dict]:
+    base = {'tracking_method': 'app-user', 'limit_strategy': 'sliding-counter',
+            'key_format': 'namespaced'}
+    if tiers:
+        return [{**base, 'limit': str(WINDOWS[0][0]), 'duration_seconds': str(WINDOWS[0][1]),
+                 'tiers': ", ".join(f"{limit}/{seconds}" for limit, seconds in WINDOWS[1:])}]
+    return [{**base, 'limit': str(limit), 'duration_seconds': str(seconds)}
+            for limit, seconds in WINDOWS]
+
+
+def _run(tiers: bool) -> tuple[float, float]:
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    runtime = MagicMock()
+    nodes = _node_parameters(tiers)
+    start = time.perf_counter()
+    for i in range(INVOCATIONS):
+        for parameters in nodes:
+            tool = UsageLimitTool(runtime=runtime, session=session)
+            tool.create_json_message = dict
+            list(tool._invoke({  # pylint: disable=protected-access
+                **parameters, 'user_id': f'user{i % USERS}'}))
+    elapsed = time.perf_counter() - start
+    return elapsed / INVOCATIONS, sum(session.storage.calls.values()) / INVOCATIONS
+
+
+def main():
+    """Print the latency and round-trips per message of both configurations."""
+    print(f"{'configuration':>16} {'latency ms':>11} {'trips':>6}")
+    for name, tiers in (("three nodes", False), ("tiers", True)):
+        latency, trips = _run(tiers)
+        print(f"{name:>16} {latency * 1000:>11.3f} {trips:>6.1f}")
+
+
+if __name__ == '__main__':
+    main()
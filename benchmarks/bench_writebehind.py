@@ -0,0 +1,66 @@
+"""
+Benchmark the latency of a decision with synchronous writes and with write-behind.
+
+Runs UsageLimitTool invocations spread over 10 users against an in-memory storage
+stand-in with a simulated round-trip of 1 ms, the order of a call to the Dify daemon.
+A synchronous decision waits for the read, the version check and the write of the
+record; with write-behind it waits for no write, and no read either while the record of
+the user is pending, and the records are written by the background thread. Reports the
+median and 99th percentile latency, the storage round-trips, and the time the queue
+takes to drain once the invocations are done.
+
+Run with `python -m benchmarks.bench_writebehind`.
+"""
+import statistics
+import time
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.cache import RECORD_CACHE
+from tools.storage import WRITE_BEHIND
+from tools.usage_limit import UsageLimitTool
+
+INVOCATIONS = 2_000
+USERS = 10
+LATENCY_SECONDS = 0.001
+
+
+def _run(write_behind_seconds: float) -> tuple[list[float], InMemoryStorage, float]:
+    storage = InMemoryStorage(latency_seconds=LATENCY_SECONDS)
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    RECORD_CACHE.clear()
+    WRITE_BEHIND.clear()
+    latencies = []
+    for i in range(INVOCATIONS):
+        tool = UsageLimitTool(runtime=MagicMock(), session=session)
+        tool.create_json_message = MagicMock()
+        start = time.perf_counter()
+        list(tool._invoke({  # pylint: disable=protected-access
+            'user_id': f'user{i % USERS}',
+            'tracking_method': 'app-user',
+            'limit': '1000000',
+            'limit_strategy': 'sliding-counter',
+            'write_behind_seconds': str(write_behind_seconds)
+        }))
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    WRITE_BEHIND.drain()
+    return latencies, storage, time.perf_counter() - start
+
+
+def main():
+    """Print the decision latency and storage writes of both write paths."""
+    print(f"{'write-behind':>12} {'p50 ms':>7} {'p99 ms':>7} {'gets':>6} {'sets':>6} "
+          f"{'drain ms':>9}")
+    for write_behind_seconds in (0, 0.1, 1.0):
+        latencies, storage, drain = _run(write_behind_seconds)
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f"{write_behind_seconds:>11}s {quantiles[49] * 1e3:>7.2f} "
+              f"{quantiles[98] * 1e3:>7.2f} {storage.calls['get']:>6} "
+              f"{storage.calls['set']:>6} {drain * 1e3:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Replay usage traces through the Usage Limit tool in virtual time.
+
+Every event of a trace is a timestamp, an identifier and optionally a cost. Events
+are replayed in order against the session storage stand-in, with the clock of the
+tool set to the timestamp of the event, so a week of traffic replays in the time its
+invocations take. Every decision is compared with an exact sliding window of the
+same limit and duration, which allows a usage if the cost of the usages it allowed
+within the window leaves room for it.
+
+Reports the share of decisions that match the exact window, the usages that were
+wrongly allowed and wrongly denied, the peak and final bytes stored, and the time and
+storage round-trips per invocation. Use it to size limits and compare strategies
+against recorded traffic before rolling them out.
+
+Trace files are CSV with one `timestamp,identifier[,cost]` line per usage, where the
+identifier is passed as the user ID. Without a trace, a synthetic one is generated
+from a seed, so every run with the same options makes the same decisions.
+
+Run with `python -m benchmarks.simulate --trace usage.csv --limit 100
+--duration-seconds 3600 --strategy sliding-counter`. `--help` lists all options.
+"""
+import argparse
+import csv
+import json
+import random
+import time
+from collections import deque
+from unittest.mock import MagicMock
+
+from tools.backends import InMemoryStorage
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.clock import VirtualClock
+from tools.exceptions import UsageLimitExceededException
+from tools.expiry import EXPIRY
+from tools.quota import QUOTA
+from tools.usage_limit import UsageLimitTool
+
+STRATEGIES = ("fixed", "sliding", "sliding-counter", "sliding-buckets", "gcra")
+# Storage growth is sampled every this many events
+SAMPLE_EVERY = 100
+# Shared by all tools, so mock construction is not measured
+RUNTIME = MagicMock()
+
+Event = tuple[float, str, int]
+
+
+def load_trace(path: str) -> list[Event]:
+    """
+    Read a trace of `timestamp,identifier[,cost]` lines, ordered by timestamp.
+
+    Parameters:
+    - `path`: The CSV file holding the trace.
+
+    Returns:
+    - `events`: The timestamp, identifier and cost of every usage.
+    """
+    with open(path, newline="", encoding="utf-8") as trace:
+        events = [(float(row[0]), row[1], int(row[2]) if len(row) > 2 and row[2] else 1)
+                  for row in csv.reader(trace) if row and not row[0].startswith("#")]
+    # Stable, so usages with the same timestamp keep their order
+    return sorted(events, key=lambda event: event[0])
+
+
+def synthetic_trace(events: int, users: int, span_seconds: int, seed: int = 0,
+                    start: int = 1_700_000_000) -> list[Event]:
+    """
+    Generate a trace with uniformly spread usages and a few heavy users.
+
+    Parameters:
+    - `events`: The number of usages.
+    - `users`: The number of identifiers.
+    - `span_seconds`: The time the usages are spread over.
+    - `seed`: The seed of the generator.
+    - `start`: The epoch of the first possible usage.
+
+    Returns:
+    - `events`: The timestamp, identifier and cost of every usage, ordered by timestamp.
+    """
+    rng = random.Random(seed)
+    timestamps = sorted(start + rng.random() * span_seconds for _ in range(events))
+    # Squaring skews the usages towards the first identifiers
+    return [(timestamp, f"user{int(users * rng.random() ** 2)}", 1) for timestamp in timestamps]
+
+
+class ExactWindow:
+    """
+    The oracle of a replay: an exact sliding window over the usages it allowed.
+
+    Usages are counted at the second they happen, like the sliding window of the
+    tool, so the "sliding" strategy matches it exactly.
+    """
+
+    def __init__(self, limit: int, duration_seconds: int):
+        self.limit = limit
+        self.duration_seconds = duration_seconds
+        self._usages: dict[str, deque[tuple[int, int]]] = {}
+        self._totals: dict[str, int] = {}
+
+    def allow(self, identifier: str, timestamp: float, cost: int) -> bool:
+        """Return whether a usage is allowed, and count it if it is."""
+        now = int(timestamp)
+        usages = self._usages.setdefault(identifier, deque())
+        total = self._totals.get(identifier, 0)
+        while usages and usages[0][0] <= now - self.duration_seconds:
+            total -= usages.popleft()[1]
+        allowed = total + cost <= self.limit
+        if allowed:
+            usages.append((now, cost))
+            total += cost
+        self._totals[identifier] = total
+        return allowed
+
+
+def replay(events: list[Event], parameters: dict) -> dict:
+    """
+    Replay a trace through the Usage Limit tool in virtual time.
+
+    Parameters:
+    - `events`: The timestamp, identifier and cost of every usage, ordered by timestamp.
+    - `parameters`: The tool parameters of the node, with at least a `limit`.
+
+    Returns:
+    - `report`: The decisions, their accuracy against an exact sliding window, the
+       storage growth and the cost per invocation.
+    """
+    parameters = {'tracking_method': 'workspace-user', **parameters}
+    oracle = ExactWindow(int(parameters["limit"]),
+                         int(parameters.get("duration_seconds") or 3600))
+    storage = InMemoryStorage()
+    session = MagicMock()
+    session.app_id = "app123"
+    session.storage = storage
+    clock = VirtualClock(events[0][0] if events else 0.0)
+    # Process-wide state of earlier replays must not leak into this one
+    for tracker in (DENY_CACHE, RECORD_CACHE, EXPIRY, QUOTA):
+        tracker.clear()
+
+    allowed = false_allows = false_denials = peak_bytes = 0
+    elapsed = 0.0
+    for index, (timestamp, identifier, cost) in enumerate(events):
+        clock.set(timestamp)
+        tool = UsageLimitTool(runtime=RUNTIME, session=session)
+        tool.clock = clock
+        tool.create_json_message = dict
+        start = time.perf_counter()
+        try:
+            list(tool._invoke({  # pylint: disable=protected-access
+                **parameters, 'user_id': identifier, 'cost': cost}))
+            decision = True
+        except UsageLimitExceededException:
+            decision = False
+        elapsed += time.perf_counter() - start
+        expected = oracle.allow(identifier, timestamp, cost)
+        allowed += decision
+        false_allows += decision and not expected
+        false_denials += expected and not decision
+        if index % SAMPLE_EVERY == 0:
+            peak_bytes = max(peak_bytes, storage.stored_bytes)
+
+    count = len(events)
+    return {
+        "events": count,
+        "allowed": allowed,
+        "denied": count - allowed,
+        "accuracy": 1 - (false_allows + false_denials) / count if count else 1.0,
+        "false_allows": false_allows,
+        "false_denials": false_denials,
+        "peak_bytes": max(peak_bytes, storage.stored_bytes),
+        "final_bytes": storage.stored_bytes,
+        "virtual_seconds": events[-1][0] - events[0][0] if events else 0.0,
+        "us_per_call": elapsed / count * 1e6 if count else 0.0,
+        "round_trips_per_call": sum(storage.calls.values()) / count if count else 0.0,
+    }
+
+
+def main():
+    """Replay a trace with every selected strategy and print the reports."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", help="CSV file of timestamp,identifier[,cost] lines")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--duration-seconds", type=int, default=3600)
+    parser.add_argument("--strategies", nargs="+", choices=STRATEGIES, default=STRATEGIES)
+    parser.add_argument("--parameter", action="append", default=[], metavar="NAME=VALUE",
+                        help="further tool parameter, e.g. bucket_count=12")
+    parser.add_argument("--events", type=int, default=100_000,
+                        help="usages of the synthetic trace")
+    parser.add_argument("--users", type=int, default=100,
+                        help="identifiers of the synthetic trace")
+    parser.add_argument("--span-seconds", type=int, default=7 * 86400,
+                        help="time the synthetic trace is spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="write the reports to PATH as JSON")
+    args = parser.parse_args()
+
+    events = load_trace(args.trace) if args.trace else synthetic_trace(
+        args.events, args.users, args.span_seconds, args.seed)
+    extra = dict(parameter.split("=", 1) for parameter in args.parameter)
+    reports = {}
+    print(f"{'strategy':>16} {'allowed':>8} {'accuracy':>9} {'false +':>8} {'false -':>8} "
+          f"{'peak kB':>8} {'us/call':>8} {'trips':>6}")
+    for strategy in args.strategies:
+        report = reports[strategy] = replay(events, {
+            'limit': args.limit, 'duration_seconds': args.duration_seconds,
+            'limit_strategy': strategy, **extra})
+        print(f"{strategy:>16} {report['allowed']:>8} {report['accuracy']:>9.2%} "
+              f"{report['false_allows']:>8} {report['false_denials']:>8} "
+              f"{report['peak_bytes'] / 1024:>8.1f} {report['us_per_call']:>8.1f} "
+              f"{report['round_trips_per_call']:>6.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(reports, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# pylint: disable=missing-module-docstring
+import hmac
+import json
+from collections.abc import Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from werkzeug import Request, Response
+
+# Largest number of items accepted in one request.
+BATCH_LIMIT = 10_000
+# Number of items evaluated concurrently, so their storage round-trips overlap
+# instead of being paid one after the other.
+PIPELINE_DEPTH = 32
+# Storage settings of the endpoint group, which items cannot override.
+BACKEND_SETTINGS = ("storage_backend", "storage_path", "redis_url")
+# Item parameter holding the ID each tracking method needs besides the user ID.
+TRACKING_METHOD_IDS = {"app-user": "app_id", "app": "app_id", "conversation": "conversation_id"}
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+class BatchSession:
+    """
+    The session a tool is invoked with for one item of a batch.
+
+    Endpoints are not called from an app, so the app and conversation of an item
+    are taken from the item instead of the session.
+    """
+
+    def __init__(self, storage: Any, app_id: str | None, conversation_id: str | None):
+        self.storage = storage
+        self.app_id = app_id
+        self.conversation_id = conversation_id
+
+
+def authorized(r: Request, settings: Mapping) -> bool:
+    """Return whether the request carries the API key of the endpoint group."""
+    api_key = settings.get("api_key")
+    return bool(api_key) and hmac.compare_digest(
+        r.headers.get("X-Api-Key", "").encode(), str(api_key).encode())
+
+
+def parse_batch(r: Request) -> tuple[dict[str, Any], list[dict[str, Any]]]:
+    """
+    Parse the JSON body of a batch request.
+
+    Parameters:
+    - `r`: The request, whose body holds the `items` array and optional `defaults`.
+
+    Returns:
+    - `defaults`: The tool parameters shared by all items.
+    - `items`: The tool parameters of every item, each with at least a `user_id`.
+    """
+    body = r.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ValueError("Invalid batch")
+    defaults = body.get("defaults") or {}
+    items = body.get("items")
+    if not isinstance(defaults, dict) or not isinstance(items, list) or not all(
+            isinstance(item, dict) and "user_id" in item for item in items):
+        raise ValueError("Invalid batch")
+    if len(items) > BATCH_LIMIT:
+        raise ValueError(f"Batches are limited to {BATCH_LIMIT} items")
+    return defaults, items
+
+
+def missing_id(parameters: dict[str, Any]) -> str | None:
+    """
+    Return the name of an ID that the tracking method of the item or of one of its
+    rules needs but the item lacks, or None if it has all of them.
+    """
+    tracking_methods = [parameters.get("tracking_method")]
+    rules = parameters.get("rules")
+    if isinstance(rules, str):
+        try:
+            rules = json.loads(rules)
+        except ValueError:
+            # Reported by the tool
+            rules = None
+    if isinstance(rules, list):
+        tracking_methods += [
+            rule.get("tracking_method") for rule in rules if isinstance(rule, dict)]
+    for tracking_method in tracking_methods:
+        name = TRACKING_METHOD_IDS.get(tracking_method)
+        if name is not None and not parameters.get(name):
+            return name
+    return None
+
+
+def run_batch(
+    session: Any,
+    settings: Mapping,
+    tool_class: type,
+    defaults: dict[str, Any],
+    items: list[dict[str, Any]],
+    overrides: dict[str, Any] | None = None
+) -> Iterator[dict[str, Any]]:
+    """
+    Invoke a tool for every item of a batch, `PIPELINE_DEPTH` items at a time.
+
+    The storage settings of the defaults and items are ignored in favour of those of
+    the endpoint group, and items lacking the app or conversation ID of their tracking
+    method report an error instead of being tracked without it.
+
+    Parameters:
+    - `session`: The session of the endpoint.
+    - `settings`: The settings of the endpoint group.
+    - `tool_class`: The tool to invoke.
+    - `defaults`: The tool parameters shared by all items.
+    - `items`: The tool parameters of every item.
+    - `overrides` (optional): Tool parameters that replace those of the items.
+
+    Returns:
+    - `results`: The JSON message of every item in the order of the items, or its error.
+    """
+    backend = {name: settings[name] for name in BACKEND_SETTINGS if settings.get(name)}
+
+    def invoke(item: dict[str, Any]) -> dict[str, Any]:
+        parameters = {
+            **{name: value for name, value in {**defaults, **item}.items()
+               if name not in BACKEND_SETTINGS},
+            **(overrides or {}), **backend}
+        name = missing_id(parameters)
+        if name is not None:
+            return {"user_id": item["user_id"], "error": f"Missing {name}"}
+        tool = tool_class(runtime=None, session=BatchSession(
+            session.storage, parameters.get("app_id"), parameters.get("conversation_id")))
+        try:
+            messages = list(tool._invoke(parameters))  # pylint: disable=protected-access
+        except KeyError as e:
+            return {"user_id": item["user_id"], "error": f"Missing {e.args[0]}"}
+        # pylint: disable=broad-except
+        except Exception as e:
+            return {"user_id": item["user_id"], "error": str(e)}
+        return {"user_id": item["user_id"], **messages[-1].message.json_object}
+
+    with ThreadPoolExecutor(PIPELINE_DEPTH) as executor:
+        yield from executor.map(invoke, items)
+
+
+def batch_response(r: Request, results: Iterator[dict[str, Any]]) -> Response:
+    """
+    Return the results of a batch as one JSON object, or streamed as one JSON object
+    per line if the request accepts NDJSON.
+    """
+    if NDJSON_MIMETYPE in r.headers.get("Accept", ""):
+        return Response((json.dumps(result) + "\n" for result in results),
+                        status=200, mimetype=NDJSON_MIMETYPE)
+    return Response(json.dumps({"results": list(results)}), status=200,
+                    mimetype="application/json")
+
+
+def error_response(status: int, error: str) -> Response:
+    """Return a JSON error response."""
+    return Response(json.dumps({"error": error}), status=status, mimetype="application/json")
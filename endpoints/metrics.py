@@ -0,0 +1,25 @@
+# pylint: disable=missing-module-docstring
+from collections.abc import Mapping
+
+from werkzeug import Request, Response
+
+from dify_plugin import Endpoint
+from endpoints.batch import authorized, error_response
+from tools.metrics import METRICS
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
+
+
+class MetricsEndpoint(Endpoint):
+    """
+    The `MetricsEndpoint` exports the metrics collected by the Usage Limit tool in the
+    Prometheus text format.
+
+    Metrics are collected by invocations with `collect_metrics` enabled, and are kept
+    per plugin process, so every process reports its own counts.
+    """
+
+    def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
+        if not authorized(r, settings):
+            return error_response(401, "Unauthorized")
+        return Response(METRICS.render(), status=200, content_type=PROMETHEUS_MIMETYPE)
@@ -0,0 +1,45 @@
+# pylint: disable=missing-module-docstring
+from collections.abc import Mapping
+
+from werkzeug import Request, Response
+
+from dify_plugin import Endpoint
+from endpoints.batch import (
+    authorized,
+    batch_response,
+    error_response,
+    parse_batch,
+    run_batch,
+)
+from tools.usage_limit import UsageLimitTool
+
+
+class QueryUsageEndpoint(Endpoint):
+    """
+    The `QueryUsageEndpoint` reports the usage of a batch of users without counting a usage.
+
+    The request body is a JSON object with an `items` array of Usage Limit tool parameters,
+    each with a `user_id` and, for tracking methods that need them, an `app_id` or
+    `conversation_id`. Parameters shared by all items can be given once in `defaults`.
+    Every item is evaluated in the "peek" mode, so the storage is only read, and the
+    reads of `PIPELINE_DEPTH` items are in flight at once.
+
+    The response holds the identifier, limit, current and remaining usage, reset seconds
+    and whether a usage would be allowed for every item, in the order of the items, or
+    the error of the item. Requests accepting `application/x-ndjson` receive one JSON
+    object per line as soon as it is available.
+    """
+
+    def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
+        if not authorized(r, settings):
+            return error_response(401, "Unauthorized")
+        try:
+            defaults, items = parse_batch(r)
+        except ValueError as e:
+            return error_response(400, str(e))
+        results = run_batch(
+            self.session, settings, UsageLimitTool, defaults, items, {"mode": "peek"})
+        # Reservations are of no use outside of a flow
+        return batch_response(r, (
+            {name: value for name, value in result.items() if name != "reservation_id"}
+            for result in results))
@@ -0,0 +1,39 @@
+# pylint: disable=missing-module-docstring
+from collections.abc import Mapping
+
+from werkzeug import Request, Response
+
+from dify_plugin import Endpoint
+from endpoints.batch import (
+    authorized,
+    batch_response,
+    error_response,
+    parse_batch,
+    run_batch,
+)
+from tools.reset_usage import ResetUsageTool
+
+
+class ResetUsageEndpoint(Endpoint):
+    """
+    The `ResetUsageEndpoint` resets the usage of a batch of users.
+
+    The request body is a JSON object with an `items` array of Reset Usage tool parameters,
+    each with a `user_id` and, for tracking methods that need them, an `app_id` or
+    `conversation_id`. Parameters shared by all items can be given once in `defaults`.
+    Every item is reset by the Reset Usage tool, so the same records are deleted as by
+    the tool, and `PIPELINE_DEPTH` items are reset at once.
+
+    The response holds the identifier and status of every item, in the order of the items,
+    or the error of the item. Requests accepting `application/x-ndjson` receive one JSON
+    object per line as soon as it is available.
+    """
+
+    def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
+        if not authorized(r, settings):
+            return error_response(401, "Unauthorized")
+        try:
+            defaults, items = parse_batch(r)
+        except ValueError as e:
+            return error_response(400, str(e))
+        return batch_response(r, run_batch(self.session, settings, ResetUsageTool, defaults, items))
@@ -0,0 +1,255 @@
+"""
+Conformance tests for the storage backends
+"""
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from tools.backends import (
+    InMemoryStorage,
+    RedisStorage,
+    SQLiteStorage,
+    backend_from_parameters,
+    open_backend,
+)
+
+try:
+    import fakeredis
+    # The window and compare-and-set scripts run on the Lua runtime of fakeredis[lua]
+    import lupa  # pylint: disable=unused-import
+except ImportError:  # pragma: no cover
+    if os.environ.get("CI"):
+        # Continuous integration runs the Redis scripts instead of skipping them
+        raise
+    fakeredis = None
+
+
+class BackendConformance:
+    """
+    Behaviour every storage backend shares with the Dify session storage.
+
+    Subclasses implement `create_backend`.
+    """
+
+    def create_backend(self):
+        """Return an empty backend."""
+        raise NotImplementedError
+
+    def setUp(self):  # pylint: disable=invalid-name
+        self.backend = self.create_backend()
+
+    def test_get_missing_key_raises(self):
+        """Test that reading a missing key raises."""
+        with self.assertRaises(Exception):
+            self.backend.get("missing")
+
+    def test_set_and_get_binary_value(self):
+        """Test that binary values are returned unchanged."""
+        value = bytes(range(256)) * 4
+        self.backend.set("key", value)
+        self.assertEqual(self.backend.get("key"), value)
+
+    def test_set_overwrites(self):
+        """Test that a second write replaces the value."""
+        self.backend.set("key", b"a")
+        self.backend.set("key", b"bb")
+        self.assertEqual(self.backend.get("key"), b"bb")
+
+    def test_set_copies_mutable_value(self):
+        """Test that later changes of a written bytearray are not stored."""
+        value = bytearray(b"a")
+        self.backend.set("key", value)
+        value[0] = ord("b")
+        self.assertEqual(self.backend.get("key"), b"a")
+
+    def test_delete(self):
+        """Test that a deleted key no longer exists and a second delete raises."""
+        self.backend.set("key", b"a")
+        self.backend.delete("key")
+        self.assertFalse(self.backend.exist("key"))
+        with self.assertRaises(Exception):
+            self.backend.get("key")
+        with self.assertRaises(Exception):
+            self.backend.delete("key")
+
+    def test_exist(self):
+        """Test that exist reports written keys only."""
+        self.assertFalse(self.backend.exist("key"))
+        self.backend.set("key", b"")
+        self.assertTrue(self.backend.exist("key"))
+
+    def test_keys_are_independent(self):
+        """Test that keys sharing a prefix do not affect each other."""
+        self.backend.set("app123", b"a")
+        self.backend.set("app123#1", b"b")
+        self.backend.delete("app123")
+        self.assertEqual(self.backend.get("app123#1"), b"b")
+
+    def test_concurrent_writes(self):
+        """Test that writes from several threads are all stored."""
+        def writer(thread: int):
+            for i in range(50):
+                self.backend.set(f"key{thread}:{i}", str(i).encode())
+
+        threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for thread in range(8):
+            self.assertEqual(self.backend.get(f"key{thread}:49"), b"49")
+
+
+class TestInMemoryStorage(BackendConformance, unittest.TestCase):
+    """
+    Conformance tests of InMemoryStorage.
+    """
+
+    def create_backend(self):
+        return InMemoryStorage()
+
+
+class TestSQLiteStorage(BackendConformance, unittest.TestCase):
+    """
+    Conformance tests of SQLiteStorage.
+    """
+
+    def create_backend(self):
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "usage.sqlite3")
+        backend = SQLiteStorage(self.path)
+        self.addCleanup(backend.close)
+        return backend
+
+    def test_records_are_shared_between_connections(self):
+        """Test that a second connection, like another plugin process, sees the records."""
+        self.backend.set("key", b"a")
+        other = SQLiteStorage(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.get("key"), b"a")
+
+
+@unittest.skipUnless(fakeredis, "fakeredis is not installed")
+class TestRedisStorage(BackendConformance, unittest.TestCase):
+    """
+    Conformance tests of RedisStorage and its atomic window updates.
+    """
+
+    def create_backend(self):
+        return RedisStorage(fakeredis.FakeRedis())
+
+    def test_fixed_window_usage(self):
+        """Test that the fixed window counts up to the limit and resets with its window."""
+        results = [self.backend.fixed_window_usage("key", 2, 60, 1000) for _ in range(3)]
+        self.assertEqual(results, [(True, 1, 1000), (True, 2, 1000), (False, 2, 1000)])
+        self.assertEqual(self.backend.get("key"), b"2:1000")
+        self.assertEqual(self.backend.client.ttl("key"), 61)
+        self.assertEqual(self.backend.fixed_window_usage("key", 2, 60, 1061), (True, 1, 1061))
+
+    def test_sliding_window_usage(self):
+        """Test that the sliding window admits usages as the oldest ones leave it."""
+        self.assertEqual(self.backend.sliding_window_usage("key", 2, 60, 1000), (True, 1, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 2, 60, 1010), (True, 2, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 2, 60, 1059), (False, 2, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 2, 60, 1060), (True, 2, 1010))
+
+    def test_weighted_window_usage(self):
+        """Test that both windows count the cost of a usage."""
+        self.assertEqual(self.backend.fixed_window_usage("fixed", 10, 60, 1000, 6), (True, 6, 1000))
+        self.assertEqual(self.backend.fixed_window_usage("fixed", 10, 60, 1001, 5), (False, 6, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1000, 6), (True, 6, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1010, 3), (True, 9, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1020, 5), (False, 9, 1000))
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1060, 5), (True, 8, 1010))
+
+    def test_sliding_window_weight_is_kept(self):
+        """Test that the summed weight is kept next to the set and follows expired usages."""
+        self.backend.sliding_window_usage("key", 10, 60, 1000, 4)
+        self.backend.sliding_window_usage("key", 10, 60, 1010)
+        self.assertEqual(self.backend.client.get("key#weight"), b"5")
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1060), (True, 2, 1010))
+        self.assertEqual(self.backend.client.get("key#weight"), b"2")
+        self.backend.delete("key")
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1061), (True, 1, 1061))
+
+    def test_sliding_window_expired_while_key_is_alive(self):
+        """Test that a window whose usages all expired before its key does not drift."""
+        self.assertEqual(self.backend.sliding_window_usage("key", 3, 10, 100), (True, 1, 100))
+        results = [self.backend.sliding_window_usage("key", 3, 10, now)
+                   for now in range(200, 210)]
+        self.assertEqual(results[:3], [(True, 1, 200), (True, 2, 200), (True, 3, 200)])
+        self.assertEqual(results[3:10], [(False, 3, 200)] * 7)
+        self.assertEqual(self.backend.client.zcard("key"), 3)
+        self.assertEqual(self.backend.client.get("key#weight"), b"3")
+
+    def test_sliding_window_without_weight_is_summed(self):
+        """Test that sets written before their weight was kept are summed once."""
+        self.backend.client.zadd("key", {"a": 1000, "b:3": 1010})
+        self.assertEqual(self.backend.sliding_window_usage("key", 10, 60, 1020), (True, 5, 1000))
+        self.assertEqual(self.backend.client.get("key#weight"), b"5")
+
+    def test_dry_run_window_usage(self):
+        """Test that dry runs report the result without counting the usage."""
+        self.backend.fixed_window_usage("fixed", 2, 60, 1000)
+        self.assertEqual(
+            self.backend.fixed_window_usage("fixed", 2, 60, 1001, 1, True), (True, 2, 1000))
+        self.assertEqual(self.backend.fixed_window_usage("fixed", 2, 60, 1002), (True, 2, 1000))
+        self.backend.sliding_window_usage("key", 2, 60, 1000)
+        self.assertEqual(
+            self.backend.sliding_window_usage("key", 2, 60, 1001, 1, True), (True, 2, 1000))
+        self.assertEqual(self.backend.client.zcard("key"), 1)
+
+    def test_window_scripts_replace_other_records(self):
+        """Test that records of another strategy are replaced instead of failing."""
+        self.backend.set("key", b"\x01binary")
+        self.assertEqual(self.backend.sliding_window_usage("key", 2, 60, 1000), (True, 1, 1000))
+        self.assertEqual(self.backend.fixed_window_usage("key", 2, 60, 1000), (True, 1, 1000))
+
+
+class TestOpenBackend(unittest.TestCase):
+    """
+    Unit tests for open_backend.
+    """
+
+    def test_session_backend(self):
+        """Test that the session backend is the session storage."""
+        session = MagicMock()
+        self.assertIs(open_backend(session, "session"), session.storage)
+
+    def test_sqlite_backend_is_opened_once(self):
+        """Test that a database is opened once per path."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "usage.sqlite3")
+            backend = open_backend(MagicMock(), "sqlite", path)
+            self.assertIsInstance(backend, SQLiteStorage)
+            self.assertIs(open_backend(MagicMock(), "sqlite", path), backend)
+            backend.close()
+
+    def test_redis_backend_requires_url(self):
+        """Test that the Redis backend raises a ValueError without a URL."""
+        with self.assertRaises(ValueError):
+            open_backend(MagicMock(), "redis")
+
+    def test_redis_url_is_a_provider_credential(self):
+        """Test that tools read the Redis URL from the provider credentials only."""
+        parameters = {"storage_backend": "redis", "redis_url": "redis://parameter:6379"}
+        with patch("tools.backends.open_backend") as opened:
+            backend_from_parameters(MagicMock(), parameters, {"redis_url": "redis://secret:6379"})
+            self.assertEqual(opened.call_args[0][2], "redis://secret:6379")
+            backend_from_parameters(MagicMock(), parameters, {})
+            self.assertIsNone(opened.call_args[0][2])
+            # The endpoints pass the URL of the endpoint group settings
+            backend_from_parameters(MagicMock(), parameters)
+            self.assertEqual(opened.call_args[0][2], "redis://parameter:6379")
+
+    def test_invalid_backend(self):
+        """Test that an unknown backend raises a ValueError."""
+        with self.assertRaises(ValueError):
+            open_backend(MagicMock(), "invalid")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Unit Tests for the usage record cache
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.cache import DenyCache, RecordCache
+
+
+class TestRecordCache(unittest.TestCase):
+    """
+    Unit tests for the RecordCache class.
+    """
+
+    def test_hit_and_miss_counters(self):
+        """Test that lookups count hits and misses."""
+        cache = RecordCache()
+        self.assertIsNone(cache.get("key", 1.0))
+        cache.put("key", b"record")
+        self.assertEqual(cache.get("key", 1.0), b"record")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_expired_entry_is_a_miss(self):
+        """Test that entries older than the requested max age are not returned."""
+        cache = RecordCache()
+        with patch('time.monotonic', return_value=100.0):
+            cache.put("key", b"record")
+        with patch('time.monotonic', return_value=100.5):
+            self.assertEqual(cache.get("key", 1.0), b"record")
+        with patch('time.monotonic', return_value=101.5):
+            self.assertIsNone(cache.get("key", 1.0))
+            self.assertEqual(cache.get("key", 5.0), b"record")
+
+    def test_least_recently_used_entry_is_evicted(self):
+        """Test that the cache evicts the least recently used entry when full."""
+        cache = RecordCache(max_entries=2)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.get("a", 1.0)
+        cache.put("c", b"3")
+        self.assertIsNone(cache.get("b", 1.0))
+        self.assertEqual(cache.get("a", 1.0), b"1")
+        self.assertEqual(cache.get("c", 1.0), b"3")
+
+    def test_invalidate_and_clear(self):
+        """Test that invalidated and cleared entries are gone."""
+        cache = RecordCache()
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a", 1.0))
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0})
+
+
+class TestDenyCache(unittest.TestCase):
+    """
+    Unit tests for the DenyCache class.
+    """
+
+    def test_denial_until_expiry(self):
+        """Test that a denial is returned until its expiry time."""
+        cache = DenyCache()
+        cache.put("key", "scope", 110.0, 5, 5)
+        self.assertEqual(cache.get("key", "scope", 100.0), (110.0, 5, 5))
+        self.assertIsNone(cache.get("key", "scope", 110.0))
+        self.assertIsNone(cache.get("key", "scope", 100.0))
+        self.assertEqual(cache.hits, 1)
+
+    def test_denial_is_scoped(self):
+        """Test that a denial only applies to the scope it was recorded for."""
+        cache = DenyCache()
+        cache.put("key", "scope", 110.0, 5, 5)
+        self.assertIsNone(cache.get("key", "other", 100.0))
+        cache.invalidate("key")
+        self.assertIsNone(cache.get("key", "scope", 100.0))
+
+    def test_bounded_size(self):
+        """Test that the least recently denied identifier is evicted."""
+        cache = DenyCache(max_entries=2)
+        cache.put("a", "scope", 110.0, 5, 5)
+        cache.put("b", "scope", 110.0, 5, 5)
+        cache.put("c", "scope", 110.0, 5, 5)
+        self.assertIsNone(cache.get("a", "scope", 100.0))
+        self.assertIsNotNone(cache.get("c", "scope", 100.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+"""
+Unit Tests for the clocks of the tools
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.clock import SYSTEM_CLOCK, VirtualClock
+
+
+class TestClock(unittest.TestCase):
+    """
+    Unit tests for the SystemClock and VirtualClock classes.
+    """
+
+    def test_system_clock_reads_time(self):
+        """Test that the system clock reads `time.time` on every call."""
+        with patch('time.time', return_value=1000000):
+            self.assertEqual(SYSTEM_CLOCK.time(), 1000000)
+
+    def test_virtual_clock(self):
+        """Test that the virtual clock only moves when told to."""
+        clock = VirtualClock(1000000)
+        self.assertEqual(clock.time(), 1000000)
+        clock.advance(60)
+        self.assertEqual(clock.time(), 1000060)
+        clock.set(1003600)
+        self.assertEqual(clock.time(), 1003600)
+        for move in (lambda: clock.advance(-1), lambda: clock.set(1000000)):
+            with self.assertRaises(ValueError):
+                move()
+        self.assertEqual(clock.time(), 1003600)
+
+
+if __name__ == '__main__':
+    unittest.main()
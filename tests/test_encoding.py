@@ -0,0 +1,296 @@
+"""
+Unit Tests for the usage record encodings
+"""
+import unittest
+
+from tools.encoding import (
+    BUCKETS_V2,
+    TIERS_V2,
+    TIMESTAMPS_MS_V1,
+    TIMESTAMPS_V1,
+    WEIGHTED_TIMESTAMPS_V1,
+    WEIGHTED_TIMESTAMPS_V2,
+    append_timestamp,
+    decode_arrival_time,
+    decode_buckets,
+    decode_counter,
+    decode_expiry_index,
+    decode_tiers,
+    decode_timestamps,
+    decode_weighted_timestamps,
+    encode_arrival_time,
+    encode_buckets,
+    encode_counter,
+    encode_expiry_index,
+    encode_tiers,
+    encode_timestamps,
+    encode_weighted_timestamps,
+    timestamp_offsets,
+)
+
+
+class TestTimestampEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_timestamps and decode_timestamps.
+    """
+
+    def test_round_trip(self):
+        """Test that encoded timestamps decode to the same list."""
+        timestamps = [1000000, 1000000, 1000001, 1003600, 1031536000]
+        record = encode_timestamps(timestamps)
+        self.assertEqual(record[0], TIMESTAMPS_V1)
+        self.assertEqual(decode_timestamps(record), timestamps)
+
+    def test_record_size(self):
+        """Test that each timestamp costs four bytes after the header."""
+        self.assertEqual(len(encode_timestamps([])), 9)
+        self.assertEqual(len(encode_timestamps(list(range(1000)))), 9 + 4000)
+
+    def test_empty_record(self):
+        """Test that empty records decode to an empty list."""
+        self.assertEqual(decode_timestamps(b""), [])
+        self.assertEqual(decode_timestamps(encode_timestamps([])), [])
+
+    def test_legacy_csv_record(self):
+        """Test that legacy comma separated records are still readable."""
+        self.assertEqual(decode_timestamps(b"999000,999500,999900"),
+                         [999000, 999500, 999900])
+
+    def test_unsupported_version(self):
+        """Test that unknown record versions raise a ValueError."""
+        with self.assertRaises(ValueError):
+            decode_timestamps(b"\x7f" + bytes(8))
+
+
+class TestTimestampAppend(unittest.TestCase):
+    """
+    Unit tests for timestamp_offsets and append_timestamp.
+    """
+
+    def test_offsets(self):
+        """Test that the offsets of binary and legacy records add up to their timestamps."""
+        for record in (encode_timestamps([999000, 999500, 999900]), b"999000,999500,999900"):
+            with self.subTest(record=record):
+                base, offsets = timestamp_offsets(record)
+                self.assertEqual([base + offset for offset in offsets],
+                                 [999000, 999500, 999900])
+        self.assertEqual(list(timestamp_offsets(b"")[1]), [])
+
+    def test_append_without_expiry(self):
+        """Test that a timestamp is appended without encoding the record again."""
+        record = encode_timestamps([999000, 999500])
+        appended = append_timestamp(record, 0, 1000000)
+        self.assertEqual(appended[:len(record)], record)
+        self.assertEqual(decode_timestamps(appended), [999000, 999500, 1000000])
+
+    def test_append_drops_oldest(self):
+        """Test that the oldest timestamps are sliced off."""
+        for record in (encode_timestamps([996000, 999000, 999500]), b"996000,999000,999500"):
+            with self.subTest(record=record):
+                self.assertEqual(decode_timestamps(append_timestamp(record, 1, 1000000)),
+                                 [999000, 999500, 1000000])
+                self.assertEqual(decode_timestamps(append_timestamp(record, 3, 1000000)),
+                                 [1000000])
+
+
+class TestMillisecondTimestampEncoding(unittest.TestCase):
+    """
+    Unit tests for timestamp records in milliseconds.
+    """
+
+    def test_round_trip(self):
+        """Test that millisecond timestamps decode to the same list."""
+        timestamps = [1000000000, 1000000250, 1000000999, 1003600000]
+        record = encode_timestamps(timestamps, milliseconds=True)
+        self.assertEqual(record[0], TIMESTAMPS_MS_V1)
+        self.assertEqual(decode_timestamps(record, milliseconds=True), timestamps)
+
+    def test_resolution_conversion(self):
+        """Test that records are converted when read at the other resolution."""
+        record = encode_timestamps([1000000250, 1000001999], milliseconds=True)
+        self.assertEqual(decode_timestamps(record), [1000000, 1000001])
+        for seconds in (encode_timestamps([1000000, 1000001]), b"1000000,1000001"):
+            with self.subTest(record=seconds):
+                self.assertEqual(decode_timestamps(seconds, milliseconds=True),
+                                 [1000000000, 1000001000])
+                base, offsets = timestamp_offsets(seconds, milliseconds=True)
+                self.assertEqual([base + offset for offset in offsets], [1000000000, 1000001000])
+
+    def test_append(self):
+        """Test that millisecond timestamps are appended in place and converted otherwise."""
+        record = encode_timestamps([1000000000, 1000000250], milliseconds=True)
+        appended = append_timestamp(record, 1, 1000000500, milliseconds=True)
+        self.assertEqual(decode_timestamps(appended, milliseconds=True), [1000000250, 1000000500])
+        converted = append_timestamp(encode_timestamps([1000000]), 0, 1000000500,
+                                     milliseconds=True)
+        self.assertEqual(converted[0], TIMESTAMPS_MS_V1)
+        self.assertEqual(decode_timestamps(converted, milliseconds=True),
+                         [1000000000, 1000000500])
+
+
+class TestWeightedTimestampEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_weighted_timestamps and decode_weighted_timestamps.
+    """
+
+    def test_round_trip(self):
+        """Test that encoded usages decode to the same timestamps and weights."""
+        usages = [(1000000, 1), (1000001, 250), (1003600, 4000000000)]
+        record = encode_weighted_timestamps(usages)
+        self.assertEqual(record[0], WEIGHTED_TIMESTAMPS_V1)
+        self.assertEqual(decode_weighted_timestamps(record), usages)
+
+    def test_wide_weights(self):
+        """Test that weights beyond 32 bits are stored in the 64-bit layout."""
+        usages = [(1000000, 1), (1000001, 3 * 10**9), (1003600, 2**40)]
+        record = encode_weighted_timestamps(usages)
+        self.assertEqual(record[0], WEIGHTED_TIMESTAMPS_V2)
+        self.assertEqual(len(record), 9 + 3 * 16)
+        self.assertEqual(decode_weighted_timestamps(record), usages)
+
+    def test_record_size(self):
+        """Test that each usage costs eight bytes after the header."""
+        self.assertEqual(len(encode_weighted_timestamps([])), 9)
+        self.assertEqual(len(encode_weighted_timestamps([(t, 2) for t in range(100)])), 9 + 800)
+
+    def test_unweighted_record(self):
+        """Test that unweighted timestamp records decode with a weight of one."""
+        self.assertEqual(decode_weighted_timestamps(encode_timestamps([999000, 999500])),
+                         [(999000, 1), (999500, 1)])
+        self.assertEqual(decode_weighted_timestamps(b""), [])
+
+    def test_counter_record_rejected(self):
+        """Test that a counter record is not decoded as a weighted usage record."""
+        with self.assertRaises(ValueError):
+            decode_weighted_timestamps(encode_counter(0, 1, 2))
+
+
+class TestCounterEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_counter and decode_counter.
+    """
+
+    def test_round_trip(self):
+        """Test that an encoded counter decodes to the same values."""
+        record = encode_counter(997200, 12, 100000)
+        self.assertEqual(decode_counter(record), (997200, 12, 100000))
+
+    def test_constant_size(self):
+        """Test that the record size does not depend on the counts."""
+        self.assertEqual(len(encode_counter(0, 0, 0)),
+                         len(encode_counter(997200, 10**9, 10**9)))
+
+    def test_empty_record(self):
+        """Test that an empty record decodes to zero counts."""
+        self.assertEqual(decode_counter(b""), (0, 0, 0))
+
+    def test_timestamp_record_rejected(self):
+        """Test that a timestamp record is not decoded as a counter."""
+        with self.assertRaises(ValueError):
+            decode_counter(encode_timestamps([1, 2, 3]))
+
+
+class TestBucketEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_buckets and decode_buckets.
+    """
+
+    def test_round_trip(self):
+        """Test that an encoded ring decodes to the same values."""
+        counts = [0, 3, 0, 70000]
+        record = encode_buckets(86400, 19675, counts)
+        self.assertEqual(decode_buckets(record), (86400, 19675, counts))
+
+    def test_wide_counts(self):
+        """Test that counts beyond 32 bits are stored in the 64-bit layout."""
+        counts = [0, 3 * 10**9, 2**40]
+        record = encode_buckets(3600, 7, counts)
+        self.assertEqual(record[0], BUCKETS_V2)
+        self.assertEqual(decode_buckets(record), (3600, 7, counts))
+
+    def test_record_size(self):
+        """Test that the record size depends only on the bucket count."""
+        self.assertEqual(len(encode_buckets(3600, 0, [0] * 24)),
+                         len(encode_buckets(3600, 0, [10**6] * 24)))
+
+    def test_counter_record_rejected(self):
+        """Test that a counter record is not decoded as a bucket ring."""
+        with self.assertRaises(ValueError):
+            decode_buckets(encode_counter(0, 1, 2))
+
+
+class TestArrivalTimeEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_arrival_time and decode_arrival_time.
+    """
+
+    def test_round_trip(self):
+        """Test that an encoded arrival time decodes to the same value."""
+        self.assertEqual(
+            decode_arrival_time(encode_arrival_time(1700000000_123456)), 1700000000_123456)
+
+    def test_empty_record(self):
+        """Test that an empty record decodes to zero."""
+        self.assertEqual(decode_arrival_time(b""), 0)
+
+    def test_bucket_record_rejected(self):
+        """Test that a bucket record is not decoded as an arrival time."""
+        with self.assertRaises(ValueError):
+            decode_arrival_time(encode_buckets(60, 0, [1]))
+
+
+class TestTierEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_tiers and decode_tiers.
+    """
+
+    def test_round_trip(self):
+        """Test that encoded counters decode to the same windows."""
+        counters = {60: (999960, 3, 20), 86400: (950400, 0, 499), 2592000: (0, 4000, 1)}
+        self.assertEqual(decode_tiers(encode_tiers(counters)), counters)
+
+    def test_wide_counts(self):
+        """Test that counts beyond 32 bits are stored in the 64-bit layout."""
+        counters = {60: (999960, 3 * 10**9, 1), 86400: (950400, 0, 2**40)}
+        record = encode_tiers(counters)
+        self.assertEqual(record[0], TIERS_V2)
+        self.assertEqual(len(record), 1 + 2 * 28)
+        self.assertEqual(decode_tiers(record), counters)
+
+    def test_record_size(self):
+        """Test that every window adds a constant 20 bytes."""
+        self.assertEqual(len(encode_tiers({60: (0, 0, 0), 3600: (0, 0, 0)})), 41)
+
+    def test_empty_record(self):
+        """Test that an empty record decodes to no windows."""
+        self.assertEqual(decode_tiers(b""), {})
+
+    def test_counter_record_rejected(self):
+        """Test that a counter record is not decoded as a tier record."""
+        with self.assertRaises(ValueError):
+            decode_tiers(encode_counter(0, 1, 2))
+
+
+class TestExpiryIndexEncoding(unittest.TestCase):
+    """
+    Unit tests for encode_expiry_index and decode_expiry_index.
+    """
+
+    def test_round_trip(self):
+        """Test that encoded expiry times decode to the same entries."""
+        entries = {"app123": 1700003600, "app123-conversation-会话": 1700000061, "": -1}
+        self.assertEqual(decode_expiry_index(encode_expiry_index(entries)), entries)
+
+    def test_empty_record(self):
+        """Test that an empty record and an empty index decode to no entries."""
+        self.assertEqual(decode_expiry_index(b""), {})
+        self.assertEqual(decode_expiry_index(encode_expiry_index({})), {})
+
+    def test_counter_record_rejected(self):
+        """Test that a counter record is not decoded as an expiry index."""
+        with self.assertRaises(ValueError):
+            decode_expiry_index(encode_counter(0, 1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+Unit Tests for the batch usage endpoints
+"""
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from werkzeug.test import EnvironBuilder
+
+from endpoints.metrics import MetricsEndpoint
+from endpoints.query_usage import QueryUsageEndpoint
+from endpoints.reset_usage import ResetUsageEndpoint
+from tools.backends import InMemoryStorage, backend_from_parameters
+from tools.metrics import METRICS
+from tools.usage_limit import UsageLimitTool
+
+SETTINGS = {"api_key": "secret"}
+
+
+def request(body, api_key="secret", accept="application/json"):
+    """Build a POST request with a JSON body."""
+    return EnvironBuilder(method="POST", json=body, headers={
+        "X-Api-Key": api_key, "Accept": accept}).get_request()
+
+
+class TestBatchEndpoints(unittest.TestCase):
+    """
+    Unit tests for the QueryUsageEndpoint and ResetUsageEndpoint classes.
+    """
+
+    def setUp(self):
+        self.session = MagicMock()
+        self.session.app_id = "app123"
+        self.session.storage = InMemoryStorage()
+        self.patcher = patch('time.time', return_value=1000000)
+        self.patcher.start()
+        for user, usages in (("user1", 3), ("user2", 1)):
+            for _ in range(usages):
+                tool = UsageLimitTool(runtime=MagicMock(), session=self.session)
+                tool.create_json_message = MagicMock()
+                list(tool._invoke({  # pylint: disable=protected-access
+                    'user_id': user, 'tracking_method': 'app-user', 'limit': '5'}))
+        self.session.storage.calls.clear()
+        self.batch = {
+            "defaults": {"tracking_method": "app-user", "app_id": "app123", "limit": 5},
+            "items": [{"user_id": "user1"}, {"user_id": "user2"}, {"user_id": "user3"}],
+        }
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_query_reads_without_counting(self):
+        """Test that queried usages are reported in order and storage is only read."""
+        response = QueryUsageEndpoint(self.session).invoke(request(self.batch), {}, SETTINGS)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data())["results"]
+        self.assertEqual([result["current_usage"] for result in results], [3, 1, 0])
+        self.assertEqual(results[0], {
+            "user_id": "user1",
+            "identifier": "app123user1",
+            "limit": 5,
+            "current_usage": 3,
+            "remaining_usage": 2,
+            "reset_seconds": 3600,
+            "allowed": True,
+        })
+        self.assertEqual(set(self.session.storage.calls), {"get"})
+
+    def test_query_streams_ndjson(self):
+        """Test that requests accepting NDJSON receive one result per line."""
+        response = QueryUsageEndpoint(self.session).invoke(
+            request(self.batch, accept="application/x-ndjson"), {}, SETTINGS)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data().decode().splitlines()
+        self.assertEqual([json.loads(line)["user_id"] for line in lines],
+                         ["user1", "user2", "user3"])
+
+    def test_item_errors_are_reported(self):
+        """Test that an invalid item reports its error without failing the batch."""
+        self.batch["items"].append({"user_id": "user4", "limit_strategy": "invalid"})
+        response = QueryUsageEndpoint(self.session).invoke(request(self.batch), {}, SETTINGS)
+        results = json.loads(response.get_data())["results"]
+        self.assertEqual(results[3], {"user_id": "user4", "error": "Invalid window strategy"})
+
+    def test_items_missing_ids(self):
+        """Test that items lacking the ID of their tracking method report an error."""
+        self.batch["defaults"].pop("app_id")
+        self.batch["items"] = [
+            {"user_id": "user1", "app_id": "app123"},
+            {"user_id": "user2"},
+            {"user_id": "user3", "app_id": "app123", "tracking_method": "workspace-user",
+             "rules": '[{"tracking_method": "conversation", "limit": 10}]'},
+        ]
+        response = QueryUsageEndpoint(self.session).invoke(request(self.batch), {}, SETTINGS)
+        results = json.loads(response.get_data())["results"]
+        self.assertEqual(results[0]["current_usage"], 3)
+        self.assertEqual(results[1], {"user_id": "user2", "error": "Missing app_id"})
+        self.assertEqual(results[2], {"user_id": "user3", "error": "Missing conversation_id"})
+
+    def test_items_cannot_select_storage(self):
+        """Test that the storage settings of items are ignored."""
+        self.batch["defaults"]["storage_backend"] = "sqlite"
+        self.batch["items"] = [{"user_id": "user1", "storage_backend": "redis",
+                                "redis_url": "redis://attacker:6379", "storage_path": "/tmp/x"}]
+        with patch('tools.usage_limit.backend_from_parameters',
+                   wraps=backend_from_parameters) as backend:
+            response = QueryUsageEndpoint(self.session).invoke(request(self.batch), {}, SETTINGS)
+        results = json.loads(response.get_data())["results"]
+        self.assertEqual(results[0]["current_usage"], 3)
+        parameters = backend.call_args[0][1]
+        self.assertFalse(set(parameters) & {"storage_backend", "redis_url", "storage_path"})
+
+    def test_reset_deletes_records(self):
+        """Test that reset items delete the records the Reset Usage tool deletes."""
+        self.batch["items"] = self.batch["items"][:2]
+        response = ResetUsageEndpoint(self.session).invoke(request(self.batch), {}, SETTINGS)
+        results = json.loads(response.get_data())["results"]
+        self.assertEqual([result["identifier"] for result in results],
+                         ["app123user1", "app123user2"])
+        self.assertFalse(self.session.storage.exist("app123user1"))
+        self.assertFalse(self.session.storage.exist("app123user2"))
+
+    def test_unauthorized(self):
+        """Test that requests without the API key are rejected."""
+        for endpoint in (QueryUsageEndpoint, ResetUsageEndpoint):
+            with self.subTest(endpoint=endpoint.__name__):
+                response = endpoint(self.session).invoke(
+                    request(self.batch, api_key="wrong"), {}, SETTINGS)
+                self.assertEqual(response.status_code, 401)
+        self.assertTrue(self.session.storage.exist("app123user1"))
+
+    def test_metrics(self):
+        """Test that the collected metrics are exported in the Prometheus text format."""
+        METRICS.clear()
+        METRICS.increment("usage_limit_denials_total", {"reason": "limit"})
+        response = MetricsEndpoint(self.session).invoke(
+            EnvironBuilder(method="GET", headers={"X-Api-Key": "secret"}).get_request(),
+            {}, SETTINGS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertIn('usage_limit_denials_total{reason="limit"} 1\n',
+                      response.get_data().decode())
+        response = MetricsEndpoint(self.session).invoke(
+            EnvironBuilder(method="GET").get_request(), {}, SETTINGS)
+        self.assertEqual(response.status_code, 401)
+        METRICS.clear()
+
+    def test_invalid_batch(self):
+        """Test that malformed and oversized batches are rejected."""
+        for body in ({"items": [{"limit": 5}]}, {"items": "user1"}, [],
+                     {"items": [{"user_id": "user"}] * 10_001}):
+            with self.subTest(body=str(body)[:40]):
+                response = QueryUsageEndpoint(self.session).invoke(request(body), {}, SETTINGS)
+                self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
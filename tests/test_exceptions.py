@@ -15,6 +15,16 @@ class TestUsageLimitExceededException(unittest.TestCase):
         self.assertEqual(exception.identifier, identifier)
         self.assertEqual(exception.limit, limit)
         self.assertEqual(exception.current_usage, current_usage)
+        self.assertIsNone(exception.retry_after)
+
+    def test_exception_message_with_retry_after(self):
+        exception = UsageLimitExceededException('test_user', 5, 5, 0.5)
+        self.assertEqual(
+            str(exception),
+            'Usage limit exceeded for test_user: 5 messages sent, limit is 5, '
+            'retry after 0.5 seconds'
+        )
+        self.assertEqual(exception.retry_after, 0.5)
 
 class TestFailedToDeleteStorageItemException(unittest.TestCase):
     def test_exception_message_and_attributes(self):
@@ -0,0 +1,88 @@
+"""
+Unit Tests for the expiry index and sweeper of usage records
+"""
+import unittest
+
+from tools.backends import InMemoryStorage
+from tools.encoding import decode_expiry_index, encode_versioned
+from tools.expiry import INDEX_KEY_PREFIX, SWEEP_INTERVAL, ExpiryTracker, index_key
+from tools.storage import VersionedStorage
+
+
+class TestExpiryTracker(unittest.TestCase):
+    """
+    Unit tests for the ExpiryTracker class.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.tracker = ExpiryTracker()
+
+    def _index(self, key: str) -> dict[str, int]:
+        return decode_expiry_index(VersionedStorage(self.backend).get(index_key(key)))
+
+    def test_touch_extends_by_lifetime(self):
+        """Test that an indexed record is kept for a whole lifetime beyond its expiry."""
+        self.tracker.touch(self.backend, "app123", 1100, 100)
+        self.assertEqual(self._index("app123"), {"app123": 1200})
+
+    def test_touch_skips_indexed_records(self):
+        """Test that the index is only written once the remembered expiry is exceeded."""
+        self.tracker.touch(self.backend, "app123", 1100, 100)
+        self.backend.calls.clear()
+        self.tracker.touch(self.backend, "app123", 1200, 100)
+        self.assertEqual(sum(self.backend.calls.values()), 0)
+        self.tracker.touch(self.backend, "app123", 1201, 100)
+        self.assertEqual(self._index("app123"), {"app123": 1301})
+
+    def test_touch_keeps_later_expiry_of_other_process(self):
+        """Test that an expiry indexed by another process is never shortened."""
+        ExpiryTracker().touch(self.backend, "app123", 2000, 100)
+        self.tracker.touch(self.backend, "app123", 1100, 100)
+        self.assertEqual(self._index("app123"), {"app123": 2100})
+
+    def test_sweep_deletes_expired_records(self):
+        """Test that a sweep deletes expired records only and reports their size."""
+        keys = [f"app123-user{i}" for i in range(200)]
+        shard = index_key(keys[0])
+        keys = [key for key in keys if index_key(key) == shard][:3]
+        for key, expires_at in zip(keys, (1000, 1001, 5000)):
+            self.backend.set(key, encode_versioned(1, b"1:100"))
+            self.tracker.touch(self.backend, key, expires_at, 0)
+
+        deleted, reclaimed = self.tracker.sweep(
+            self.backend, int(shard[len(INDEX_KEY_PREFIX):]), 2000)
+        self.assertEqual((deleted, reclaimed), (2, 2 * len(encode_versioned(1, b"1:100"))))
+        self.assertEqual([self.backend.exist(key) for key in keys], [False, False, True])
+        self.assertEqual(self._index(keys[0]), {keys[2]: 5000})
+
+    def test_sweep_is_bounded(self):
+        """Test that a sweep deletes at most the given number of records."""
+        keys = [f"app123-user{i}" for i in range(200)]
+        shard = index_key(keys[0])
+        keys = [key for key in keys if index_key(key) == shard][:5]
+        for key in keys:
+            self.backend.set(key, b"")
+            self.tracker.touch(self.backend, key, 1000, 0)
+        shard = int(shard[len(INDEX_KEY_PREFIX):])
+        self.assertEqual(self.tracker.sweep(self.backend, shard, 2000, 3)[0], 3)
+        self.assertEqual(self.tracker.sweep(self.backend, shard, 2000, 3)[0], 2)
+        self.assertEqual(self.tracker.sweep(self.backend, shard, 2000, 3), (0, 0))
+
+    def test_sweep_ignores_deleted_records(self):
+        """Test that records deleted by someone else are dropped from the index."""
+        self.tracker.touch(self.backend, "app123", 1000, 0)
+        shard = int(index_key("app123")[len(INDEX_KEY_PREFIX):])
+        self.assertEqual(self.tracker.sweep(self.backend, shard, 2000), (0, 0))
+        self.assertEqual(self._index("app123"), {})
+
+    def test_maybe_sweep_counts_reclaimed_records(self):
+        """Test that a sweep runs every SWEEP_INTERVAL calls and its results are counted."""
+        results = [self.tracker.maybe_sweep(self.backend, 2000) for _ in range(SWEEP_INTERVAL)]
+        self.assertEqual(results.count(None), SWEEP_INTERVAL - 1)
+        self.assertEqual(self.tracker.stats(),
+                         {"sweeps": 1, "expired_records": 0, "reclaimed_bytes": 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Unit Tests for the index of usage records per tracking method and app
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.backends import InMemoryStorage
+from tools.encoding import decode_expiry_index
+from tools.identifiers import IdentifierIndex, identifier_index_key, identifier_shard
+from tools.storage import VersionedStorage
+
+
+class TestIdentifierIndex(unittest.TestCase):
+    """
+    Unit tests for the IdentifierIndex class.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.index = IdentifierIndex()
+        for user in range(5):
+            key = f"app123user{user}"
+            self.backend.set(key, b"1:1000000")
+            self.index.touch(self.backend, "app-user", "app123", key, 1000000 + user * 1000)
+
+    def _indexed(self, key):
+        index_key = identifier_index_key("app-user", "app123", identifier_shard(key))
+        try:
+            return decode_expiry_index(VersionedStorage(self.backend).get(index_key)).get(key)
+        except ValueError:
+            return None
+
+    def test_touch_only_rewrites_stale_entries(self):
+        """Test that the last use is only written once it is out of date."""
+        self.backend.calls.clear()
+        self.index.touch(self.backend, "app-user", "app123", "app123user0", 1000300)
+        self.assertEqual(sum(self.backend.calls.values()), 0)
+        self.assertEqual(self._indexed("app123user0"), 1000000)
+
+        # Another process that did not write the entry reads it before skipping it
+        IdentifierIndex().touch(self.backend, "app-user", "app123", "app123user0", 1000300)
+        self.assertEqual(self._indexed("app123user0"), 1000000)
+
+        self.index.touch(self.backend, "app-user", "app123", "app123user0", 1000600)
+        self.assertEqual(self._indexed("app123user0"), 1000600)
+
+    def test_reset_all(self):
+        """Test that every indexed record of the tracking method and app is deleted."""
+        self.index.touch(self.backend, "app-user", "app456", "app456user0", 1000000)
+        self.backend.set("app456user0", b"1:1000000")
+        self.assertEqual(self.index.reset(self.backend, "app-user", "app123", 1010000),
+                         (5, 0, 0))
+        for user in range(5):
+            self.assertFalse(self.backend.exist(f"app123user{user}"))
+            self.assertIsNone(self._indexed(f"app123user{user}"))
+        self.assertTrue(self.backend.exist("app456user0"))
+
+    def test_reset_older_than(self):
+        """Test that only records unused for the given time are deleted."""
+        deleted, _, remaining = self.index.reset(
+            self.backend, "app-user", "app123", 1005000, older_than_seconds=3000)
+        self.assertEqual((deleted, remaining), (3, 0))
+        self.assertFalse(self.backend.exist("app123user2"))
+        self.assertTrue(self.backend.exist("app123user3"))
+
+    def test_reset_in_batches(self):
+        """Test that a reset stops after a batch and reports the remaining records."""
+        # Every index entry is its key, a 64-bit last use and a 16-bit key length
+        entry_bytes = len("app123user0") + 10
+        self.assertEqual(self.index.reset(
+            self.backend, "app-user", "app123", 1010000, max_deletions=2, measure=True),
+            (2, 2 * (len(b"1:1000000") + entry_bytes), 3))
+        self.assertEqual(self.index.reset(self.backend, "app-user", "app123", 1010000,
+                                          max_deletions=2), (2, 0, 1))
+        self.assertEqual(self.index.reset(self.backend, "app-user", "app123", 1010000),
+                         (1, 0, 0))
+
+    @patch('tools.identifiers.RESET_DEADLINE_SECONDS', 0.0)
+    def test_reset_deadline(self):
+        """Test that nothing more is deleted once the deadline passed."""
+        self.assertEqual(self.index.reset(self.backend, "app-user", "app123", 1010000),
+                         (0, 0, 5))
+        self.assertTrue(self.backend.exist("app123user0"))
+
+    def test_reset_deleted_record(self):
+        """Test that records that no longer exist are dropped from the index."""
+        self.backend.delete("app123user0")
+        self.assertEqual(self.index.reset(self.backend, "app-user", "app123", 1010000),
+                         (4, 0, 0))
+        self.assertIsNone(self._indexed("app123user0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Unit Tests for the storage key derivation
+"""
+import unittest
+from unittest.mock import MagicMock
+
+from tools.keys import identifier_parts, storage_key
+
+
+class TestIdentifierParts(unittest.TestCase):
+    """
+    Unit tests for identifier_parts.
+    """
+
+    def setUp(self):
+        self.session = MagicMock()
+        self.session.app_id = "app123"
+        self.session.conversation_id = "conv456"
+
+    def test_tracking_methods(self):
+        """Test that every tracking method returns the IDs of its identifier."""
+        self.assertEqual(identifier_parts(self.session, "user789", "workspace-user"), ["user789"])
+        self.assertEqual(identifier_parts(self.session, "user789", "app-user"),
+                         ["app123", "user789"])
+        self.assertEqual(identifier_parts(self.session, "user789", "app"), ["app123"])
+        self.assertEqual(identifier_parts(self.session, "user789", "conversation"), ["conv456"])
+
+    def test_invalid_tracking_method(self):
+        """Test that an unknown tracking method raises a ValueError."""
+        with self.assertRaises(ValueError):
+            identifier_parts(self.session, "user789", "invalid")
+
+
+class TestStorageKey(unittest.TestCase):
+    """
+    Unit tests for storage_key.
+    """
+
+    def test_plain_key_is_identifier(self):
+        """Test that plain keys are the keys written by earlier versions."""
+        self.assertEqual(
+            storage_key(["app123", "user789"], "app-user", "fixed", 3600), "app123user789")
+
+    def test_namespaced_key(self):
+        """Test that namespaced keys carry the strategy, window and tracking method."""
+        self.assertEqual(
+            storage_key(["app123", "user789"], "app-user", "fixed", 3600, "namespaced"),
+            "ul:fixed:3600:app-user:app123:user789")
+
+    def test_namespaces_are_separate(self):
+        """Test that different strategies and windows derive different keys."""
+        keys = {
+            storage_key(["app123"], "app", strategy, duration_seconds, key_format)
+            for strategy in ("fixed", "sliding")
+            for duration_seconds in (3600, 86400)
+            for key_format in ("namespaced", "hashed")
+        }
+        self.assertEqual(len(keys), 8)
+
+    def test_separators_are_encoded(self):
+        """Test that separators inside IDs cannot make two identifiers share a key."""
+        first = storage_key(["app:1", "user"], "app-user", "fixed", 60, "namespaced")
+        second = storage_key(["app", "1:user"], "app-user", "fixed", 60, "namespaced")
+        self.assertNotEqual(first, second)
+        self.assertEqual(first, "ul:fixed:60:app-user:app%3A1:user")
+        self.assertNotIn("#", storage_key(["user#1"], "workspace-user", "fixed", 60, "namespaced"))
+
+    def test_hashed_key_has_fixed_length(self):
+        """Test that hashed keys have the same length for short and long IDs."""
+        short = storage_key(["u"], "workspace-user", "sliding", 3600, "hashed")
+        long = storage_key(["u" * 1000], "workspace-user", "sliding", 3600, "hashed")
+        self.assertEqual(len(short), len(long))
+        self.assertRegex(short, r"^ul:[0-9a-f]{32}$")
+
+    def test_invalid_key_format(self):
+        """Test that an unknown key format raises a ValueError."""
+        with self.assertRaises(ValueError):
+            storage_key(["app123"], "app", "fixed", 3600, "invalid")
+
+
+if __name__ == '__main__':
+    unittest.main()
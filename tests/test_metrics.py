@@ -0,0 +1,76 @@
+"""
+Unit Tests for the metrics of the Usage Limit tool
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.metrics import LATENCY_BUCKETS, SIZE_BUCKETS, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Unit tests for the Metrics class.
+    """
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_render_counters(self):
+        """Test that counters are rendered with their type, help text and labels."""
+        self.metrics.increment("usage_limit_denials_total",
+                               {"tracking_method": "app-user", "reason": "limit"})
+        self.metrics.increment("usage_limit_denials_total",
+                               {"reason": "limit", "tracking_method": "app-user"}, 2)
+        rendered = self.metrics.render()
+        self.assertIn("# TYPE usage_limit_denials_total counter\n", rendered)
+        self.assertIn(
+            'usage_limit_denials_total{reason="limit",tracking_method="app-user"} 3\n', rendered)
+
+    def test_render_histograms(self):
+        """Test that histograms are rendered with cumulative buckets, sum and count."""
+        for size in (10, 100, 2_000_000):
+            self.metrics.observe("usage_limit_record_bytes", size, SIZE_BUCKETS,
+                                 {"operation": "set"})
+        rendered = self.metrics.render()
+        self.assertIn('usage_limit_record_bytes_bucket{operation="set",le="64"} 1\n', rendered)
+        self.assertIn('usage_limit_record_bytes_bucket{operation="set",le="256"} 2\n', rendered)
+        self.assertIn('usage_limit_record_bytes_bucket{operation="set",le="+Inf"} 3\n', rendered)
+        self.assertIn('usage_limit_record_bytes_sum{operation="set"} 2000110\n', rendered)
+        self.assertIn('usage_limit_record_bytes_count{operation="set"} 3\n', rendered)
+
+    def test_label_values_are_escaped(self):
+        """Test that quotes and backslashes in label values are escaped."""
+        self.metrics.increment("usage_limit_denials_total", {"reason": 'a"b\\c'})
+        self.assertIn('usage_limit_denials_total{reason="a\\"b\\\\c"} 1\n', self.metrics.render())
+
+    def test_timed(self):
+        """Test that storage operations are timed, including those that raise."""
+        self.assertEqual(self.metrics.timed("get", lambda key: key * 2, "a"), "aa")
+        with self.assertRaises(KeyError):
+            self.metrics.timed("get", {}.__getitem__, "a")
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(
+            snapshot["histograms"]['usage_limit_storage_seconds{operation="get"}']["count"], 2)
+        self.assertLess(
+            snapshot["histograms"]['usage_limit_storage_seconds{operation="get"}']["sum"],
+            LATENCY_BUCKETS[-1])
+
+    def test_maybe_log(self):
+        """Test that a snapshot is logged at most once per interval."""
+        self.metrics.increment("usage_limit_decisions_total")
+        with patch('tools.metrics.logger') as logger:
+            self.assertTrue(self.metrics.maybe_log(1000000))
+            self.assertFalse(self.metrics.maybe_log(1000059))
+            self.assertTrue(self.metrics.maybe_log(1000060))
+        self.assertEqual(logger.info.call_count, 2)
+        self.assertIn('"usage_limit_decisions_total": 1', logger.info.call_args[0][1])
+
+    def test_clear(self):
+        """Test that cleared metrics render without series."""
+        self.metrics.increment("usage_limit_decisions_total")
+        self.metrics.clear()
+        self.assertNotIn("usage_limit_decisions_total 1", self.metrics.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
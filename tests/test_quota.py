@@ -0,0 +1,60 @@
+"""
+Unit Tests for the plugin storage quota accounting
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.backends import InMemoryStorage
+from tools.quota import QUOTA_FLUSH_BYTES, QUOTA_KEY, StorageQuota
+
+
+class TestStorageQuota(unittest.TestCase):
+    """
+    Unit tests for the StorageQuota class.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.quota = StorageQuota(capacity=10 * QUOTA_FLUSH_BYTES)
+
+    def test_small_changes_stay_local(self):
+        """Test that changes below the flush size are counted without writing storage."""
+        self.quota.record(self.backend, 100)
+        self.quota.record(self.backend, -30)
+        self.assertEqual(self.quota.used_bytes(self.backend), 70)
+        self.assertFalse(self.backend.exist(QUOTA_KEY))
+
+    def test_total_is_shared_between_processes(self):
+        """Test that flushed changes of two processes add up in the shared total."""
+        other = StorageQuota(capacity=self.quota.capacity)
+        self.quota.record(self.backend, QUOTA_FLUSH_BYTES)
+        other.record(self.backend, 2 * QUOTA_FLUSH_BYTES)
+        self.assertEqual(other.used_bytes(self.backend), 3 * QUOTA_FLUSH_BYTES)
+        with patch('tools.quota.QUOTA_REFRESH_SECONDS', 0):
+            self.assertEqual(self.quota.used_bytes(self.backend), 3 * QUOTA_FLUSH_BYTES)
+
+    def test_total_never_negative(self):
+        """Test that freeing more than was counted leaves a total of zero."""
+        self.quota.record(self.backend, -QUOTA_FLUSH_BYTES)
+        self.assertEqual(self.quota.used_bytes(self.backend), 0)
+        self.assertEqual(self.backend.get(QUOTA_KEY)[-1:], b"0")
+
+    def test_pressure_hysteresis(self):
+        """Test that pressure starts at 80% of the capacity and ends below 60%."""
+        self.quota.record(self.backend, 7 * QUOTA_FLUSH_BYTES)
+        self.assertFalse(self.quota.under_pressure(self.backend))
+        self.quota.record(self.backend, QUOTA_FLUSH_BYTES)
+        self.assertTrue(self.quota.under_pressure(self.backend))
+        self.quota.record(self.backend, -QUOTA_FLUSH_BYTES)
+        self.assertTrue(self.quota.under_pressure(self.backend))
+        self.quota.record(self.backend, -2 * QUOTA_FLUSH_BYTES)
+        self.assertFalse(self.quota.under_pressure(self.backend))
+        self.assertEqual(self.quota.stats(), {
+            "used_bytes": 5 * QUOTA_FLUSH_BYTES,
+            "capacity_bytes": 10 * QUOTA_FLUSH_BYTES,
+            "under_pressure": False,
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Unit Tests for the reservations committed against usage records
+"""
+import unittest
+
+from tools.backends import InMemoryStorage
+from tools.encoding import decode_expiry_index
+from tools.reservations import (
+    MAX_RESERVATION_SECONDS,
+    claim_reservation,
+    new_reservation_id,
+    reservation_expiry,
+    reservations_key,
+)
+from tools.storage import VersionedStorage
+
+
+class TestReservations(unittest.TestCase):
+    """
+    Unit tests for the reservation helpers.
+    """
+
+    def setUp(self):
+        self.storage = VersionedStorage(InMemoryStorage())
+
+    def test_reservation_id_carries_expiry(self):
+        """Test that the expiry of a reservation is read back from its ID."""
+        reservation_id = new_reservation_id(1000600)
+        self.assertEqual(reservation_expiry(reservation_id), 1000600)
+        self.assertNotEqual(reservation_id, new_reservation_id(1000600))
+
+    def test_invalid_reservation_id(self):
+        """Test that malformed reservation IDs raise a ValueError."""
+        for reservation_id in ("", "1000600", "1000600.", "soon.abc"):
+            with self.subTest(reservation_id=reservation_id):
+                with self.assertRaises(ValueError):
+                    reservation_expiry(reservation_id)
+
+    def test_reservation_is_claimed_once(self):
+        """Test that a reservation can only be claimed once per usage record."""
+        reservation_id = new_reservation_id(1000600)
+        self.assertTrue(claim_reservation(self.storage, "user789", reservation_id, 1000000))
+        self.assertFalse(claim_reservation(self.storage, "user789", reservation_id, 1000001))
+        self.assertTrue(claim_reservation(self.storage, "app123", reservation_id, 1000001))
+
+    def test_expired_reservation(self):
+        """Test that expired reservations raise a ValueError and are dropped from the record."""
+        expired_id = new_reservation_id(1000100)
+        claim_reservation(self.storage, "user789", expired_id, 1000000)
+        with self.assertRaises(ValueError) as context:
+            claim_reservation(self.storage, "user789", expired_id, 1000100)
+        self.assertEqual(str(context.exception), "Reservation expired")
+        reservation_id = new_reservation_id(1000700)
+        claim_reservation(self.storage, "user789", reservation_id, 1000100)
+        self.assertEqual(decode_expiry_index(self.storage.get(reservations_key("user789"))),
+                         {reservation_id: 1000700})
+
+    def test_reservation_expiry_is_capped(self):
+        """Test that expiries beyond the longest reservation lifetime are capped."""
+        reservation_id = new_reservation_id(10 ** 12)
+        self.assertEqual(claim_reservation(self.storage, "user789", reservation_id, 1000000),
+                         1000000 + MAX_RESERVATION_SECONDS)
+        self.assertEqual(decode_expiry_index(self.storage.get(reservations_key("user789"))),
+                         {reservation_id: 1000000 + MAX_RESERVATION_SECONDS})
+
+
+if __name__ == '__main__':
+    unittest.main()
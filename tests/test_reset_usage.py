@@ -2,10 +2,18 @@
 """
 Unit Tests for Reset Usage Tool
 """
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
+from tools.backends import InMemoryStorage, open_backend
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.identifiers import IDENTIFIERS
+from tools.quota import QUOTA
 from tools.reset_usage import ResetUsageTool
+from tools.storage import WRITE_BEHIND
+from tools.usage_limit import UsageLimitTool
 from tools.exceptions import FailedToDeleteStorageItemException
 
 
@@ -164,6 +172,20 @@ class TestResetUsageTool(unittest.TestCase):
 
         self.assertEqual(str(context.exception), "'tracking_method'")
 
+    def test_invoke_drops_record_written_behind(self):
+        """Test that _invoke resets a record that is still queued to be written."""
+        WRITE_BEHIND.put("user789", self.mock_session.storage, None, b"", 60)
+        self.mock_session.storage.delete.side_effect = KeyError("user789")
+
+        list(self.tool._invoke({"user_id": "user789", "tracking_method": "workspace-user"}))
+
+        self.assertIsNone(WRITE_BEHIND.get("user789"))
+        self.tool.create_json_message.assert_called_once_with({
+            "identifier": "user789",
+            "status": "Reset successfully completed"
+        })
+        WRITE_BEHIND.clear()
+
     def test_invoke_with_tracking_method_none(self):
         """Test that _invoke uses 'user_id' as identifier when tracking_method is None."""
         tool_parameters = {
@@ -182,4 +204,193 @@ class TestResetUsageTool(unittest.TestCase):
             "identifier": expected_identifier,
             "status": "Reset successfully completed"
         })
-        self.assertEqual(result, ["mocked_message"])
\ No newline at end of file
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_invoke_with_shards(self):
+        """Test that _invoke deletes every shard of a sharded identifier."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "app",
+            "shard_count": 3
+        }
+        # Shard 1 never received a usage
+        self.mock_session.storage.delete.side_effect = [None, Exception("missing"), None]
+
+        result = list(self.tool._invoke(tool_parameters))
+
+        self.assertEqual(
+            [call.args[0] for call in self.mock_session.storage.delete.call_args_list],
+            ["app123#0", "app123#1", "app123#2"])
+        self.tool.create_json_message.assert_called_once_with({
+            "identifier": "app123",
+            "status": "Reset successfully completed"
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_invoke_with_shards_all_deletes_fail(self):
+        """Test that _invoke raises when no shard could be deleted."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "app",
+            "shard_count": 2
+        }
+        self.mock_session.storage.delete.side_effect = Exception("Storage delete failed")
+
+        with self.assertRaises(FailedToDeleteStorageItemException) as context:
+            list(self.tool._invoke(tool_parameters))
+
+        self.assertEqual(context.exception.identifier, "app123")
+
+
+    def test_invoke_invalidates_cached_record(self):
+        """Test that _invoke drops the cached record of the identifier."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "workspace-user"
+        }
+        RECORD_CACHE.put("user789", b"record")
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.assertIsNone(RECORD_CACHE.get("user789", 60))
+        RECORD_CACHE.clear()
+
+    def test_invoke_invalidates_denials(self):
+        """Test that _invoke forgets the remembered denials of the identifier."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "workspace-user"
+        }
+        DENY_CACHE.put("user789", "scope", float("inf"), 5, 5)
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.assertIsNone(DENY_CACHE.get("user789", "scope", 0.0))
+
+    def test_invoke_subtracts_freed_bytes(self):
+        """Test that _invoke subtracts the size of the deleted record from the quota usage."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "workspace-user",
+            "quota_accounting": True
+        }
+        QUOTA.clear()
+        QUOTA.record(self.mock_session.storage, 100)
+        self.mock_session.storage.get.return_value = b"1:999000"
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.assertEqual(QUOTA.stats()["used_bytes"], 100 - len(b"1:999000"))
+        QUOTA.clear()
+
+    def test_invoke_with_namespaced_key(self):
+        """Test that _invoke deletes the record under the key of the configured namespace."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "app-user",
+            "key_format": "namespaced",
+            "limit_strategy": "fixed",
+            "duration_seconds": 86400
+        }
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.mock_session.storage.delete.assert_called_once_with(
+            "ul:fixed:86400:app-user:app123:user789")
+        self.tool.create_json_message.assert_called_once_with({
+            "identifier": "app123user789",
+            "status": "Reset successfully completed"
+        })
+
+    def test_invoke_with_millisecond_window(self):
+        """Test that _invoke deletes the record of a millisecond window."""
+        tool_parameters = {
+            "user_id": "user789",
+            "tracking_method": "app-user",
+            "key_format": "namespaced",
+            "duration_milliseconds": "500"
+        }
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.mock_session.storage.delete.assert_called_once_with(
+            "ul:sliding:500ms:app-user:app123:user789")
+
+    def test_invoke_with_sqlite_backend(self):
+        """Test that _invoke deletes the record from the selected backend."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "usage.sqlite3")
+            backend = open_backend(self.mock_session, "sqlite", path)
+            backend.set("user789", b"1:999000")
+            tool_parameters = {
+                "user_id": "user789",
+                "tracking_method": "workspace-user",
+                "storage_backend": "sqlite",
+                "storage_path": path
+            }
+
+            list(self.tool._invoke(tool_parameters))
+
+            self.assertFalse(backend.exist("user789"))
+            self.mock_session.storage.delete.assert_not_called()
+            backend.close()
+
+    def test_invoke_reset_all(self):
+        """Test that the "all" scope deletes the indexed records of the app."""
+        IDENTIFIERS.clear()
+        storage = self.mock_session.storage = InMemoryStorage()
+        for key, app_id in (("app123user1", "app123"), ("app123user2", "app123"),
+                            ("app456user1", "app456")):
+            storage.set(key, b"1:999000")
+            IDENTIFIERS.touch(storage, "app-user", app_id, key, 999000)
+        tool_parameters = {
+            "tracking_method": "app-user",
+            "reset_scope": "all"
+        }
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.tool.create_json_message.assert_called_once_with({
+            "tracking_method": "app-user",
+            "deleted_keys": 2,
+            "remaining_keys": 0,
+            "complete": True,
+            "status": "Reset successfully completed"
+        })
+        self.assertFalse(storage.exist("app123user1"))
+        self.assertTrue(storage.exist("app456user1"))
+        IDENTIFIERS.clear()
+
+    def test_invoke_reset_all_subtracts_index_bytes(self):
+        """Test that the "all" scope subtracts the deleted records and index entries."""
+        IDENTIFIERS.clear()
+        QUOTA.clear()
+        storage = self.mock_session.storage = InMemoryStorage()
+        for user in ("user1", "user2"):
+            tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+            tool.create_json_message = MagicMock()
+            list(tool._invoke({"user_id": user, "tracking_method": "app-user", "limit": "5",
+                               "quota_accounting": True, "index_identifiers": True}))
+        tool_parameters = {
+            "tracking_method": "app-user",
+            "reset_scope": "all",
+            "quota_accounting": True
+        }
+
+        list(self.tool._invoke(tool_parameters))
+
+        self.assertFalse(storage.exist("app123user1"))
+        self.assertEqual(QUOTA.stats()["used_bytes"], storage.stored_bytes)
+        IDENTIFIERS.clear()
+        QUOTA.clear()
+
+    def test_invoke_with_invalid_reset_scope(self):
+        """Test that _invoke raises ValueError for invalid bulk reset parameters."""
+        for tool_parameters in ({"tracking_method": "app-user", "reset_scope": "app"},
+                                {"tracking_method": "app-user", "reset_scope": "all",
+                                 "older_than_seconds": -1},
+                                {"tracking_method": "invalid", "reset_scope": "all"}):
+            with self.subTest(tool_parameters=tool_parameters):
+                with self.assertRaises(ValueError):
+                    list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.delete.assert_not_called()
@@ -0,0 +1,77 @@
+"""
+Unit Tests for the sharding helpers
+"""
+import unittest
+from unittest.mock import patch
+
+from tools.sharding import ShardCountCache, choose_shard, shard_key
+
+
+class TestChooseShard(unittest.TestCase):
+    """
+    Unit tests for shard_key and choose_shard.
+    """
+
+    def test_shard_key(self):
+        """Test the storage key of a shard."""
+        self.assertEqual(shard_key("app123", 7), "app123#7")
+
+    def test_shard_by_user_is_stable(self):
+        """Test that a user is always mapped to the same shard."""
+        shards = {choose_shard("user789", 8, "user") for _ in range(10)}
+        self.assertEqual(len(shards), 1)
+        self.assertIn(shards.pop(), range(8))
+
+    def test_shard_by_random_spreads_writes(self):
+        """Test that random selection uses every shard."""
+        shards = {choose_shard("user789", 4, "random") for _ in range(200)}
+        self.assertEqual(shards, {0, 1, 2, 3})
+
+    def test_invalid_shard_selection(self):
+        """Test that an unknown selection raises a ValueError."""
+        with self.assertRaises(ValueError):
+            choose_shard("user789", 4, "invalid")
+
+
+class TestShardCountCache(unittest.TestCase):
+    """
+    Unit tests for the ShardCountCache class.
+    """
+
+    def test_get_within_max_age(self):
+        """Test that cached counts are returned for the same window."""
+        cache = ShardCountCache()
+        cache.put("app123", 3600, {0: 1})
+        self.assertEqual(cache.get("app123", 3600, 1.0), {0: 1})
+        self.assertIsNone(cache.get("app123", 7200, 1.0))
+
+    def test_get_expired(self):
+        """Test that counts older than max_age are not returned."""
+        cache = ShardCountCache()
+        with patch('time.monotonic', return_value=100.0):
+            cache.put("app123", 3600, {0: 1})
+        with patch('time.monotonic', return_value=102.0):
+            self.assertIsNone(cache.get("app123", 3600, 1.0))
+
+    def test_update_writes_through(self):
+        """Test that a shard update is applied to the cached counts."""
+        cache = ShardCountCache()
+        cache.put("app123", 3600, {0: 1})
+        cache.update("app123", 3600, 1, 5)
+        cache.update("app123", 7200, 0, 9)
+        self.assertEqual(cache.get("app123", 3600, 1.0), {0: 1, 1: 5})
+
+    def test_bounded_size(self):
+        """Test that the least recently refreshed entry is evicted."""
+        cache = ShardCountCache(max_entries=2)
+        cache.put("a", 0, {})
+        cache.put("b", 0, {})
+        cache.put("a", 0, {})
+        cache.put("c", 0, {})
+        self.assertIsNone(cache.get("b", 0, 1.0))
+        self.assertIsNotNone(cache.get("a", 0, 1.0))
+        self.assertIsNotNone(cache.get("c", 0, 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Unit Tests for the trace replay simulator
+"""
+import os
+import tempfile
+import unittest
+
+from benchmarks.simulate import ExactWindow, load_trace, replay, synthetic_trace
+
+
+class TestSimulate(unittest.TestCase):
+    """
+    Unit tests for the replay of usage traces in virtual time.
+    """
+
+    def test_exact_window(self):
+        """Test that the oracle allows the limit within any window of the duration."""
+        oracle = ExactWindow(2, 60)
+        decisions = [oracle.allow("user1", timestamp, 1) for timestamp in (0, 10, 20, 60, 70)]
+        self.assertEqual(decisions, [True, True, False, True, True])
+        self.assertFalse(oracle.allow("user1", 71, 1))
+        self.assertTrue(oracle.allow("user2", 71, 2))
+
+    def test_load_trace(self):
+        """Test that traces are read in timestamp order with a default cost of 1."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "trace.csv")
+            with open(path, "w", encoding="utf-8") as trace:
+                trace.write("# timestamp,identifier,cost\n20,user2,3\n10,user1\n10,user3,\n")
+            self.assertEqual(load_trace(path),
+                             [(10.0, "user1", 1), (10.0, "user3", 1), (20.0, "user2", 3)])
+
+    def test_replay_is_deterministic(self):
+        """Test that the same trace and seed always make the same decisions."""
+        events = synthetic_trace(2_000, 10, 86400, seed=1)
+        self.assertEqual(events, synthetic_trace(2_000, 10, 86400, seed=1))
+        first = replay(events, {'limit': 20, 'limit_strategy': 'fixed'})
+        second = replay(events, {'limit': 20, 'limit_strategy': 'fixed'})
+        for name in ("allowed", "false_allows", "false_denials", "final_bytes"):
+            self.assertEqual(first[name], second[name])
+        self.assertEqual(first["events"], 2_000)
+        self.assertAlmostEqual(first["virtual_seconds"], events[-1][0] - events[0][0])
+
+    def test_sliding_window_matches_oracle(self):
+        """Test that the sliding strategy makes the decisions of the exact window."""
+        events = synthetic_trace(2_000, 10, 86400, seed=2)
+        events[5] = (events[5][0], events[5][1], 3)
+        report = replay(events, {'limit': 20, 'duration_seconds': 3600,
+                                 'limit_strategy': 'sliding'})
+        self.assertEqual(report["accuracy"], 1.0)
+        self.assertGreater(report["denied"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
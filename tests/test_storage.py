@@ -0,0 +1,439 @@
+# pylint: disable=protected-access
+"""
+Unit Tests for the storage helpers
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from tools.backends import InMemoryStorage, RedisStorage, SQLiteStorage
+from tools.cache import RecordCache
+from tools.encoding import encode_versioned
+from tools.exceptions import StorageConflictException
+from tools.storage import (
+    CONFLICT_ATTEMPTS,
+    VersionedStorage,
+    WriteBehindQueue,
+    retry_on_conflict,
+)
+from tools.usage_limit import UsageLimitTool
+
+try:
+    import fakeredis
+    # The window and compare-and-set scripts run on the Lua runtime of fakeredis[lua]
+    import lupa  # pylint: disable=unused-import
+except ImportError:  # pragma: no cover
+    if os.environ.get("CI"):
+        # Continuous integration runs the Redis scripts instead of skipping them
+        raise
+    fakeredis = None
+
+
+class TestVersionedStorage(unittest.TestCase):
+    """
+    Unit tests for the VersionedStorage class.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.storage = VersionedStorage(self.backend)
+
+    def test_legacy_record_is_version_zero(self):
+        """Test that records without a version stamp are read as version 0."""
+        self.backend.set("key", b"1:999000")
+        self.assertEqual(self.storage.get("key"), b"1:999000")
+        self.storage.set("key", b"2:999000")
+        self.assertEqual(self.backend.get("key"), encode_versioned(1, b"2:999000"))
+
+    def test_consecutive_writes_increment_version(self):
+        """Test that each write increments the version stamp."""
+        self.storage.set("key", b"a")
+        self.storage.set("key", b"b")
+        self.assertEqual(self.backend.get("key"), encode_versioned(2, b"b"))
+        self.assertEqual(self.storage.get("key"), b"b")
+
+    def test_concurrent_write_raises_conflict(self):
+        """Test that a write after a concurrent update raises a conflict."""
+        self.backend.set("key", encode_versioned(3, b"a"))
+        self.storage.get("key")
+        self.backend.set("key", encode_versioned(4, b"b"))
+        with self.assertRaises(StorageConflictException) as context:
+            self.storage.set("key", b"c")
+        self.assertEqual(context.exception.expected_version, 3)
+        self.assertEqual(context.exception.actual_version, 4)
+        self.assertEqual(self.backend.get("key"), encode_versioned(4, b"b"))
+
+    def test_delete(self):
+        """Test that deleted records are written again from version 1."""
+        self.storage.set("key", b"a")
+        self.storage.delete("key")
+        self.assertFalse(self.backend.exist("key"))
+        self.storage.set("key", b"b")
+        self.assertEqual(self.backend.get("key"), encode_versioned(1, b"b"))
+
+    def test_staged_writes_are_committed_together(self):
+        """Test that staged writes are readable in the block and written at its end."""
+        with self.storage.staged():
+            self.storage.set("a", b"1")
+            self.storage.set("b", b"2")
+            self.assertEqual(self.storage.get("a"), b"1")
+            self.assertEqual(self.backend.calls["set"], 0)
+        self.assertEqual(self.backend.get("a"), encode_versioned(1, b"1"))
+        self.assertEqual(self.backend.get("b"), encode_versioned(1, b"2"))
+
+    def test_staged_writes_are_discarded_on_error(self):
+        """Test that nothing is written if the block raises."""
+        with self.assertRaises(ValueError):
+            with self.storage.staged():
+                self.storage.set("a", b"1")
+                raise ValueError("denied")
+        self.assertFalse(self.backend.exist("a"))
+
+    def test_staged_conflict_writes_nothing(self):
+        """Test that a conflict on one staged record leaves all records unchanged."""
+        self.backend.set("a", encode_versioned(1, b"0"))
+        self.backend.set("b", encode_versioned(1, b"0"))
+        self.storage.get("a")
+        self.storage.get("b")
+        self.backend.set("b", encode_versioned(2, b"other"))
+        with self.assertRaises(StorageConflictException):
+            with self.storage.staged():
+                self.storage.set("a", b"1")
+                self.storage.set("b", b"2")
+        self.assertEqual(self.backend.get("a"), encode_versioned(1, b"0"))
+        self.assertEqual(self.backend.get("b"), encode_versioned(2, b"other"))
+
+    def test_discarded_writes_are_dropped(self):
+        """Test that discarded writes are readable in the block and never written."""
+        with self.storage.discarded():
+            self.storage.set("a", b"1")
+            with self.storage.staged():
+                self.storage.set("b", b"2")
+            self.assertEqual(self.storage.get("a"), b"1")
+            self.assertEqual(self.storage.get("b"), b"2")
+        self.assertEqual(self.backend.calls["set"], 0)
+        self.assertFalse(self.backend.exist("a"))
+        self.assertEqual(self.storage.written, set())
+
+    def test_written_bytes(self):
+        """Test that the size changes of written and deleted records are summed."""
+        self.backend.set("a", b"legacy")
+        self.storage.set("a", b"1")
+        self.storage.set("b", b"22")
+        self.assertEqual(self.storage.written, {"a", "b"})
+        self.assertEqual(self.storage.written_bytes, self.backend.stored_bytes - len(b"legacy"))
+        self.storage.delete("b")
+        self.assertEqual(self.storage.written_bytes, self.backend.stored_bytes - len(b"legacy"))
+
+
+class CompareAndSetConformance:
+    """
+    Conflicts between two VersionedStorage instances, like two plugin processes, over
+    a backend that compares and sets records atomically.
+
+    Subclasses implement `create_backends`.
+    """
+
+    def create_backends(self):
+        """Return two connections to the same empty backend."""
+        raise NotImplementedError
+
+    def setUp(self):  # pylint: disable=invalid-name
+        self.first_backend, self.second_backend = self.create_backends()
+        self.first = VersionedStorage(self.first_backend)
+        self.second = VersionedStorage(self.second_backend)
+
+    def test_write_of_other_instance_raises_conflict(self):
+        """Test that a write after a write of another instance raises a conflict."""
+        self.first.set("key", b"a")
+        self.assertEqual(self.first.get("key"), b"a")
+        self.assertEqual(self.second.get("key"), b"a")
+        self.second.set("key", b"b")
+        with patch.object(self.first_backend, "get", wraps=self.first_backend.get) as get:
+            with self.assertRaises(StorageConflictException) as context:
+                self.first.set("key", b"c")
+        # The version is compared by the backend, not by re-reading the record
+        get.assert_not_called()
+        self.assertEqual(context.exception.expected_version, 1)
+        self.assertEqual(context.exception.actual_version, 2)
+        self.assertEqual(self.first_backend.get("key"), encode_versioned(2, b"b"))
+        self.assertEqual(self.first.get("key"), b"b")
+        self.first.set("key", b"c")
+        self.assertEqual(self.second_backend.get("key"), encode_versioned(3, b"c"))
+
+    def test_first_writes_of_both_instances_conflict(self):
+        """Test that only one of two instances creates a record."""
+        self.first.set("key", b"a")
+        with self.assertRaises(StorageConflictException):
+            self.second.set("key", b"b")
+        self.assertEqual(self.second_backend.get("key"), encode_versioned(1, b"a"))
+
+    def test_staged_conflict_writes_nothing(self):
+        """Test that a conflict on one staged record leaves every record unchanged."""
+        self.first.set("a", b"0")
+        self.first.set("b", b"0")
+        self.second.get("b")
+        self.second.set("b", b"other")
+        with self.assertRaises(StorageConflictException):
+            with self.first.staged():
+                self.first.set("a", b"1")
+                self.first.set("b", b"1")
+        self.assertEqual(self.second_backend.get("a"), encode_versioned(1, b"0"))
+        self.assertEqual(self.second_backend.get("b"), encode_versioned(2, b"other"))
+
+    def test_version_beyond_24_bits(self):
+        """Test that every byte of the version stamp is compared."""
+        self.first_backend.set("key", encode_versioned(2 ** 31 + 5, b"a"))
+        self.assertEqual(self.first.get("key"), b"a")
+        self.first.set("key", b"b")
+        self.assertEqual(self.second_backend.get("key"), encode_versioned(2 ** 31 + 6, b"b"))
+
+    def test_legacy_and_unreadable_records_are_version_zero(self):
+        """Test that records without a readable version stamp are overwritten."""
+        self.first_backend.set("legacy", b"1:999000")
+        self.first_backend.set("truncated", bytes([0x80, 1]))
+        for key in ("legacy", "truncated"):
+            self.first.set(key, b"a")
+            self.assertEqual(self.second_backend.get(key), encode_versioned(1, b"a"))
+
+
+class TestSQLiteCompareAndSet(CompareAndSetConformance, unittest.TestCase):
+    """
+    Conflicts between two connections to a SQLite database.
+    """
+
+    def create_backends(self):
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "usage.sqlite3")
+        backends = SQLiteStorage(path), SQLiteStorage(path)
+        for backend in backends:
+            self.addCleanup(backend.close)
+        return backends
+
+
+@unittest.skipUnless(fakeredis, "fakeredis is not installed")
+class TestRedisCompareAndSet(CompareAndSetConformance, unittest.TestCase):
+    """
+    Conflicts between two clients of a Redis server.
+    """
+
+    def create_backends(self):
+        server = fakeredis.FakeServer()
+        return (RedisStorage(fakeredis.FakeRedis(server=server)),
+                RedisStorage(fakeredis.FakeRedis(server=server)))
+
+
+class TestCachedVersionedStorage(unittest.TestCase):
+    """
+    Unit tests for VersionedStorage with a record cache.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.cache = RecordCache()
+        self.storage = VersionedStorage(self.backend, self.cache, cache_seconds=1.0)
+
+    def test_get_reads_through_cache(self):
+        """Test that repeated reads are served from the cache."""
+        self.backend.set("key", encode_versioned(1, b"a"))
+        self.assertEqual(self.storage.get("key"), b"a")
+        self.assertEqual(self.storage.get("key"), b"a")
+        self.assertEqual(self.backend.calls["get"], 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_set_writes_through_cache(self):
+        """Test that a write updates the cache and later reads skip the storage."""
+        self.storage.set("key", b"a")
+        self.assertEqual(self.storage.get("key"), b"a")
+        # Only the version check of the write reached the storage
+        self.assertEqual(self.backend.calls["get"], 1)
+
+    def test_stale_cache_entry_is_evicted_on_conflict(self):
+        """Test that a conflict caused by a stale cached record evicts it."""
+        self.storage.set("key", b"a")
+        self.backend.set("key", encode_versioned(2, b"b"))
+        self.storage.get("key")
+        with self.assertRaises(StorageConflictException):
+            self.storage.set("key", b"c")
+        self.assertEqual(self.storage.get("key"), b"b")
+
+    def test_disabled_cache_is_kept_coherent(self):
+        """Test that writes without caching drop the cached record."""
+        self.storage.set("key", b"a")
+        uncached = VersionedStorage(self.backend, self.cache)
+        uncached.get("key")
+        uncached.set("key", b"b")
+        self.assertEqual(self.storage.get("key"), b"b")
+
+    def test_delete_invalidates_cache(self):
+        """Test that deleting a record drops it from the cache."""
+        self.storage.set("key", b"a")
+        self.storage.delete("key")
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+
+class TestWriteBehind(unittest.TestCase):
+    """
+    Unit tests for VersionedStorage with a write-behind queue.
+    """
+
+    def setUp(self):
+        self.backend = InMemoryStorage()
+        self.queue = WriteBehindQueue()
+        self.storage = VersionedStorage(self.backend, write_behind=self.queue,
+                                        write_behind_seconds=60)
+
+    def tearDown(self):
+        self.queue.clear()
+
+    def test_writes_are_merged_until_flushed(self):
+        """Test that queued records are read back and written once when flushed."""
+        self.backend.set("key", encode_versioned(3, b"a"))
+        for value in (b"b", b"c", b"d"):
+            self.storage.get("key")
+            self.storage.set("key", value)
+        self.assertEqual(self.backend.calls["set"], 1)
+        self.assertEqual(self.storage.get("key"), b"d")
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertEqual(self.queue.drain(), 0)
+        self.assertEqual(self.backend.get("key"), encode_versioned(4, b"d"))
+        self.assertEqual(self.queue.stats(), {
+            "queued": 3, "merged": 2, "flushed": 1, "conflicts": 0, "failed": 0, "pending": 0})
+
+    def test_conflicting_flush_keeps_stored_record(self):
+        """Test that a record written by another process wins over the queued one."""
+        self.storage.set("key", b"a")
+        self.backend.set("key", encode_versioned(1, b"b"))
+        self.queue.drain()
+        self.assertEqual(self.backend.get("key"), encode_versioned(1, b"b"))
+        self.assertEqual(self.queue.stats()["conflicts"], 1)
+        self.assertEqual(self.storage.get("key"), b"b")
+
+    def test_full_queue_writes_synchronously(self):
+        """Test that records beyond the bound of the queue are written at once."""
+        self.queue.max_pending = 1
+        self.storage.set("key1", b"a")
+        self.storage.set("key2", b"b")
+        self.storage.set("key1", b"c")
+        self.assertEqual(self.backend.get("key2"), encode_versioned(1, b"b"))
+        self.assertFalse(self.backend.exist("key1"))
+        self.assertEqual(self.queue.stats()["pending"], 1)
+
+    def test_synchronous_write_and_delete_drop_queued_record(self):
+        """Test that a record written through or deleted is not overwritten by the queue."""
+        self.storage.set("key1", b"a")
+        self.storage.set("key2", b"a")
+        synchronous = VersionedStorage(self.backend, write_behind=self.queue)
+        synchronous.get("key1")
+        synchronous.set("key1", b"b")
+        self.backend.set("key2", b"")
+        self.storage.delete("key2")
+        self.assertEqual(self.queue.stats()["pending"], 0)
+        self.assertEqual(self.backend.get("key1"), encode_versioned(1, b"b"))
+
+    def test_staged_writes_are_queued(self):
+        """Test that staged writes are queued together once the block completes."""
+        with self.storage.staged():
+            self.storage.set("key1", b"a")
+            self.storage.set("key2", b"b")
+            self.assertEqual(self.queue.stats()["pending"], 0)
+        self.assertEqual(self.queue.stats()["pending"], 2)
+        self.assertEqual(self.storage.written, {"key1", "key2"})
+        self.assertEqual(self.backend.calls["set"], 0)
+
+    def test_background_flush(self):
+        """Test that the background thread writes records once their delay has passed."""
+        self.storage.write_behind_seconds = 0.01
+        self.storage.set("key", b"a")
+        deadline = time.monotonic() + 5
+        while not self.backend.exist("key") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.backend.get("key"), encode_versioned(1, b"a"))
+
+
+class TestRetryOnConflict(unittest.TestCase):
+    """
+    Unit tests for retry_on_conflict.
+    """
+
+    @patch('time.sleep')
+    def test_retries_until_success(self, mock_sleep):
+        """Test that the operation is re-run after a conflict."""
+        operation = MagicMock(side_effect=[
+            StorageConflictException("key", 1, 2), "done"])
+        self.assertEqual(retry_on_conflict("key", operation, 1, 2), "done")
+        self.assertEqual(operation.call_count, 2)
+        operation.assert_called_with(1, 2)
+        mock_sleep.assert_called_once()
+
+    @patch('time.sleep')
+    def test_gives_up_after_bounded_attempts(self, mock_sleep):
+        """Test that the conflict is raised once all attempts are used."""
+        operation = MagicMock(side_effect=StorageConflictException("key", 1, 2))
+        with self.assertRaises(StorageConflictException):
+            retry_on_conflict("key", operation)
+        self.assertEqual(operation.call_count, CONFLICT_ATTEMPTS)
+        self.assertEqual(mock_sleep.call_count, CONFLICT_ATTEMPTS - 1)
+        for call in mock_sleep.call_args_list:
+            self.assertLessEqual(call.args[0], 0.05)
+
+
+class TestConcurrentUsage(unittest.TestCase):
+    """
+    Stress tests of concurrent UsageLimitTool invocations on one hot key.
+    """
+
+    INVOCATIONS_PER_CALLER = 20
+
+    def _run_callers(self, callers, limit_strategy):
+        storage = InMemoryStorage()
+        session = MagicMock()
+        session.app_id = "app123"
+        session.storage = storage
+        errors = []
+
+        def caller():
+            try:
+                for _ in range(self.INVOCATIONS_PER_CALLER):
+                    tool = UsageLimitTool(runtime=MagicMock(), session=session)
+                    tool.create_json_message = MagicMock()
+                    list(tool._invoke({
+                        'user_id': 'user789',
+                        'tracking_method': 'app',
+                        'limit': '1000000',
+                        'duration_seconds': '3600',
+                        'limit_strategy': limit_strategy
+                    }))
+            # pylint: disable=broad-except
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return VersionedStorage(storage).get("app123")
+
+    def test_no_lost_updates_fixed_window(self):
+        """Test that no fixed window increments are lost at 1, 8 and 64 callers."""
+        for callers in (1, 8, 64):
+            with self.subTest(callers=callers):
+                record = self._run_callers(callers, 'fixed')
+                self.assertEqual(int(record.split(b":")[0]),
+                                 callers * self.INVOCATIONS_PER_CALLER)
+
+    def test_no_lost_updates_sliding_window(self):
+        """Test that no sliding window timestamps are lost at 8 callers."""
+        record = self._run_callers(8, 'sliding')
+        # Nine header bytes followed by four bytes per timestamp
+        self.assertEqual((len(record) - 9) // 4, 8 * self.INVOCATIONS_PER_CALLER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,52 @@
 Unit Tests for UsageLimitTool
 """
 
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
+from tools.encoding import (
+    decode_tiers,
+    decode_timestamps,
+    decode_versioned,
+    decode_weighted_timestamps,
+    encode_arrival_time,
+    encode_buckets,
+    encode_counter,
+    encode_tiers,
+    encode_timestamps,
+    encode_versioned,
+    encode_weighted_timestamps,
+)
+from tools.backends import InMemoryStorage, RedisStorage, open_backend
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.clock import VirtualClock
+from tools.expiry import EXPIRY
+from tools.identifiers import IDENTIFIERS
+from tools.metrics import METRICS
+from tools.quota import QUOTA
+from tools.reservations import reservations_key
+from tools.sharding import SHARD_COUNTS
+from tools.storage import WriteBehindQueue
 from tools.usage_limit import UsageLimitTool
 from tools.exceptions import UsageLimitExceededException
 
+try:
+    import fakeredis
+    # The window and compare-and-set scripts run on the Lua runtime of fakeredis[lua]
+    import lupa  # pylint: disable=unused-import
+except ImportError:  # pragma: no cover
+    if os.environ.get("CI"):
+        # Continuous integration runs the Redis scripts instead of skipping them
+        raise
+    fakeredis = None
+
+
+def versioned(payload, version=1):
+    """Wrap a record in the version stamp envelope written by the tool."""
+    return encode_versioned(version, payload)
+
 
 class TestUsageLimitTool(unittest.TestCase):
     """
@@ -61,7 +101,7 @@ class TestUsageLimitTool(unittest.TestCase):
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -91,6 +131,7 @@ class TestUsageLimitTool(unittest.TestCase):
         self.assertEqual(exception.identifier, expected_identifier)
         self.assertEqual(exception.limit, 5)
         self.assertEqual(exception.current_usage, 5)
+        self.assertEqual(exception.retry_after, 2601)
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_not_called()
 
@@ -109,13 +150,12 @@ class TestUsageLimitTool(unittest.TestCase):
         self.mock_session.storage.get.return_value = b"999000,999500,999900"
         expected_identifier = "user789"
         expected_timestamps = [999000, 999500, 999900, 1000000]
-        expected_timestamps_str = ','.join(
-            map(str, expected_timestamps)).encode()
+        expected_record = encode_timestamps(expected_timestamps)
         result = list(self.tool._invoke(tool_parameters))
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_timestamps_str)
+            expected_identifier, versioned(expected_record))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -145,9 +185,1732 @@ class TestUsageLimitTool(unittest.TestCase):
         self.assertEqual(exception.identifier, expected_identifier)
         self.assertEqual(exception.limit, 5)
         self.assertEqual(exception.current_usage, 5)
+        # The oldest timestamp leaves the window first
+        self.assertEqual(exception.retry_after, 100)
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_not_called()
 
+    def test_sliding_window_usage_binary_record(self):
+        """
+        Test sliding window reads records written in the binary format.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding'
+        }
+        self.mock_session.storage.get.return_value = encode_timestamps(
+            [996000, 999000, 999500])
+        expected_identifier = "user789"
+        result = list(self.tool._invoke(tool_parameters))
+        # Assertions
+        # The expired timestamp is sliced off, the others keep their offsets
+        stored_key, stored = self.mock_session.storage.set.call_args[0]
+        self.assertEqual(stored_key, expected_identifier)
+        self.assertEqual(decode_timestamps(decode_versioned(stored)[1]),
+                         [999000, 999500, 1000000])
+        self.assertEqual(len(stored), len(versioned(encode_timestamps([999000, 999500, 1000000]))))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 3,
+            "remaining_usage": 2,
+            'reset_seconds': 2600
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_sliding_counter_usage_rolls_previous_window(self):
+        """
+        Test sliding counter weights the count of the previous window.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-counter'
+        }
+        # The current window started at 997200, 2800 seconds ago
+        self.mock_session.storage.get.return_value = encode_counter(993600, 0, 10)
+        expected_identifier = "user789"
+        result = list(self.tool._invoke(tool_parameters))
+        # Assertions
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_counter(997200, 10, 1)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 4,
+            "remaining_usage": 1,
+            'reset_seconds': 80
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_sliding_counter_usage_current_window(self):
+        """
+        Test sliding counter increments the count of the current window.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-counter'
+        }
+        self.mock_session.storage.get.return_value = encode_counter(997200, 4, 1)
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_counter(997200, 4, 2)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 3,
+            "remaining_usage": 2,
+            'reset_seconds': 800
+        })
+
+    def test_sliding_counter_usage_limit_exceeded(self):
+        """
+        Test sliding counter when the estimated usage reaches the limit.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-counter'
+        }
+        self.mock_session.storage.get.return_value = encode_counter(997200, 9, 3)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.current_usage, 5)
+        # The weighted previous count drops from 2 to 1 at 3200 seconds into the window
+        self.assertEqual(context.exception.retry_after, 400)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_sliding_counter_usage_expired_record(self):
+        """
+        Test sliding counter discards counts older than the previous window.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-counter'
+        }
+        self.mock_session.storage.get.return_value = encode_counter(990000, 5, 5)
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_counter(997200, 0, 1)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 1,
+            "remaining_usage": 4,
+            'reset_seconds': 4400
+        })
+
+    def test_sliding_buckets_usage_rotates_ring(self):
+        """
+        Test bucketed sliding window clears buckets that left the window.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-buckets',
+            'bucket_count': '24'
+        }
+        # 150 second buckets, the current bucket 6666 shares its slot with 6642
+        counts = [0] * 24
+        counts[6642 % 24] = 5
+        counts[6643 % 24] = 1
+        counts[6660 % 24] = 2
+        self.mock_session.storage.get.return_value = encode_buckets(150, 6660, counts)
+        expected_identifier = "user789"
+        result = list(self.tool._invoke(tool_parameters))
+        # Assertions
+        expected_counts = [0] * 24
+        expected_counts[6643 % 24] = 1
+        expected_counts[6660 % 24] = 2
+        expected_counts[6666 % 24] = 1
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_buckets(150, 6666, expected_counts)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 4,
+            "remaining_usage": 1,
+            'reset_seconds': 50,
+            'reset_resolution_seconds': 150
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_sliding_buckets_usage_limit_exceeded(self):
+        """
+        Test bucketed sliding window when the buckets add up to the limit.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-buckets',
+            'bucket_count': '24'
+        }
+        counts = [0] * 24
+        counts[6650 % 24] = 3
+        counts[6666 % 24] = 2
+        self.mock_session.storage.get.return_value = encode_buckets(150, 6666, counts)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.current_usage, 5)
+        # Bucket 6650 leaves the window at (6650 + 24) * 150
+        self.assertEqual(context.exception.retry_after, 1100)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_sliding_buckets_usage_layout_changed(self):
+        """
+        Test bucketed sliding window starts a new ring when the bucket count changes.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-buckets',
+            'bucket_count': '60'
+        }
+        self.mock_session.storage.get.return_value = encode_buckets(150, 6666, [4] * 24)
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        expected_counts = [0] * 60
+        expected_counts[16666 % 60] = 1
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_buckets(60, 16666, expected_counts)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 1,
+            "remaining_usage": 4,
+            'reset_seconds': 3560,
+            'reset_resolution_seconds': 60
+        })
+
+    def test_sliding_buckets_invalid_bucket_count(self):
+        """
+        Test that a bucket count below one raises a ValueError.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-buckets',
+            'bucket_count': '0'
+        }
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception), "Invalid bucket count")
+
+    def test_gcra_usage_first_request(self):
+        """
+        Test GCRA allows the first request and advances the arrival time.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '3600',
+            'duration_seconds': '3600',
+            'limit_strategy': 'gcra',
+            'burst': '5'
+        }
+        self.mock_session.storage.get.return_value = b""
+        expected_identifier = "user789"
+        result = list(self.tool._invoke(tool_parameters))
+        # One second emission interval, arrival time is stored in microseconds
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_arrival_time(1000001_000000)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 3600,
+            "current_usage": 1,
+            "remaining_usage": 4,
+            'reset_seconds': 1,
+            'retry_after': 0.0
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_gcra_usage_last_request_of_burst(self):
+        """
+        Test GCRA reports the exact retry_after once the burst is used up.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '3600',
+            'duration_seconds': '3600',
+            'limit_strategy': 'gcra',
+            'burst': '5'
+        }
+        self.mock_session.storage.get.return_value = encode_arrival_time(1000003_500000)
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_arrival_time(1000004_500000)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 3600,
+            "current_usage": 5,
+            "remaining_usage": 0,
+            'reset_seconds': 5,
+            'retry_after': 0.5
+        })
+
+    def test_gcra_usage_limit_exceeded(self):
+        """
+        Test GCRA denies requests beyond the burst with retry_after.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '3600',
+            'duration_seconds': '3600',
+            'limit_strategy': 'gcra',
+            'burst': '5'
+        }
+        self.mock_session.storage.get.return_value = encode_arrival_time(1000004_500000)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        exception = context.exception
+        self.assertEqual(exception.limit, 5)
+        self.assertEqual(exception.current_usage, 5)
+        self.assertEqual(exception.retry_after, 0.5)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_gcra_usage_burst_defaults_to_limit(self):
+        """
+        Test GCRA uses the limit as burst and ignores arrival times in the past.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '10',
+            'duration_seconds': '3600',
+            'limit_strategy': 'gcra'
+        }
+        self.mock_session.storage.get.return_value = encode_arrival_time(999000_000000)
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_called_with(
+            expected_identifier, versioned(encode_arrival_time(1000360_000000)))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 10,
+            "current_usage": 1,
+            "remaining_usage": 9,
+            'reset_seconds': 360,
+            'retry_after': 0.0
+        })
+
+    def test_gcra_invalid_burst(self):
+        """
+        Test that a negative burst raises a ValueError.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '10',
+            'duration_seconds': '3600',
+            'limit_strategy': 'gcra',
+            'burst': '-1'
+        }
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception), "Invalid burst")
+
+    @patch('time.sleep')
+    def test_concurrent_update_is_retried(self, mock_sleep):
+        """
+        Test that an update racing with another process is re-read and retried.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed'
+        }
+        # Another process increments the record between our read and write
+        self.mock_session.storage.get.side_effect = [
+            b"2:999000",
+            versioned(b"3:999000"),
+            versioned(b"3:999000"),
+            versioned(b"3:999000"),
+        ]
+        expected_identifier = "user789"
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_called_once_with(
+            expected_identifier, versioned(b"4:999000", 2))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": expected_identifier,
+            "limit": 5,
+            "current_usage": 4,
+            "remaining_usage": 1,
+            'reset_seconds': 2600
+        })
+        mock_sleep.assert_called_once()
+
+    def test_sharded_fixed_window_sums_shards(self):
+        """
+        Test sharded fixed window adds the usage of all shards.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app',
+            'limit': '10',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'shard_count': '3',
+            'shard_by': 'user'
+        }
+        SHARD_COUNTS.invalidate("app123")
+        # The window started at 997200, shard 2 holds a count of an earlier window
+        records = {
+            "app123#0": versioned(b"2:997200"),
+            "app123#1": versioned(b"3:997200"),
+            "app123#2": versioned(b"5:993600"),
+        }
+        self.mock_session.storage.get.side_effect = records.__getitem__
+        with patch('tools.usage_limit.choose_shard', return_value=1) as mock_choose:
+            result = list(self.tool._invoke(tool_parameters))
+        mock_choose.assert_called_once_with("user789", 3, "user")
+        self.mock_session.storage.set.assert_called_once_with(
+            "app123#1", versioned(b"4:997200", 2))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": "app123",
+            "limit": 10,
+            "current_usage": 6,
+            "remaining_usage": 4,
+            'reset_seconds': 800
+        })
+        self.assertEqual(result, ["mocked_message"])
+
+    def test_sharded_fixed_window_limit_exceeded(self):
+        """
+        Test sharded fixed window denies once the shards add up to the limit.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'shard_count': '2',
+            'shard_by': 'random'
+        }
+        SHARD_COUNTS.invalidate("app123")
+        self.mock_session.storage.get.return_value = versioned(b"3:997200")
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.current_usage, 6)
+        self.assertEqual(context.exception.retry_after, 800)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_sharded_fixed_window_cached_aggregate(self):
+        """
+        Test sharded fixed window reuses the cached usage of the other shards.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app',
+            'limit': '10',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'shard_count': '4',
+            'shard_cache_seconds': '5'
+        }
+        SHARD_COUNTS.put("app123", 997200, {0: 1, 2: 2, 3: 3})
+        self.mock_session.storage.get.return_value = versioned(b"1:997200")
+        with patch('tools.usage_limit.choose_shard', return_value=1):
+            list(self.tool._invoke(tool_parameters))
+        # Only the own shard is read, once for the update and once for the version check
+        self.assertEqual(self.mock_session.storage.get.call_count, 2)
+        self.mock_session.storage.get.assert_called_with("app123#1")
+        self.tool.create_json_message.assert_called_with({
+            "identifier": "app123",
+            "limit": 10,
+            "current_usage": 8,
+            "remaining_usage": 2,
+            'reset_seconds': 800
+        })
+        SHARD_COUNTS.invalidate("app123")
+
+    def test_sharded_fixed_window_peek_keeps_aggregate(self):
+        """
+        Test that peeks at a shard leave the cached usage of the other shards unchanged.
+        """
+        SHARD_COUNTS.invalidate("app123")
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'shard_count': '2',
+            'shard_cache_seconds': '5'
+        }
+        with patch('tools.usage_limit.choose_shard', return_value=0):
+            for _ in range(4):
+                list(self.tool._invoke(tool_parameters))
+        with patch('tools.usage_limit.choose_shard', return_value=1):
+            for _ in range(3):
+                list(self.tool._invoke({**tool_parameters, 'mode': 'peek'}))
+        with patch('tools.usage_limit.choose_shard', return_value=0):
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"], 5)
+        SHARD_COUNTS.invalidate("app123")
+
+    def test_sharding_requires_fixed_strategy(self):
+        """
+        Test that sharding other strategies raises a ValueError.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding',
+            'shard_count': '4'
+        }
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception),
+                         "Sharding is only supported by the fixed strategy")
+
+    def test_record_cache_skips_storage_reads(self):
+        """
+        Test that a cached record is used by the next invocation for the same identifier.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'record_cache_seconds': '2'
+        }
+        RECORD_CACHE.clear()
+        self.mock_session.storage.get.return_value = b"2:999000"
+        list(self.tool._invoke(tool_parameters))
+        # The next invocation only reads the storage to check the version before writing
+        self.mock_session.storage.get.reset_mock()
+        self.mock_session.storage.get.return_value = versioned(b"3:999000")
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        tool.create_json_message = MagicMock()
+        list(tool._invoke(tool_parameters))
+        self.mock_session.storage.get.assert_called_once_with("user789")
+        self.mock_session.storage.set.assert_called_with(
+            "user789", versioned(b"4:999000", 2))
+        self.assertEqual(RECORD_CACHE.stats()["hits"], 1)
+        RECORD_CACHE.clear()
+
+    def test_record_cache_metrics(self):
+        """
+        Test that record cache hits and misses are counted in the collected metrics.
+        """
+        RECORD_CACHE.clear()
+        METRICS.clear()
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'limit_strategy': 'fixed',
+            'record_cache_seconds': '2',
+            'collect_metrics': True
+        }
+        for _ in range(3):
+            list(self.tool._invoke(tool_parameters))
+        counters = METRICS.snapshot()["counters"]
+        self.assertEqual(counters['usage_limit_record_cache_total{result="miss"}'], 1)
+        self.assertEqual(counters['usage_limit_record_cache_total{result="hit"}'], 2)
+        RECORD_CACHE.clear()
+        METRICS.clear()
+
+    def test_sliding_counter_denied_until_next_window(self):
+        """
+        Test sliding counter retry_after when the current count alone reaches the limit.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding-counter'
+        }
+        self.mock_session.storage.get.return_value = encode_counter(997200, 0, 5)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.retry_after, 800)
+
+    def test_deny_cache_skips_storage(self):
+        """
+        Test that a denied identifier is rejected from the deny cache until its usage decreases.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'deny_cache': True
+        }
+        DENY_CACHE.clear()
+        self.mock_session.storage.get.return_value = b"5:999000"
+        with self.assertRaises(UsageLimitExceededException):
+            list(self.tool._invoke(tool_parameters))
+
+        self.mock_session.storage.get.reset_mock()
+        self.mock_time.return_value = 1000001
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.current_usage, 5)
+        self.assertEqual(context.exception.retry_after, 2600)
+        self.mock_session.storage.get.assert_not_called()
+
+        # Once the window has expired the storage is read again
+        self.mock_time.return_value = 1002601
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        tool.create_json_message = MagicMock()
+        list(tool._invoke(tool_parameters))
+        self.mock_session.storage.get.assert_called_with("user789")
+        DENY_CACHE.clear()
+
+    def test_deny_cache_is_scoped_to_limit(self):
+        """
+        Test that a denial is not applied to invocations with another limit.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'deny_cache': True
+        }
+        DENY_CACHE.clear()
+        self.mock_session.storage.get.return_value = b"5:999000"
+        with self.assertRaises(UsageLimitExceededException):
+            list(self.tool._invoke(tool_parameters))
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        tool.create_json_message = MagicMock()
+        list(tool._invoke({**tool_parameters, 'limit': '10'}))
+        self.mock_session.storage.set.assert_called_with(
+            "user789", versioned(b"6:999000"))
+        DENY_CACHE.clear()
+
+    def test_deny_cache_disabled(self):
+        """
+        Test that denials are not remembered unless the deny cache is enabled.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed'
+        }
+        DENY_CACHE.clear()
+        self.mock_session.storage.get.return_value = b"5:999000"
+        with self.assertRaises(UsageLimitExceededException):
+            list(self.tool._invoke(tool_parameters))
+        self.assertIsNone(DENY_CACHE.get("user789", ("fixed", 5, 3600, None, None, None), 1000000))
+
+    def test_rules_all_allowed(self):
+        """
+        Test that every rule is counted when all rules allow the usage.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'rules': '[{"tracking_method": "app", "limit": 10, "limit_strategy": "fixed"}]'
+        }
+        records = {"user789": b"2:999000", "app123": b"6:999000"}
+        self.mock_session.storage.get.side_effect = records.get
+        list(self.tool._invoke(tool_parameters))
+        self.mock_session.storage.set.assert_any_call("user789", versioned(b"3:999000"))
+        self.mock_session.storage.set.assert_any_call("app123", versioned(b"7:999000"))
+        first_rule = {
+            "identifier": "user789",
+            "limit": 5,
+            "current_usage": 3,
+            "remaining_usage": 2,
+            'reset_seconds': 2600
+        }
+        self.tool.create_json_message.assert_called_with({
+            **first_rule,
+            "rules": [first_rule, {
+                "identifier": "app123",
+                "limit": 10,
+                "current_usage": 7,
+                "remaining_usage": 3,
+                'reset_seconds': 2600
+            }]
+        })
+
+    def test_rules_denied_by_one_rule(self):
+        """
+        Test that no rule is counted when one rule denies the usage.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'rules': [{"tracking_method": "app", "limit": 6, "limit_strategy": "fixed"}]
+        }
+        records = {"user789": b"2:999000", "app123": b"6:999000"}
+        self.mock_session.storage.get.side_effect = records.get
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.identifier, "app123")
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_invalid_rules(self):
+        """
+        Test that malformed rules raise a ValueError.
+        """
+        for rules in ('not json', '{"limit": 5}', '[{"tracking_method": "app"}]'):
+            with self.subTest(rules=rules):
+                tool_parameters = {
+                    'user_id': 'user789',
+                    'tracking_method': 'workspace-user',
+                    'limit': '5',
+                    'rules': rules
+                }
+                with self.assertRaises(ValueError) as context:
+                    list(self.tool._invoke(tool_parameters))
+                self.assertEqual(str(context.exception), "Invalid rules")
+
+    def test_rules_with_same_tracking_method(self):
+        """
+        Test that rules sharing an identifier raise a ValueError.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'rules': '[{"limit": 100, "duration_seconds": 86400}]'
+        }
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception), "Rules must use different tracking methods")
+
+    def test_rules_with_same_tracking_method_namespaced(self):
+        """
+        Test that namespaced keys keep rules with the same tracking method apart.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'key_format': 'namespaced',
+            'rules': '[{"limit": 100, "duration_seconds": 86400, "limit_strategy": "fixed"}]'
+        }
+        list(self.tool._invoke(tool_parameters))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual([rule["identifier"] for rule in message["rules"]],
+                         ["user789", "user789"])
+        self.assertTrue(self.mock_session.storage.exist("ul:fixed:3600:workspace-user:user789"))
+        self.assertTrue(self.mock_session.storage.exist("ul:fixed:86400:workspace-user:user789"))
+
+    def test_sqlite_backend(self):
+        """
+        Test that records are kept in the SQLite backend instead of the session storage.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "usage.sqlite3")
+            tool_parameters = {
+                'user_id': 'user789',
+                'tracking_method': 'workspace-user',
+                'limit': '5',
+                'duration_seconds': '3600',
+                'limit_strategy': 'fixed',
+                'storage_backend': 'sqlite',
+                'storage_path': path
+            }
+            for _ in range(2):
+                tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+                tool.create_json_message = MagicMock()
+                list(tool._invoke(tool_parameters))
+            backend = open_backend(self.mock_session, "sqlite", path)
+            self.assertEqual(backend.get("user789"), versioned(b"2:1000000", 2))
+            self.mock_session.storage.get.assert_not_called()
+            self.mock_session.storage.set.assert_not_called()
+            backend.close()
+
+    def test_invalid_storage_backend(self):
+        """
+        Test that an unknown storage backend raises a ValueError.
+        """
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'storage_backend': 'invalid'
+        }
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception), "Invalid storage backend")
+
+    @unittest.skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend_atomic_windows(self):
+        """
+        Test that fixed and sliding windows are updated by the Redis scripts.
+        """
+        redis = RedisStorage(fakeredis.FakeRedis())
+        for limit_strategy, record_type in (('fixed', b'string'), ('sliding', b'zset')):
+            with self.subTest(limit_strategy=limit_strategy):
+                tool_parameters = {
+                    'user_id': 'user789',
+                    'tracking_method': 'workspace-user',
+                    'limit': '1',
+                    'duration_seconds': '3600',
+                    'limit_strategy': limit_strategy,
+                    'storage_backend': 'redis'
+                }
+                redis.client.delete("user789")
+                with patch('tools.usage_limit.backend_from_parameters', return_value=redis):
+                    list(self.tool._invoke(tool_parameters))
+                    self.tool.create_json_message.assert_called_with({
+                        "identifier": "user789",
+                        "limit": 1,
+                        "current_usage": 1,
+                        "remaining_usage": 0,
+                        'reset_seconds': 3600
+                    })
+                    tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+                    with self.assertRaises(UsageLimitExceededException) as context:
+                        list(tool._invoke(tool_parameters))
+                self.assertEqual(context.exception.retry_after,
+                                 3601 if limit_strategy == 'fixed' else 3600)
+                self.assertEqual(redis.client.type("user789"), record_type)
+        self.mock_session.storage.get.assert_not_called()
+
+    @unittest.skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend_peek_and_commit(self):
+        """
+        Test that the Redis scripts evaluate peeks without counting and count commits.
+        """
+        redis = RedisStorage(fakeredis.FakeRedis())
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '1',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding',
+            'storage_backend': 'redis'
+        }
+        with patch('tools.usage_limit.backend_from_parameters', return_value=redis):
+            list(self.tool._invoke({**tool_parameters, 'mode': 'peek'}))
+            self.assertEqual(redis.client.zcard("user789"), 0)
+            reservation_id = self.tool.create_json_message.call_args[0][0]["reservation_id"]
+            for _ in range(2):
+                list(self.tool._invoke({**tool_parameters, 'mode': 'commit',
+                                        'reservation_id': reservation_id, 'cost': '2'}))
+        self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"], 2)
+        self.assertEqual(redis.client.zcard("user789"), 1)
+
+    @unittest.skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend_rules_share_records(self):
+        """
+        Test that invocations with and without rules count the same Redis records.
+        """
+        redis = RedisStorage(fakeredis.FakeRedis())
+        for limit_strategy in ('fixed', 'sliding'):
+            with self.subTest(limit_strategy=limit_strategy):
+                tool_parameters = {
+                    'user_id': f'user-{limit_strategy}',
+                    'tracking_method': 'workspace-user',
+                    'limit': '3',
+                    'duration_seconds': '3600',
+                    'limit_strategy': limit_strategy,
+                    'storage_backend': 'redis'
+                }
+                rules = [{"tracking_method": "app", "limit": 100,
+                          "limit_strategy": limit_strategy}]
+                allowed = 0
+                with patch('tools.usage_limit.backend_from_parameters', return_value=redis):
+                    for i in range(8):
+                        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+                        tool.create_json_message = MagicMock()
+                        try:
+                            list(tool._invoke(
+                                {**tool_parameters, 'rules': rules} if i % 2 else tool_parameters))
+                            allowed += 1
+                        except UsageLimitExceededException:
+                            pass
+                self.assertEqual(allowed, 3)
+
+    @unittest.skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend_rules_with_other_strategies(self):
+        """
+        Test that Redis rules combining script and stored strategies raise a ValueError.
+        """
+        redis = RedisStorage(fakeredis.FakeRedis())
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '3',
+            'limit_strategy': 'fixed',
+            'storage_backend': 'redis',
+            'rules': [{"tracking_method": "app", "limit": 100, "limit_strategy": "gcra"}]
+        }
+        with patch('tools.usage_limit.backend_from_parameters', return_value=redis):
+            with self.assertRaises(ValueError) as context:
+                list(self.tool._invoke(tool_parameters))
+        self.assertEqual(str(context.exception), "Rules on the Redis backend cannot combine "
+                         "fixed or sliding windows with other strategies")
+
+    @patch('tools.expiry.INDEX_SHARDS', 1)
+    @patch('tools.expiry.SWEEP_INTERVAL', 1)
+    def test_record_expiry_sweeps_stale_records(self):
+        """
+        Test that records are deleted by a later invocation once they expired.
+        """
+        EXPIRY.clear()
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '60',
+            'limit_strategy': 'fixed',
+            'record_expiry': True
+        }
+        list(self.tool._invoke({**tool_parameters, 'user_id': 'user1'}))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual((message["expired_records"], message["reclaimed_bytes"]), (0, 0))
+
+        # The record is kept for one lifetime after it expired
+        self.mock_time.return_value = 1000000 + 2 * 61 + 1
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        tool.create_json_message = MagicMock()
+        list(tool._invoke({**tool_parameters, 'user_id': 'user2'}))
+        message = tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["expired_records"], 1)
+        self.assertEqual(message["reclaimed_bytes"], len(versioned(b"1:1000000")))
+        self.assertFalse(self.mock_session.storage.exist("user1"))
+        self.assertTrue(self.mock_session.storage.exist("user2"))
+        self.assertEqual(EXPIRY.stats()["expired_records"], 1)
+        EXPIRY.clear()
+
+    @patch('tools.expiry.INDEX_SHARDS', 1)
+    @patch('tools.expiry.SWEEP_INTERVAL', 1)
+    def test_record_expiry_keeps_valid_reservations(self):
+        """
+        Test that committed reservations are kept until they can no longer be committed.
+        """
+        EXPIRY.clear()
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user1',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '60',
+            'limit_strategy': 'fixed',
+            'record_expiry': True
+        }
+        list(self.tool._invoke({**tool_parameters, 'mode': 'peek', 'reservation_seconds': '3600'}))
+        reservation_id = self.tool.create_json_message.call_args[0][0]["reservation_id"]
+        list(self.tool._invoke({**tool_parameters, 'mode': 'commit',
+                                'reservation_id': reservation_id}))
+
+        # The usage record expired, but the reservation can still be committed
+        self.mock_time.return_value = 1000000 + 2 * 61 + 1
+        tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+        tool.create_json_message = MagicMock()
+        list(tool._invoke({**tool_parameters, 'user_id': 'user2'}))
+        self.assertFalse(self.mock_session.storage.exist("user1"))
+        self.assertTrue(self.mock_session.storage.exist(reservations_key("user1")))
+        list(tool._invoke({**tool_parameters, 'mode': 'commit', 'reservation_id': reservation_id}))
+        self.assertFalse(tool.create_json_message.call_args[0][0]["committed"])
+        EXPIRY.clear()
+
+    def test_index_identifiers(self):
+        """
+        Test that written records are indexed so the Reset Usage tool can reset them.
+        """
+        IDENTIFIERS.clear()
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'tracking_method': 'app-user',
+            'limit': '5',
+            'index_identifiers': True
+        }
+        for user in ('user1', 'user2'):
+            list(self.tool._invoke({**tool_parameters, 'user_id': user}))
+
+        deleted, _, remaining = IDENTIFIERS.reset(
+            self.mock_session.storage, 'app-user', 'app123', 1000000)
+        self.assertEqual((deleted, remaining), (2, 0))
+        self.assertFalse(self.mock_session.storage.exist('app123user1'))
+        self.assertFalse(self.mock_session.storage.exist('app123user2'))
+        IDENTIFIERS.clear()
+
+    def test_collect_metrics(self):
+        """
+        Test that decisions, denial reasons and storage operations are counted.
+        """
+        METRICS.clear()
+        DENY_CACHE.clear()
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app-user',
+            'limit': '1',
+            'limit_strategy': 'fixed',
+            'deny_cache': True
+        }
+        list(self.tool._invoke(tool_parameters))
+        self.assertEqual(METRICS.snapshot(), {"counters": {}, "histograms": {}})
+
+        tool_parameters['collect_metrics'] = True
+        for _ in range(2):
+            with self.assertRaises(UsageLimitExceededException):
+                list(self.tool._invoke(tool_parameters))
+        with self.assertRaises(UsageLimitExceededException):
+            list(self.tool._invoke({**tool_parameters, 'user_id': 'user1', 'cost': '2'}))
+        list(self.tool._invoke({**tool_parameters, 'user_id': 'user2'}))
+
+        snapshot = METRICS.snapshot()
+        self.assertEqual(snapshot["counters"], {
+            'usage_limit_decisions_total{decision="allowed",mode="consume",strategy="fixed",'
+            'tracking_method="app-user"}': 1,
+            'usage_limit_decisions_total{decision="denied",mode="consume",strategy="fixed",'
+            'tracking_method="app-user"}': 3,
+            'usage_limit_denials_total{reason="cached",tracking_method="app-user"}': 1,
+            'usage_limit_denials_total{reason="cost",tracking_method="app-user"}': 1,
+            'usage_limit_denials_total{reason="limit",tracking_method="app-user"}': 1,
+        })
+        histograms = snapshot["histograms"]
+        self.assertEqual(histograms['usage_limit_strategy_seconds{strategy="fixed"}']["count"], 2)
+        self.assertEqual(histograms['usage_limit_storage_seconds{operation="set"}']["count"], 1)
+        self.assertEqual(histograms['usage_limit_record_bytes{operation="set"}']["count"], 1)
+        METRICS.clear()
+        DENY_CACHE.clear()
+
+    def test_virtual_clock(self):
+        """
+        Test that usage is evaluated at the time of the clock of the tool.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        clock = VirtualClock(2000000)
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '1',
+            'duration_seconds': '60'
+        }
+        self.tool.clock = clock
+        list(self.tool._invoke(tool_parameters))
+        clock.advance(59)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.retry_after, 1)
+        clock.advance(1)
+        list(self.tool._invoke(tool_parameters))
+        self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"], 1)
+
+    def test_millisecond_sliding_window(self):
+        """
+        Test that sliding windows in milliseconds time usages to the millisecond.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        clock = VirtualClock(2000000.5)
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '2',
+            'duration_milliseconds': '500'
+        }
+        self.tool.clock = clock
+        list(self.tool._invoke(tool_parameters))
+        clock.advance(0.25)
+        list(self.tool._invoke(tool_parameters))
+        self.tool.create_json_message.assert_called_with({
+            "identifier": "user789",
+            "limit": 2,
+            "current_usage": 2,
+            "remaining_usage": 0,
+            'reset_seconds': 0.25
+        })
+        clock.advance(0.125)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.retry_after, 0.125)
+        # A second window would still count the first usage
+        clock.advance(0.125)
+        list(self.tool._invoke(tool_parameters))
+        self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"], 2)
+
+    def test_millisecond_fixed_window(self):
+        """
+        Test that fixed windows in milliseconds reset once their duration has passed.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        clock = VirtualClock(2000000)
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '1',
+            'duration_milliseconds': '250',
+            'limit_strategy': 'fixed'
+        }
+        self.tool.clock = clock
+        list(self.tool._invoke(tool_parameters))
+        clock.advance(0.1)
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.retry_after, 0.151)
+        clock.advance(0.151)
+        list(self.tool._invoke(tool_parameters))
+        self.assertEqual(self.tool.create_json_message.call_args[0][0]["reset_seconds"], 0.25)
+
+    def test_millisecond_window_keys(self):
+        """
+        Test that millisecond windows are part of namespaced keys.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        list(self.tool._invoke({
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_milliseconds': '500',
+            'key_format': 'namespaced'
+        }))
+        self.assertTrue(self.mock_session.storage.exist(
+            "ul:sliding:500ms:workspace-user:user789"))
+
+    def test_invalid_millisecond_window(self):
+        """
+        Test that millisecond windows reject unsupported options.
+        """
+        base_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_milliseconds': '500'
+        }
+        for options, message in (
+                ({'duration_milliseconds': '0'}, "Invalid duration milliseconds"),
+                ({'duration_milliseconds': '86400001'}, "Invalid duration milliseconds"),
+                ({'duration_milliseconds': 'soon'}, "Invalid duration milliseconds"),
+                ({'limit_strategy': 'gcra'},
+                 "Millisecond windows are only supported by the fixed and sliding strategies"),
+                ({'limit_strategy': 'fixed', 'shard_count': '2'},
+                 "Sharding is not supported by millisecond windows"),
+                ({'cost': '2'},
+                 "Weighted usage is not supported by millisecond sliding windows")):
+            with self.subTest(options=options):
+                with self.assertRaises(ValueError) as context:
+                    list(self.tool._invoke({**base_parameters, **options}))
+                self.assertEqual(str(context.exception), message)
+
+    @unittest.skipUnless(fakeredis, "fakeredis is not installed")
+    def test_redis_backend_millisecond_windows(self):
+        """
+        Test that the Redis scripts count millisecond windows.
+        """
+        redis = RedisStorage(fakeredis.FakeRedis())
+        clock = VirtualClock(2000000)
+        self.tool.clock = clock
+        for limit_strategy in ('fixed', 'sliding'):
+            with self.subTest(limit_strategy=limit_strategy):
+                clock.advance(1)
+                tool_parameters = {
+                    'user_id': f'user-{limit_strategy}',
+                    'tracking_method': 'workspace-user',
+                    'limit': '1',
+                    'duration_milliseconds': '200',
+                    'limit_strategy': limit_strategy,
+                    'storage_backend': 'redis'
+                }
+                with patch('tools.usage_limit.backend_from_parameters', return_value=redis):
+                    list(self.tool._invoke(tool_parameters))
+                    self.assertEqual(
+                        self.tool.create_json_message.call_args[0][0]["reset_seconds"], 0.2)
+                    clock.advance(0.15)
+                    with self.assertRaises(UsageLimitExceededException):
+                        list(self.tool._invoke(tool_parameters))
+                    clock.advance(0.06)
+                    list(self.tool._invoke(tool_parameters))
+                self.assertGreater(redis.client.pttl(f'user-{limit_strategy}'), 0)
+
+    def _admitted(self, queue: WriteBehindQueue, messages: int, **options) -> int:
+        """
+        Send messages of one user with a fixed limit of 3 through a plugin process with its
+        own write-behind queue, and return the number of messages allowed.
+        """
+        allowed = 0
+        with patch('tools.usage_limit.WRITE_BEHIND', queue):
+            for _ in range(messages):
+                tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+                tool.create_json_message = MagicMock()
+                try:
+                    list(tool._invoke({
+                        'user_id': 'user789',
+                        'tracking_method': 'workspace-user',
+                        'limit': '3',
+                        'limit_strategy': 'fixed',
+                        **options
+                    }))
+                    allowed += 1
+                except UsageLimitExceededException:
+                    pass
+        return allowed
+
+    def test_write_behind_decisions_match_synchronous_writes(self):
+        """
+        Test that write-behind reports the same decisions within one plugin process and
+        merges them into one write.
+        """
+        queue = WriteBehindQueue()
+        self.mock_session.storage = InMemoryStorage()
+        self.assertEqual(self._admitted(queue, 5, write_behind_seconds='60'), 3)
+        self.assertEqual(self.mock_session.storage.calls["set"], 0)
+        self.assertEqual(queue.drain(), 0)
+        self.assertEqual(self.mock_session.storage.get("user789"), versioned(b"3:1000000"))
+        self.assertEqual(self.mock_session.storage.calls["set"], 1)
+
+        synchronous = InMemoryStorage()
+        self.mock_session.storage = synchronous
+        self.assertEqual(self._admitted(WriteBehindQueue(), 5), 3)
+        self.assertEqual(synchronous.calls["set"], 3)
+
+    def test_write_behind_drift_between_processes(self):
+        """
+        Test the worst case drift of write-behind between plugin processes: within one
+        delay, every process admits up to the limit against the stored record, and the
+        flush of all but the first process is dropped.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        processes = [WriteBehindQueue() for _ in range(3)]
+        admitted = [self._admitted(queue, 5, write_behind_seconds='60') for queue in processes]
+        self.assertEqual(admitted, [3, 3, 3])
+        for queue in processes:
+            queue.drain()
+        self.assertEqual([queue.stats()["conflicts"] for queue in processes], [0, 1, 1])
+        self.assertEqual(self.mock_session.storage.get("user789"), versioned(b"3:1000000"))
+        # Once flushed, every process sees the stored usage again
+        self.assertEqual(sum(self._admitted(queue, 1) for queue in processes), 0)
+
+    def test_invalid_write_behind_seconds(self):
+        """
+        Test that negative write-behind delays are rejected.
+        """
+        with self.assertRaises(ValueError) as context:
+            self._admitted(WriteBehindQueue(), 1, write_behind_seconds='-1')
+        self.assertEqual(str(context.exception), "Invalid write-behind seconds")
+
+    def _fill_storage(self, quota_accounting: bool) -> list[int]:
+        """
+        Send messages of 40 users with a sliding limit of 50 until every user is denied,
+        against a plugin storage with a 4 kB quota.
+
+        Returns the number of messages allowed per user.
+        """
+        QUOTA.clear()
+        self.mock_session.storage = InMemoryStorage(max_bytes=4096)
+        allowed = [0] * 40
+        for message in range(51):
+            self.mock_time.return_value = 1000000 + message
+            for user in range(40):
+                tool = UsageLimitTool(runtime=self.mock_runtime, session=self.mock_session)
+                tool.create_json_message = MagicMock()
+                try:
+                    list(tool._invoke({
+                        'user_id': f'user{user}',
+                        'tracking_method': 'app-user',
+                        'limit': '50',
+                        'duration_seconds': '3600',
+                        'limit_strategy': 'sliding',
+                        'quota_accounting': quota_accounting
+                    }))
+                    allowed[user] += 1
+                except UsageLimitExceededException:
+                    pass
+        return allowed
+
+    @patch.object(QUOTA, 'capacity', 4096)
+    def test_quota_accounting_compacts_records_under_pressure(self):
+        """
+        Test that sliding windows switch to counters near the quota and keep enforcing limits.
+        """
+        self.assertEqual(self._fill_storage(quota_accounting=True), [50] * 40)
+        stats = QUOTA.stats()
+        # Compacted records stay counters after the pressure ended
+        self.assertEqual(self.mock_session.storage.get("app123user0"),
+                         versioned(encode_counter(997200, 0, 50), 50))
+        self.assertLessEqual(self.mock_session.storage.stored_bytes, 4096)
+        self.assertLessEqual(abs(stats["used_bytes"] - self.mock_session.storage.stored_bytes),
+                             len(self.mock_session.storage.get("usage-limit-quota")))
+        QUOTA.clear()
+
+    def test_quota_accounting_counts_index_writes(self):
+        """
+        Test that the writes of the expiry and identifier indexes are accounted for.
+        """
+        QUOTA.clear()
+        EXPIRY.clear()
+        IDENTIFIERS.clear()
+        self.mock_session.storage = InMemoryStorage()
+        for user in ('user1', 'user2'):
+            list(self.tool._invoke({
+                'user_id': user,
+                'tracking_method': 'app-user',
+                'limit': '5',
+                'quota_accounting': True,
+                'record_expiry': True,
+                'index_identifiers': True
+            }))
+        self.assertEqual(QUOTA.stats()["used_bytes"], self.mock_session.storage.stored_bytes)
+        QUOTA.clear()
+        EXPIRY.clear()
+        IDENTIFIERS.clear()
+
+    def test_storage_quota_exceeded_without_accounting(self):
+        """
+        Test that sliding windows fail to be stored once the quota is exhausted.
+        """
+        with self.assertRaises(ValueError):
+            self._fill_storage(quota_accounting=False)
+
+    def test_namespaced_strategies_do_not_share_records(self):
+        """
+        Test that a fixed and a sliding node on the same identifier keep separate records.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        for strategy in ('fixed', 'sliding'):
+            for _ in range(2):
+                list(self.tool._invoke({
+                    'user_id': 'user789',
+                    'tracking_method': 'app-user',
+                    'limit': '5',
+                    'duration_seconds': '3600',
+                    'limit_strategy': strategy,
+                    'key_format': 'namespaced'
+                }))
+                message = self.tool.create_json_message.call_args[0][0]
+            self.assertEqual(message["current_usage"], 2)
+        self.assertFalse(self.mock_session.storage.exist("app123user789"))
+
+    def test_hashed_key_reports_identifier(self):
+        """
+        Test that output and denials name the identifier instead of its hashed key.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        tool_parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'app-user',
+            'limit': '1',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'key_format': 'hashed'
+        }
+        list(self.tool._invoke(tool_parameters))
+        self.assertEqual(
+            self.tool.create_json_message.call_args[0][0]["identifier"], "app123user789")
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke(tool_parameters))
+        self.assertEqual(context.exception.identifier, "app123user789")
+
+    def test_tiers_count_all_windows_in_one_record(self):
+        """
+        Test that all windows are read and written once and the binding window is reported.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        self.mock_session.storage.set("user789", versioned(encode_tiers({
+            60: (999960, 0, 5),
+            86400: (950400, 0, 498),
+        })))
+        self.mock_session.storage.calls.clear()
+        list(self.tool._invoke({
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '20',
+            'duration_seconds': '60',
+            'limit_strategy': 'sliding-counter',
+            'tiers': '500/86400, 5000/2592000'
+        }))
+        # One read, one version check before the write and one write
+        self.assertEqual(self.mock_session.storage.calls, {"get": 2, "set": 1})
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["limit"], 500)
+        self.assertEqual(message["duration_seconds"], 86400)
+        self.assertEqual(message["current_usage"], 499)
+        self.assertEqual(message["remaining_usage"], 1)
+        self.assertEqual([tier["current_usage"] for tier in message["tiers"]], [6, 499, 1])
+        self.assertEqual(decode_tiers(decode_versioned(self.mock_session.storage.get("user789"))[1]), {
+            60: (999960, 0, 6),
+            86400: (950400, 0, 499),
+            2592000: (0, 0, 1),
+        })
+
+    def test_tiers_limit_exceeded(self):
+        """
+        Test that a usage denied by one window is counted in none of them.
+        """
+        record = versioned(encode_tiers({60: (999960, 0, 5), 86400: (950400, 0, 500)}))
+        self.mock_session.storage.get.return_value = record
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke({
+                'user_id': 'user789',
+                'tracking_method': 'workspace-user',
+                'limit': '20',
+                'duration_seconds': '60',
+                'limit_strategy': 'sliding-counter',
+                'tiers': '500/86400'
+            }))
+        self.assertEqual(context.exception.limit, 500)
+        # The next day window starts at 1036800
+        self.assertEqual(context.exception.retry_after, 36800)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_invalid_tiers(self):
+        """
+        Test that malformed tiers and tiers of other strategies raise a ValueError.
+        """
+        for strategy, tiers, error in (
+            ('sliding-counter', '500', "Invalid tiers"),
+            ('sliding-counter', '500/60', "Invalid tiers"),
+            ('sliding-counter', '0/86400', "Invalid tiers"),
+            ('fixed', '500/86400', "Tiers are only supported by the sliding-counter strategy"),
+        ):
+            with self.subTest(strategy=strategy, tiers=tiers):
+                with self.assertRaises(ValueError) as context:
+                    list(self.tool._invoke({
+                        'user_id': 'user789',
+                        'tracking_method': 'workspace-user',
+                        'limit': '20',
+                        'duration_seconds': '60',
+                        'limit_strategy': strategy,
+                        'tiers': tiers
+                    }))
+                self.assertEqual(str(context.exception), error)
+
+    def test_fixed_window_cost(self):
+        """
+        Test that the fixed window counts the cost of a usage.
+        """
+        self.mock_session.storage.get.return_value = b"2:999000"
+        list(self.tool._invoke({
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '100',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'cost': '40'
+        }))
+        self.mock_session.storage.set.assert_called_with("user789", versioned(b"42:999000"))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 42)
+        self.assertEqual(message["remaining_usage"], 58)
+
+    def test_sliding_window_cost_merges_same_second(self):
+        """
+        Test that weighted usages convert the record and merge usages of the same second.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        self.mock_session.storage.set(
+            "user789", versioned(encode_timestamps([996000, 999000, 1000000])))
+        parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '100',
+            'duration_seconds': '3600',
+            'limit_strategy': 'sliding'
+        }
+        list(self.tool._invoke({**parameters, 'cost': '30'}))
+        list(self.tool._invoke(parameters))
+        record = decode_versioned(self.mock_session.storage.get("user789"))[1]
+        self.assertEqual(decode_weighted_timestamps(record), [(999000, 1), (1000000, 32)])
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 33)
+        self.assertEqual(message["reset_seconds"], 2600)
+
+    def test_sliding_window_cost_limit_exceeded(self):
+        """
+        Test that a weighted denial waits until enough of the oldest usages leave the window.
+        """
+        self.mock_session.storage.get.return_value = versioned(
+            encode_weighted_timestamps([(997000, 20), (998000, 50), (999000, 20)]))
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke({
+                'user_id': 'user789',
+                'tracking_method': 'workspace-user',
+                'limit': '100',
+                'duration_seconds': '3600',
+                'limit_strategy': 'sliding',
+                'cost': '40'
+            }))
+        self.assertEqual(context.exception.current_usage, 90)
+        # 20 + 40 fits once the first two usages left the window at 1001600
+        self.assertEqual(context.exception.retry_after, 1600)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_counter_and_buckets_cost(self):
+        """
+        Test that the counter strategies deny a usage whose cost does not fit.
+        """
+        for strategy, record in (
+            ('sliding-counter', encode_counter(997200, 0, 8)),
+            ('sliding-buckets', encode_buckets(600, 997200, [0, 0, 0, 0, 0, 8])),
+        ):
+            with self.subTest(strategy=strategy):
+                self.mock_session.storage.get.return_value = versioned(record)
+                parameters = {
+                    'user_id': 'user789',
+                    'tracking_method': 'workspace-user',
+                    'limit': '10',
+                    'duration_seconds': '3600',
+                    'limit_strategy': strategy,
+                    'bucket_count': '6'
+                }
+                list(self.tool._invoke({**parameters, 'cost': '2'}))
+                self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"], 10)
+                with self.assertRaises(UsageLimitExceededException):
+                    list(self.tool._invoke({**parameters, 'cost': '3'}))
+
+    def test_costs_beyond_32_bits(self):
+        """
+        Test that usages whose summed cost does not fit in 32 bits are counted exactly.
+        """
+        for options in ({'limit_strategy': 'sliding'},
+                        {'limit_strategy': 'sliding-buckets', 'bucket_count': '6'},
+                        {'limit_strategy': 'sliding-counter', 'tiers': '20000000000/86400'}):
+            with self.subTest(**options):
+                self.mock_session.storage = InMemoryStorage()
+                parameters = {
+                    'user_id': 'user789',
+                    'tracking_method': 'workspace-user',
+                    'limit': '10000000000',
+                    'duration_seconds': '3600',
+                    'cost': '3000000000',
+                    **options
+                }
+                for _ in range(3):
+                    list(self.tool._invoke(parameters))
+                self.assertEqual(self.tool.create_json_message.call_args[0][0]["current_usage"],
+                                 9000000000)
+                with self.assertRaises(UsageLimitExceededException):
+                    list(self.tool._invoke(parameters))
+
+    def test_gcra_cost(self):
+        """
+        Test that a usage of cost n takes n emission intervals of the burst.
+        """
+        self.mock_session.storage.get.side_effect = Exception("Not found")
+        parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '10',
+            'duration_seconds': '10',
+            'limit_strategy': 'gcra',
+            'burst': '5'
+        }
+        list(self.tool._invoke({**parameters, 'cost': '4'}))
+        self.mock_session.storage.set.assert_called_with(
+            "user789", versioned(encode_arrival_time(1_000_004_000_000)))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 4)
+        self.assertEqual(message["remaining_usage"], 1)
+        self.mock_session.storage.get.side_effect = None
+        self.mock_session.storage.get.return_value = versioned(encode_arrival_time(1_000_004_000_000))
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke({**parameters, 'cost': '2'}))
+        self.assertEqual(context.exception.retry_after, 1)
+
+    def test_cost_above_limit(self):
+        """
+        Test that a usage costing more than the limit is denied without a retry time.
+        """
+        with self.assertRaises(UsageLimitExceededException) as context:
+            list(self.tool._invoke({
+                'user_id': 'user789',
+                'tracking_method': 'workspace-user',
+                'limit': '10',
+                'limit_strategy': 'fixed',
+                'cost': '11'
+            }))
+        self.assertEqual(context.exception.current_usage, 11)
+        self.assertFalse(context.exception.retry_after)
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_invalid_cost(self):
+        """
+        Test that a cost below one raises a ValueError.
+        """
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke({
+                'user_id': 'user789',
+                'tracking_method': 'workspace-user',
+                'limit': '10',
+                'cost': '0'
+            }))
+        self.assertEqual(str(context.exception), "Invalid cost")
+
+    def test_peek_does_not_write(self):
+        """
+        Test that peeking reports the usage and a reservation without writing storage.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        self.mock_session.storage.set("user789", versioned(b"2:999000"))
+        self.mock_session.storage.calls.clear()
+        list(self.tool._invoke({
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'mode': 'peek'
+        }))
+        self.assertEqual(self.mock_session.storage.calls, {"get": 1})
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 2)
+        self.assertEqual(message["remaining_usage"], 3)
+        self.assertEqual(message["reset_seconds"], 2600)
+        self.assertTrue(message["allowed"])
+        self.assertRegex(message["reservation_id"], r"^1000600\.[0-9a-f]{32}$")
+
+    def test_peek_every_strategy(self):
+        """
+        Test that every strategy reports the usage before this usage when peeking.
+        """
+        for strategy in ('fixed', 'sliding', 'sliding-counter', 'sliding-buckets', 'gcra'):
+            with self.subTest(strategy=strategy):
+                self.mock_session.storage = InMemoryStorage()
+                parameters = {
+                    'user_id': 'user789',
+                    'tracking_method': 'workspace-user',
+                    'limit': '5',
+                    'duration_seconds': '3600',
+                    'limit_strategy': strategy
+                }
+                self.tool.clock = VirtualClock(2000000)
+                list(self.tool._invoke({**parameters, 'mode': 'peek'}))
+                message = self.tool.create_json_message.call_args[0][0]
+                self.assertEqual((message["current_usage"], message["reset_seconds"]), (0, 0))
+                list(self.tool._invoke(parameters))
+                consumed = self.tool.create_json_message.call_args[0][0]
+                list(self.tool._invoke({**parameters, 'mode': 'peek', 'cost': '3'}))
+                message = self.tool.create_json_message.call_args[0][0]
+                self.assertEqual(message["current_usage"], 1)
+                self.assertEqual(message["remaining_usage"], 4)
+                self.assertTrue(message["allowed"])
+                # The reset is the one of the current usage, not of the peeked usage
+                self.assertEqual(message["reset_seconds"], consumed["reset_seconds"])
+                self.tool.clock.advance(600)
+                list(self.tool._invoke(parameters))
+                consumed = self.tool.create_json_message.call_args[0][0]
+                list(self.tool._invoke({**parameters, 'mode': 'peek'}))
+                message = self.tool.create_json_message.call_args[0][0]
+                self.assertEqual(message["current_usage"], consumed["current_usage"])
+                self.assertEqual(message["reset_seconds"], consumed["reset_seconds"])
+
+    def test_peek_denied(self):
+        """
+        Test that a peek that would be denied reports the wait instead of raising.
+        """
+        self.mock_session.storage.get.return_value = versioned(b"5:999000")
+        parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed',
+            'mode': 'peek'
+        }
+        list(self.tool._invoke(parameters))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 5)
+        self.assertFalse(message["allowed"])
+        self.assertEqual(message["retry_after"], 2601)
+        self.assertNotIn("reservation_id", message)
+        list(self.tool._invoke({**parameters, 'cost': '6'}))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertFalse(message["allowed"])
+        self.assertIsNone(message["retry_after"])
+        self.mock_session.storage.set.assert_not_called()
+
+    def test_commit_counts_usage_beyond_limit(self):
+        """
+        Test that a commit counts its cost even if the usage exceeds the limit, and only once.
+        """
+        self.mock_session.storage = InMemoryStorage()
+        self.mock_session.storage.set("user789", versioned(b"4:999000"))
+        parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'duration_seconds': '3600',
+            'limit_strategy': 'fixed'
+        }
+        list(self.tool._invoke({**parameters, 'mode': 'peek'}))
+        reservation_id = self.tool.create_json_message.call_args[0][0]["reservation_id"]
+        commit = {**parameters, 'mode': 'commit', 'reservation_id': reservation_id, 'cost': '3'}
+        list(self.tool._invoke(commit))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertEqual(message["current_usage"], 7)
+        self.assertEqual(message["remaining_usage"], 0)
+        self.assertTrue(message["committed"])
+        list(self.tool._invoke(commit))
+        message = self.tool.create_json_message.call_args[0][0]
+        self.assertFalse(message["committed"])
+        self.assertEqual(message["current_usage"], 7)
+        self.assertEqual(decode_versioned(self.mock_session.storage.get("user789"))[1],
+                         b"7:999000")
+
+    def test_invalid_commit(self):
+        """
+        Test that commits without a valid reservation raise a ValueError.
+        """
+        parameters = {
+            'user_id': 'user789',
+            'tracking_method': 'workspace-user',
+            'limit': '5',
+            'mode': 'commit'
+        }
+        self.mock_session.storage.get.side_effect = Exception("Not found")
+        for reservation_id, error in (
+            (None, "Missing reservation ID"),
+            ('invalid', "Invalid reservation ID"),
+            ('999999.abc', "Reservation expired"),
+        ):
+            with self.subTest(reservation_id=reservation_id):
+                with self.assertRaises(ValueError) as context:
+                    list(self.tool._invoke({**parameters, 'reservation_id': reservation_id}))
+                self.assertEqual(str(context.exception), error)
+        with self.assertRaises(ValueError) as context:
+            list(self.tool._invoke({**parameters, 'mode': 'invalid'}))
+        self.assertEqual(str(context.exception), "Invalid mode")
+        self.mock_session.storage.set.assert_not_called()
+
     def test_invalid_tracking_method(self):
         """
         Test invoking with an invalid tracking method.
@@ -223,7 +1986,7 @@ class TestUsageLimitTool(unittest.TestCase):
         result = list(self.tool._invoke(tool_parameters))
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -250,7 +2013,7 @@ class TestUsageLimitTool(unittest.TestCase):
         result = list(self.tool._invoke(tool_parameters))
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -277,7 +2040,7 @@ class TestUsageLimitTool(unittest.TestCase):
         result = list(self.tool._invoke(tool_parameters))
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -304,7 +2067,7 @@ class TestUsageLimitTool(unittest.TestCase):
         result = list(self.tool._invoke(tool_parameters))
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -334,7 +2097,7 @@ class TestUsageLimitTool(unittest.TestCase):
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -359,13 +2122,12 @@ class TestUsageLimitTool(unittest.TestCase):
         self.mock_session.storage.get.return_value = b"996000,997000,999500,999900"
         expected_identifier = "user789"
         expected_timestamps = [997000, 999500, 999900, 1000000]
-        expected_timestamps_str = ','.join(
-            map(str, expected_timestamps)).encode()
+        expected_record = encode_timestamps(expected_timestamps)
         result = list(self.tool._invoke(tool_parameters))
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_timestamps_str)
+            expected_identifier, versioned(expected_record))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -393,7 +2155,7 @@ class TestUsageLimitTool(unittest.TestCase):
         result = list(self.tool._invoke(tool_parameters))
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -423,7 +2185,7 @@ class TestUsageLimitTool(unittest.TestCase):
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         expected_usage = f"1:{1000000}".encode()
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
 
     def test_default_limit_strategy(self):
         """
@@ -439,13 +2201,12 @@ class TestUsageLimitTool(unittest.TestCase):
         self.mock_session.storage.get.return_value = b"999000,999500,999900"
         expected_identifier = "user789"
         expected_timestamps = [999000, 999500, 999900, 1000000]
-        expected_timestamps_str = ','.join(
-            map(str, expected_timestamps)).encode()
+        expected_record = encode_timestamps(expected_timestamps)
         result = list(self.tool._invoke(tool_parameters))
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_timestamps_str)
+            expected_identifier, versioned(expected_record))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
@@ -473,7 +2234,7 @@ class TestUsageLimitTool(unittest.TestCase):
         # Assertions
         self.mock_session.storage.get.assert_called_with(expected_identifier)
         self.mock_session.storage.set.assert_called_with(
-            expected_identifier, expected_usage)
+            expected_identifier, versioned(expected_usage))
         self.tool.create_json_message.assert_called_with({
             "identifier": expected_identifier,
             "limit": 5,
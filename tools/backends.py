@@ -0,0 +1,556 @@
+# pylint: disable=missing-module-docstring
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Protocol
+
+from tools.encoding import decode_versioned
+
+# Names of the storage backends accepted by the `storage_backend` tool parameter.
+STORAGE_BACKENDS = ("session", "sqlite", "redis")
+# Database file of the "sqlite" backend, relative to the plugin working directory.
+DEFAULT_SQLITE_PATH = "usage_limit.sqlite3"
+
+
+def _record_version(record: bytes) -> int:
+    """Return the version stamp of a stored record, 0 for unreadable records."""
+    try:
+        return decode_versioned(record)[0]
+    # pylint: disable=broad-except
+    except Exception:
+        return 0
+
+
+class StorageBackend(Protocol):
+    """
+    Key-value store holding the usage records.
+
+    This is the interface of the Dify plugin session storage, which is the default
+    backend. `get` and `delete` raise an exception if the key does not exist.
+    """
+
+    def get(self, key: str) -> bytes:
+        """Return the value of `key`."""
+
+    def set(self, key: str, val: bytes) -> None:
+        """Store `val` under `key`."""
+
+    def delete(self, key: str) -> None:
+        """Delete `key`."""
+
+    def exist(self, key: str) -> bool:
+        """Return whether `key` exists."""
+
+
+class SQLiteStorage:
+    """
+    Usage records in a SQLite database on the plugin host.
+
+    Unlike the session storage, reads and writes do not leave the plugin process and
+    are not counted against the plugin storage quota. The database runs in WAL mode,
+    so plugin processes on the same host can share the file, with readers never
+    blocked by a writer. Records do not survive a reinstallation of the plugin on
+    another host.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # Durable up to the last checkpoint, which is enough for usage counters
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS usage_records (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        # The connection is shared by all threads of the plugin process
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes:
+        """Return the value of `key`, raising `KeyError` if it does not exist."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM usage_records WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def set(self, key: str, val: bytes) -> None:
+        """Store `val` under `key`."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO usage_records (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, bytes(val)))
+
+    def delete(self, key: str) -> None:
+        """Delete `key`, raising `KeyError` if it does not exist."""
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM usage_records WHERE key = ?", (key,)).rowcount
+        if not deleted:
+            raise KeyError(key)
+
+    def exist(self, key: str) -> bool:
+        """Return whether `key` exists."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM usage_records WHERE key = ?", (key,)).fetchone() is not None
+
+    def compare_and_set(self, records: dict[str, tuple[int, bytes]]) -> dict[str, int]:
+        """
+        Store every record if the stored record of each key carries the expected version
+        stamp, or none of them, in one transaction.
+
+        Parameters:
+        - `records`: The expected version stamp and the new value of every key.
+
+        Returns:
+        - `conflicts`: The version stamp found under every key that did not carry the
+           expected one. Nothing was written if it is not empty.
+        """
+        with self._lock:
+            # Taking the write lock up front keeps other processes out between the
+            # version check and the write
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                conflicts = {}
+                for key, (expected_version, _) in records.items():
+                    row = self._connection.execute(
+                        "SELECT value FROM usage_records WHERE key = ?", (key,)).fetchone()
+                    version = _record_version(row[0]) if row is not None else 0
+                    if version != expected_version:
+                        conflicts[key] = version
+                if not conflicts:
+                    self._connection.executemany(
+                        "INSERT INTO usage_records (key, value) VALUES (?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                        [(key, bytes(value)) for key, (_, value) in records.items()])
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return conflicts
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+
+# Check-and-count of one usage against one or more fixed and sliding windows, which
+# counts it in all of them or, if any window denies it, in none. KEYS holds two keys per
+# window, the record and the summed weight of a sliding window. ARGV holds whether the
+# usage is only evaluated, the member ID of sliding windows, and per window its kind,
+# the current time, duration, limit, cost and whether times are in milliseconds.
+#
+# Fixed windows are a "count:window_start" string, which expires with its window.
+# Sliding windows are a sorted set of usages scored by their timestamp, whose members
+# are unique IDs followed by ":" and the weight of usages weighing more than 1. The
+# summed weight of the set is kept in the second key, so a check only reads the
+# usages that left the window since the last one instead of the whole set. Dry runs
+# write nothing. Records of another kind are replaced.
+#
+# Returns {allowed, denied window, count, timestamp, ...} with a count and timestamp per
+# window, or only of the denied window. The count includes the usage if it is allowed.
+# The timestamp is the start of a fixed window, and the oldest usage of a sliding
+# window if allowed or the usage that has to leave it if denied.
+_WINDOWS_SCRIPT = """
+local dry_run, member_id = ARGV[1] == '1', ARGV[2]
+local function weight(member)
+  return tonumber(string.match(member, ':(%d+)$')) or 1
+end
+
+local function evaluate_fixed(key, now, duration, limit, cost)
+  local count, start = 0, now
+  if redis.call('TYPE', key).ok == 'string' then
+    local stored_count, stored_start = string.match(redis.call('GET', key), '^(%d+):(%d+)$')
+    if stored_count then
+      count, start = tonumber(stored_count), tonumber(stored_start)
+    end
+  end
+  if now - start > duration then
+    count, start = 0, now
+  end
+  return count + cost <= limit, count, start
+end
+
+local function evaluate_sliding(key, weight_key, now, duration, limit, cost, milliseconds)
+  local cutoff = now - duration
+  local key_type = redis.call('TYPE', key).ok
+  if key_type ~= 'zset' and key_type ~= 'none' and not dry_run then
+    redis.call('DEL', key)
+  end
+  local count, stale = 0, false
+  if key_type == 'zset' and redis.call('ZCARD', key) > 0 then
+    count = tonumber(redis.call('GET', weight_key))
+    if count then
+      local expired = redis.call('ZRANGEBYSCORE', key, '-inf', cutoff)
+      for _, member in ipairs(expired) do
+        count = count - weight(member)
+      end
+      stale = #expired > 0
+    else
+      -- Sets written before their weight was kept are summed once
+      count, stale = 0, true
+      for _, member in ipairs(redis.call('ZRANGEBYSCORE', key, '(' .. cutoff, '+inf')) do
+        count = count + weight(member)
+      end
+    end
+    count = math.max(count, 0)
+  end
+  if not dry_run and stale then
+    -- Expired usages are subtracted from the weight only once, even if none remain
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', cutoff)
+    if count > 0 then
+      redis.call('SET', weight_key, count, milliseconds and 'PX' or 'EX', duration)
+    else
+      redis.call('DEL', weight_key)
+    end
+  end
+  if count + cost > limit then
+    -- Only the oldest usages whose weight has to leave the window are read
+    local remaining = count
+    local usages = redis.call('ZRANGEBYSCORE', key, '(' .. cutoff, '+inf', 'WITHSCORES',
+                              'LIMIT', 0, count + cost - limit)
+    for i = 1, #usages, 2 do
+      remaining = remaining - weight(usages[i])
+      if remaining + cost <= limit then
+        return false, count, tonumber(usages[i + 1])
+      end
+    end
+    return false, count, now
+  end
+  local oldest = redis.call('ZRANGEBYSCORE', key, '(' .. cutoff, '+inf', 'WITHSCORES',
+                            'LIMIT', 0, 1)
+  return true, count, tonumber(oldest[2]) or now
+end
+
+local windows = {}
+for index = 1, #KEYS / 2 do
+  local offset = 2 + (index - 1) * 6
+  local window = {
+    kind = ARGV[offset + 1], key = KEYS[2 * index - 1], weight_key = KEYS[2 * index],
+    now = tonumber(ARGV[offset + 2]), duration = tonumber(ARGV[offset + 3]),
+    limit = tonumber(ARGV[offset + 4]), cost = tonumber(ARGV[offset + 5]),
+    milliseconds = ARGV[offset + 6] == '1'
+  }
+  local allowed
+  if window.kind == 'fixed' then
+    allowed, window.count, window.timestamp = evaluate_fixed(
+      window.key, window.now, window.duration, window.limit, window.cost)
+  else
+    allowed, window.count, window.timestamp = evaluate_sliding(
+      window.key, window.weight_key, window.now, window.duration, window.limit, window.cost,
+      window.milliseconds)
+  end
+  if not allowed then
+    return {0, index, window.count, window.timestamp}
+  end
+  windows[index] = window
+end
+
+local results = {1, 0}
+for _, window in ipairs(windows) do
+  local count = window.count + window.cost
+  if not dry_run and window.kind == 'fixed' then
+    redis.call('SET', window.key, count .. ':' .. window.timestamp,
+               window.milliseconds and 'PX' or 'EX',
+               window.timestamp + window.duration + 1 - window.now)
+  elseif not dry_run then
+    local member = member_id
+    if window.cost ~= 1 then
+      member = member .. ':' .. window.cost
+    end
+    redis.call('ZADD', window.key, window.now, member)
+    redis.call(window.milliseconds and 'PEXPIRE' or 'EXPIRE', window.key, window.duration)
+    redis.call('SET', window.weight_key, count, window.milliseconds and 'PX' or 'EX',
+               window.duration)
+  end
+  table.insert(results, count)
+  table.insert(results, window.timestamp)
+end
+return results
+"""
+
+
+# Conditional write of versioned records. ARGV holds the expected version stamp and the
+# new value of every key of KEYS. The stamp is read from the envelope of
+# `encode_versioned`, a 0x80 byte and a little-endian 32-bit version; other records
+# are version 0. Every value is written if every stamp matches, otherwise none.
+#
+# Returns the keys that did not match, each followed by the stamp found.
+_COMPARE_AND_SET_SCRIPT = """
+local conflicts = {}
+for i, key in ipairs(KEYS) do
+  local version = 0
+  if redis.call('TYPE', key).ok == 'string' then
+    local stored = redis.call('GET', key)
+    if #stored >= 5 and string.byte(stored, 1) == 128 then
+      local b1, b2, b3, b4 = string.byte(stored, 2, 5)
+      version = b1 + b2 * 256 + b3 * 65536 + b4 * 16777216
+    end
+  end
+  if version ~= tonumber(ARGV[2 * i - 1]) then
+    table.insert(conflicts, key)
+    table.insert(conflicts, version)
+  end
+end
+if #conflicts == 0 then
+  for i, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[2 * i])
+  end
+end
+return conflicts
+"""
+
+
+def sliding_weight_key(key: str) -> str:
+    """Return the Redis key holding the summed weight of the sliding window of `key`."""
+    return f"{key}#weight"
+
+
+class RedisStorage:
+    """
+    Usage records in a Redis server shared by all plugin replicas.
+
+    Besides the key-value interface, the fixed and sliding window updates of a usage run
+    as one server-side Lua script, so concurrent replicas never lose or overshoot an
+    update and a check of all the windows of a rule set costs a single round-trip.
+    The version-checked writes of the other strategies run as a script as well.
+    """
+
+    def __init__(self, client: Any):
+        self.client = client
+        self._windows = client.register_script(_WINDOWS_SCRIPT)
+        self._compare_and_set = client.register_script(_COMPARE_AND_SET_SCRIPT)
+
+    def get(self, key: str) -> bytes:
+        """Return the value of `key`, raising `KeyError` if it does not exist."""
+        value = self.client.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def set(self, key: str, val: bytes) -> None:
+        """Store `val` under `key`."""
+        self.client.set(key, bytes(val))
+
+    def delete(self, key: str) -> None:
+        """Delete `key`, raising `KeyError` if it does not exist."""
+        if not self.client.delete(key):
+            raise KeyError(key)
+
+    def exist(self, key: str) -> bool:
+        """Return whether `key` exists."""
+        return bool(self.client.exists(key))
+
+    def compare_and_set(self, records: dict[str, tuple[int, bytes]]) -> dict[str, int]:
+        """
+        Store every record if the stored record of each key carries the expected version
+        stamp, or none of them, in one atomic script.
+
+        Parameters:
+        - `records`: The expected version stamp and the new value of every key.
+
+        Returns:
+        - `conflicts`: The version stamp found under every key that did not carry the
+           expected one. Nothing was written if it is not empty.
+        """
+        args = []
+        for expected_version, value in records.values():
+            args += [expected_version, bytes(value)]
+        conflicts = self._compare_and_set(keys=list(records), args=args)
+        return {key.decode() if isinstance(key, bytes) else key: int(version)
+                for key, version in zip(conflicts[::2], conflicts[1::2])}
+
+    def window_usages(
+        self,
+        windows: list[tuple[str, str, int, int, int, int, bool]],
+        dry_run: bool = False
+    ) -> tuple[int | None, list[tuple[int, int]]]:
+        """
+        Count a usage in every fixed and sliding window of `windows` unless it would exceed
+        the limit of any of them, in one atomic script.
+
+        Parameters:
+        - `windows`: The kind ("fixed" or "sliding"), key, limit, duration, current time,
+           cost and whether the times are in milliseconds of every window.
+        - `dry_run`: Whether the result is returned without counting the usage.
+
+        Returns:
+        - `denied`: The index of the first window that denies the usage, or None.
+        - `results`: The count and timestamp of every window, or only of the denied window.
+           The count includes the usage if it is allowed. The timestamp is the start of a
+           fixed window, and the oldest usage of a sliding window if allowed or the usage
+           that has to leave it before the next one is allowed if denied.
+        """
+        keys = []
+        args = [int(dry_run), uuid.uuid4().hex]
+        for kind, key, limit, duration, current_time, cost, milliseconds in windows:
+            keys += [key, sliding_weight_key(key)]
+            args += [kind, current_time, duration, limit, cost, int(milliseconds)]
+        allowed, denied, *values = self._windows(keys=keys, args=args)
+        results = list(zip(values[::2], values[1::2]))
+        return None if allowed else denied - 1, results
+
+    def fixed_window_usage(
+        self,
+        key: str,
+        limit: int,
+        duration_seconds: int,
+        current_time: int,
+        cost: int = 1,
+        dry_run: bool = False,
+        milliseconds: bool = False
+    ) -> tuple[bool, int, int]:
+        """
+        Count a usage of weight `cost` in the fixed window of `key` unless it would
+        exceed `limit`. With `dry_run`, the result is returned without counting it.
+        With `milliseconds`, `duration_seconds` and `current_time` are in milliseconds.
+
+        Returns:
+        - `allowed`: Whether the usage was counted.
+        - `count`: The usage count of the window.
+        - `window_start`: The start of the window.
+        """
+        denied, [(count, window_start)] = self.window_usages(
+            [("fixed", key, limit, duration_seconds, current_time, cost, milliseconds)], dry_run)
+        return denied is None, count, window_start
+
+    def sliding_window_usage(
+        self,
+        key: str,
+        limit: int,
+        duration_seconds: int,
+        current_time: int,
+        cost: int = 1,
+        dry_run: bool = False,
+        milliseconds: bool = False
+    ) -> tuple[bool, int, int]:
+        """
+        Add a usage of weight `cost` to the sliding window of `key` unless it would
+        exceed `limit`. With `dry_run`, the result is returned without adding it.
+        With `milliseconds`, `duration_seconds` and `current_time` are in milliseconds.
+
+        Returns:
+        - `allowed`: Whether the usage was added.
+        - `count`: The summed weight of the usages in the window.
+        - `timestamp`: The oldest usage in the window if allowed, otherwise the usage
+           that has to leave the window before the next one is allowed.
+        """
+        denied, [(count, timestamp)] = self.window_usages(
+            [("sliding", key, limit, duration_seconds, current_time, cost, milliseconds)],
+            dry_run)
+        return denied is None, count, timestamp
+
+
+_OPENED_BACKENDS: dict[tuple[str, str], StorageBackend] = {}
+_OPENED_BACKENDS_GUARD = threading.Lock()
+
+
+def open_backend(session: Any, name: str, location: str | None = None) -> StorageBackend:
+    """
+    Return a storage backend.
+
+    Parameters:
+    - `session`: The session of the tool invocation.
+    - `name`: "session" for the plugin session storage, "sqlite" for a local database
+       or "redis" for a Redis server.
+    - `location`: The database file of the "sqlite" backend or the URL of the "redis" backend.
+
+    Returns:
+    - `backend`: The storage backend. Databases and connection pools are opened once per process.
+    """
+    if name == "session":
+        return session.storage
+    if name == "sqlite":
+        location = location or DEFAULT_SQLITE_PATH
+    elif name == "redis":
+        if not location:
+            raise ValueError("A Redis URL is required")
+    else:
+        raise ValueError("Invalid storage backend")
+    with _OPENED_BACKENDS_GUARD:
+        backend = _OPENED_BACKENDS.get((name, location))
+        if backend is None:
+            if name == "sqlite":
+                backend = SQLiteStorage(location)
+            else:
+                # Only needed by deployments that use the Redis backend
+                import redis  # pylint: disable=import-outside-toplevel
+                backend = RedisStorage(redis.Redis.from_url(location))
+            _OPENED_BACKENDS[(name, location)] = backend
+        return backend
+
+
+def runtime_credentials(runtime: Any) -> dict[str, Any] | None:
+    """Return the provider credentials of a tool runtime, None for the endpoints' tools."""
+    return None if runtime is None else runtime.credentials
+
+
+def backend_from_parameters(session: Any, tool_parameters: dict[str, Any],
+                            credentials: dict[str, Any] | None = None) -> StorageBackend:
+    """
+    Return the storage backend selected by the `storage_backend` and `storage_path` tool
+    parameters.
+
+    The Redis URL carries the credentials of the server, so it is read from the
+    `redis_url` provider credential. Tools invoked by the endpoints have no runtime and
+    no `credentials`, and read the `redis_url` the endpoints pass from the settings of
+    the endpoint group instead.
+    """
+    name = tool_parameters.get("storage_backend") or "session"
+    if name != "redis":
+        return open_backend(session, name, tool_parameters.get("storage_path"))
+    source = tool_parameters if credentials is None else credentials
+    return open_backend(session, name, source.get("redis_url"))
+
+
+class InMemoryStorage:
+    """
+    In-process stand-in for the plugin storage, used by tests and benchmarks.
+
+    `latency_seconds` simulates the round-trip to the Dify daemon on every call, and
+    `calls` counts the round-trips per operation. With `max_bytes`, writes that would
+    exceed the size of all values fail like writes beyond the plugin storage quota.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, max_bytes: int | None = None):
+        self.latency_seconds = latency_seconds
+        self.max_bytes = max_bytes
+        self.calls: Counter[str] = Counter()
+        self._data: dict[str, bytes] = {}
+
+    @property
+    def stored_bytes(self) -> int:
+        """The size of all stored values in bytes."""
+        return sum(map(len, self._data.values()))
+
+    def get(self, key: str) -> bytes:
+        """Return the value of `key`, raising `KeyError` if it does not exist."""
+        self._round_trip("get")
+        return self._data[key]
+
+    def set(self, key: str, val: bytes) -> None:
+        """Store `val` under `key`."""
+        self._round_trip("set")
+        if self.max_bytes is not None and \
+                self.stored_bytes - len(self._data.get(key, b"")) + len(val) > self.max_bytes:
+            raise ValueError("Storage quota exceeded")
+        self._data[key] = bytes(val)
+
+    def delete(self, key: str) -> None:
+        """Delete `key`, raising `KeyError` if it does not exist."""
+        self._round_trip("delete")
+        del self._data[key]
+
+    def exist(self, key: str) -> bool:
+        """Return whether `key` exists."""
+        self._round_trip("exist")
+        return key in self._data
+
+    def _round_trip(self, operation: str) -> None:
+        self.calls[operation] += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
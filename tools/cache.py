@@ -0,0 +1,126 @@
+# pylint: disable=missing-module-docstring
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+# Upper bound of usage records cached per process.
+RECORD_CACHE_SIZE = 10000
+# Upper bound of denied identifiers remembered per process.
+DENY_CACHE_SIZE = 10000
+
+
+class RecordCache:
+    """
+    Process-wide LRU cache of stored usage records.
+
+    Entries remember when they were fetched, and each lookup passes the maximum age
+    it accepts, so nodes configured with different TTLs can share the cache. Hits
+    and misses are counted for monitoring.
+    """
+
+    def __init__(self, max_entries: int = RECORD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        # Only held for dictionary operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def get(self, key: str, max_age: float) -> bytes | None:
+        """Return the cached record of `key` if it is younger than `max_age` seconds."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, record: bytes) -> None:
+        """Cache the current record of `key`, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), record)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        """Drop the cached record of `key`."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all cached records and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the hit and miss counters and the number of cached records."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+RECORD_CACHE = RecordCache()
+
+
+class DenyCache:
+    """
+    Process-wide LRU cache of identifiers that are over their limit.
+
+    A denial is remembered until the usage of the identifier decreases, together with
+    the limit configuration (`scope`) it was computed for, so invocations with another
+    limit on the same identifier are still evaluated against the storage.
+    """
+
+    def __init__(self, max_entries: int = DENY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self._entries: OrderedDict[str, dict[Hashable, tuple[float, int, int]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, identifier: str, scope: Hashable, now: float) -> tuple[float, int, int] | None:
+        """
+        Return the `(denied_until, limit, current_usage)` of a denial that is still in
+        effect at the wall clock time `now`.
+        """
+        with self._lock:
+            denials = self._entries.get(identifier)
+            if denials is None:
+                return None
+            denial = denials.get(scope)
+            if denial is None:
+                return None
+            if denial[0] <= now:
+                del denials[scope]
+                if not denials:
+                    del self._entries[identifier]
+                return None
+            self.hits += 1
+            return denial
+
+    def put(self, identifier: str, scope: Hashable, denied_until: float,
+            limit: int, current_usage: int) -> None:
+        """Remember that `identifier` is denied until the wall clock time `denied_until`."""
+        with self._lock:
+            self._entries.setdefault(identifier, {})[scope] = (denied_until, limit, current_usage)
+            self._entries.move_to_end(identifier)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, identifier: str) -> None:
+        """Forget all denials of `identifier`."""
+        with self._lock:
+            self._entries.pop(identifier, None)
+
+    def clear(self) -> None:
+        """Forget all denials and reset the hit counter."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+
+
+DENY_CACHE = DenyCache()
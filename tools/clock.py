@@ -0,0 +1,53 @@
+# pylint: disable=missing-module-docstring
+import time
+from typing import Protocol
+
+
+class Clock(Protocol):
+    """
+    The source of the current time of the tools.
+    """
+
+    def time(self) -> float:
+        """Return the current epoch in seconds."""
+
+
+class SystemClock:
+    """
+    The wall clock of the plugin host.
+
+    `time.time` is looked up on every call, so patching it still controls the time.
+    """
+
+    def time(self) -> float:
+        """Return the current epoch in seconds."""
+        return time.time()
+
+
+class VirtualClock:
+    """
+    A clock that only moves when told to, so usage can be replayed in virtual time.
+
+    Parameters:
+    - `start`: The epoch the clock starts at.
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        """Return the current virtual epoch in seconds."""
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        """Move the clock `seconds` forward."""
+        if seconds < 0:
+            raise ValueError("Clocks cannot move backwards")
+        self.now += seconds
+
+    def set(self, epoch: float) -> None:
+        """Move the clock to `epoch`, which must not be in its past."""
+        self.advance(epoch - self.now)
+
+
+SYSTEM_CLOCK = SystemClock()
@@ -0,0 +1,435 @@
+# pylint: disable=missing-module-docstring
+import struct
+import sys
+from array import array
+from collections.abc import Sequence
+
+# Version bytes written at the start of every binary record. Each record kind
+# has its own version byte. Legacy records are decimal strings and always
+# start with an ASCII digit, so they can never be mistaken for a binary record.
+TIMESTAMPS_V1 = 0x01
+COUNTER_V1 = 0x02
+BUCKETS_V1 = 0x03
+ARRIVAL_TIME_V1 = 0x04
+EXPIRY_INDEX_V1 = 0x05
+TIERS_V1 = 0x06
+WEIGHTED_TIMESTAMPS_V1 = 0x07
+TIMESTAMPS_MS_V1 = 0x08
+# Layouts of the weighted timestamp, bucket and tier records with 64-bit counts,
+# written instead of the 32-bit layouts once a count no longer fits.
+WEIGHTED_TIMESTAMPS_V2 = 0x09
+BUCKETS_V2 = 0x0A
+TIERS_V2 = 0x0B
+# Envelope around any of the records above that carries a version stamp for
+# optimistic concurrency control.
+VERSIONED_V1 = 0x80
+
+_TIMESTAMPS_V1_HEADER = struct.Struct("<Bq")
+_COUNTER_V1 = struct.Struct("<BqQQ")
+_BUCKETS_V1_HEADER = struct.Struct("<BIq")
+_ARRIVAL_TIME_V1 = struct.Struct("<Bq")
+_VERSIONED_V1_HEADER = struct.Struct("<BI")
+_EXPIRY_INDEX_V1_ENTRY = struct.Struct("<qH")
+_UINT32 = struct.Struct("<I")
+_TIERS_V1_TIER = struct.Struct("<IqII")
+_TIERS_V2_TIER = struct.Struct("<IqQQ")
+_UINT32_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+_UINT32_MAX = 0xFFFFFFFF
+_SWAP_BYTES = sys.byteorder != "little"
+
+
+def encode_timestamps(timestamps: list[int], milliseconds: bool = False) -> bytes:
+    """
+    Encode a sorted list of epoch timestamps as a compact binary record.
+
+    The record is a version byte and a signed 64-bit base epoch, followed by
+    one little-endian unsigned 32-bit offset from the base per timestamp.
+    Millisecond records have their own version byte, and their offsets span
+    up to 49 days.
+
+    Parameters:
+    - `timestamps`: The timestamps to encode, oldest first.
+    - `milliseconds`: Whether the timestamps are in milliseconds instead of seconds.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    base = timestamps[0] if timestamps else 0
+    offsets = array(_UINT32_TYPECODE, [t - base for t in timestamps])
+    if _SWAP_BYTES:
+        offsets.byteswap()
+    version = TIMESTAMPS_MS_V1 if milliseconds else TIMESTAMPS_V1
+    return _TIMESTAMPS_V1_HEADER.pack(version, base) + offsets.tobytes()
+
+
+def decode_timestamps(record: bytes, milliseconds: bool = False) -> list[int]:
+    """
+    Decode a timestamp record written by `encode_timestamps`.
+
+    Legacy comma separated records are decoded transparently, so they are
+    migrated to the binary format on the next write. Records of the other
+    resolution are converted, so a window keeps its usage when its resolution
+    changes.
+
+    Parameters:
+    - `record`: The stored record.
+    - `milliseconds`: Whether the timestamps are returned in milliseconds instead of seconds.
+
+    Returns:
+    - `timestamps`: The decoded timestamps, oldest first.
+    """
+    if not record:
+        return []
+    if record[:1].isdigit():
+        timestamps = list(map(int, record.decode().split(',')))
+        return [t * 1000 for t in timestamps] if milliseconds else timestamps
+    if record[0] not in (TIMESTAMPS_V1, TIMESTAMPS_MS_V1):
+        raise ValueError(f"Unsupported timestamp record version {record[0]}")
+
+    _, base = _TIMESTAMPS_V1_HEADER.unpack_from(record)
+    offsets = array(_UINT32_TYPECODE)
+    offsets.frombytes(record[_TIMESTAMPS_V1_HEADER.size:])
+    if _SWAP_BYTES:
+        offsets.byteswap()
+    if (record[0] == TIMESTAMPS_MS_V1) == milliseconds:
+        return [base + offset for offset in offsets]
+    if milliseconds:
+        return [(base + offset) * 1000 for offset in offsets]
+    return [(base + offset) // 1000 for offset in offsets]
+
+
+def timestamp_offsets(record: bytes, milliseconds: bool = False) -> tuple[int, Sequence[int]]:
+    """
+    Return the timestamps of a record written by `encode_timestamps` as offsets from
+    its base epoch, without copying them.
+
+    The offsets are ascending, so the first timestamp in a window can be found with
+    `bisect`. Legacy records, records of the other resolution and records on
+    big-endian hosts are decoded instead.
+
+    Parameters:
+    - `record`: The stored record.
+    - `milliseconds`: Whether the offsets are returned in milliseconds instead of seconds.
+
+    Returns:
+    - `base`: The base epoch of the record.
+    - `offsets`: The offset of every timestamp from `base`, oldest first.
+    """
+    version = TIMESTAMPS_MS_V1 if milliseconds else TIMESTAMPS_V1
+    if not record or record[0] != version or _SWAP_BYTES:
+        timestamps = decode_timestamps(record, milliseconds)
+        base = timestamps[0] if timestamps else 0
+        return base, [t - base for t in timestamps]
+    _, base = _TIMESTAMPS_V1_HEADER.unpack_from(record)
+    return base, memoryview(record)[_TIMESTAMPS_V1_HEADER.size:].cast(_UINT32_TYPECODE)
+
+
+def append_timestamp(record: bytes, start: int, timestamp: int,
+                     milliseconds: bool = False) -> bytes:
+    """
+    Drop the oldest timestamps of a record and append a new one.
+
+    The kept offsets are copied as they are, relative to the base epoch of the
+    record, instead of decoding and encoding every timestamp. The record is only
+    encoded again if it is a legacy record or of the other resolution, it holds
+    no timestamp to keep, or `timestamp` is too far from its base to be stored as
+    an offset.
+
+    Parameters:
+    - `record`: The stored record.
+    - `start`: The number of oldest timestamps to drop.
+    - `timestamp`: The timestamp to append, at least the newest timestamp of the record.
+    - `milliseconds`: Whether `timestamp` is in milliseconds instead of seconds.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    kept = _TIMESTAMPS_V1_HEADER.size + 4 * start
+    version = TIMESTAMPS_MS_V1 if milliseconds else TIMESTAMPS_V1
+    if record[:1] == bytes([version]) and not _SWAP_BYTES and kept < len(record):
+        offset = timestamp - _TIMESTAMPS_V1_HEADER.unpack_from(record)[1]
+        if 0 <= offset <= 0xFFFFFFFF:
+            head = record if start == 0 else record[:_TIMESTAMPS_V1_HEADER.size] + record[kept:]
+            return head + _UINT32.pack(offset)
+    return encode_timestamps(
+        decode_timestamps(record, milliseconds)[start:] + [timestamp], milliseconds)
+
+
+def encode_weighted_timestamps(usages: list[tuple[int, int]]) -> bytes:
+    """
+    Encode a sorted list of weighted usages as a compact binary record.
+
+    The record is a version byte and a signed 64-bit base epoch, followed by one
+    pair of little-endian unsigned 32-bit integers per usage: its offset from the
+    base and its weight. If a weight does not fit in 32 bits, the pairs are
+    unsigned 64-bit integers and the record has its own version byte.
+
+    Parameters:
+    - `usages`: The timestamp and weight of every usage, oldest first.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    base = usages[0][0] if usages else 0
+    wide = any(weight > _UINT32_MAX for _, weight in usages)
+    pairs = array("Q" if wide else _UINT32_TYPECODE)
+    for timestamp, weight in usages:
+        pairs.append(timestamp - base)
+        pairs.append(weight)
+    if _SWAP_BYTES:
+        pairs.byteswap()
+    version = WEIGHTED_TIMESTAMPS_V2 if wide else WEIGHTED_TIMESTAMPS_V1
+    return _TIMESTAMPS_V1_HEADER.pack(version, base) + pairs.tobytes()
+
+
+def decode_weighted_timestamps(record: bytes) -> list[tuple[int, int]]:
+    """
+    Decode a weighted usage record written by `encode_weighted_timestamps`.
+
+    Timestamp records and legacy records are decoded with a weight of 1 per usage.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `usages`: The timestamp and weight of every usage, oldest first.
+    """
+    if not record or record[0] not in (WEIGHTED_TIMESTAMPS_V1, WEIGHTED_TIMESTAMPS_V2):
+        return [(timestamp, 1) for timestamp in decode_timestamps(record)]
+
+    _, base = _TIMESTAMPS_V1_HEADER.unpack_from(record)
+    pairs = array("Q" if record[0] == WEIGHTED_TIMESTAMPS_V2 else _UINT32_TYPECODE)
+    pairs.frombytes(record[_TIMESTAMPS_V1_HEADER.size:])
+    if _SWAP_BYTES:
+        pairs.byteswap()
+    return [(base + offset, weight) for offset, weight in zip(pairs[::2], pairs[1::2])]
+
+
+def encode_counter(window_start: int, previous_count: int, current_count: int) -> bytes:
+    """
+    Encode a sliding window counter as a constant-size binary record.
+
+    Parameters:
+    - `window_start`: The start of the current fixed window as epoch seconds.
+    - `previous_count`: The number of usages counted in the previous window.
+    - `current_count`: The number of usages counted in the current window.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    return _COUNTER_V1.pack(COUNTER_V1, window_start, previous_count, current_count)
+
+
+def decode_counter(record: bytes) -> tuple[int, int, int]:
+    """
+    Decode a sliding window counter record written by `encode_counter`.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `window_start`, `previous_count`, `current_count`: The decoded counter.
+    """
+    if not record:
+        return 0, 0, 0
+    if record[0] != COUNTER_V1:
+        raise ValueError(f"Unsupported counter record version {record[0]}")
+    _, window_start, previous_count, current_count = _COUNTER_V1.unpack(record)
+    return window_start, previous_count, current_count
+
+
+def encode_buckets(bucket_seconds: int, head_bucket: int, counts: list[int]) -> bytes:
+    """
+    Encode a ring of per-bucket usage counts as a binary record.
+
+    The counts are unsigned 32-bit integers, or unsigned 64-bit integers under their
+    own version byte if a count does not fit in 32 bits.
+
+    Parameters:
+    - `bucket_seconds`: The width of each bucket in seconds.
+    - `head_bucket`: The number of the most recently updated bucket, i.e. its
+       start time divided by `bucket_seconds`.
+    - `counts`: The ring of counts, where bucket `n` is stored at `n % len(counts)`.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    wide = any(count > _UINT32_MAX for count in counts)
+    ring = array("Q" if wide else _UINT32_TYPECODE, counts)
+    if _SWAP_BYTES:
+        ring.byteswap()
+    version = BUCKETS_V2 if wide else BUCKETS_V1
+    return _BUCKETS_V1_HEADER.pack(version, bucket_seconds, head_bucket) + ring.tobytes()
+
+
+def decode_buckets(record: bytes) -> tuple[int, int, list[int]]:
+    """
+    Decode a bucket ring record written by `encode_buckets`.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `bucket_seconds`, `head_bucket`, `counts`: The decoded ring.
+    """
+    if not record:
+        return 0, 0, []
+    if record[0] not in (BUCKETS_V1, BUCKETS_V2):
+        raise ValueError(f"Unsupported bucket record version {record[0]}")
+    _, bucket_seconds, head_bucket = _BUCKETS_V1_HEADER.unpack_from(record)
+    ring = array("Q" if record[0] == BUCKETS_V2 else _UINT32_TYPECODE)
+    ring.frombytes(record[_BUCKETS_V1_HEADER.size:])
+    if _SWAP_BYTES:
+        ring.byteswap()
+    return bucket_seconds, head_bucket, ring.tolist()
+
+
+def encode_arrival_time(arrival_time: int) -> bytes:
+    """
+    Encode the theoretical arrival time of the generic cell rate algorithm.
+
+    Parameters:
+    - `arrival_time`: The theoretical arrival time as epoch microseconds.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    return _ARRIVAL_TIME_V1.pack(ARRIVAL_TIME_V1, arrival_time)
+
+
+def decode_arrival_time(record: bytes) -> int:
+    """
+    Decode a theoretical arrival time record written by `encode_arrival_time`.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `arrival_time`: The theoretical arrival time as epoch microseconds.
+    """
+    if not record:
+        return 0
+    if record[0] != ARRIVAL_TIME_V1:
+        raise ValueError(f"Unsupported arrival time record version {record[0]}")
+    return _ARRIVAL_TIME_V1.unpack(record)[1]
+
+
+def encode_tiers(counters: dict[int, tuple[int, int, int]]) -> bytes:
+    """
+    Encode the sliding window counters of several windows as one binary record.
+
+    The record is a version byte followed by one entry per window: its unsigned
+    32-bit duration, a signed 64-bit window start and two unsigned 32-bit counts.
+    If a count does not fit in 32 bits, the counts are unsigned 64-bit integers and
+    the record has its own version byte.
+
+    Parameters:
+    - `counters`: The window start, previous count and current count per window duration.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    wide = any(count > _UINT32_MAX for _, *counts in counters.values() for count in counts)
+    tier = _TIERS_V2_TIER if wide else _TIERS_V1_TIER
+    return bytes([TIERS_V2 if wide else TIERS_V1]) + b"".join(
+        tier.pack(duration_seconds, *counter)
+        for duration_seconds, counter in counters.items())
+
+
+def decode_tiers(record: bytes) -> dict[int, tuple[int, int, int]]:
+    """
+    Decode a tier record written by `encode_tiers`.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `counters`: The window start, previous count and current count per window duration.
+    """
+    if not record:
+        return {}
+    if record[0] not in (TIERS_V1, TIERS_V2):
+        raise ValueError(f"Unsupported tier record version {record[0]}")
+    tier = _TIERS_V2_TIER if record[0] == TIERS_V2 else _TIERS_V1_TIER
+    counters = {}
+    for duration_seconds, *counter in tier.iter_unpack(record[1:]):
+        counters[duration_seconds] = tuple(counter)
+    return counters
+
+
+def encode_expiry_index(entries: dict[str, int]) -> bytes:
+    """
+    Encode the expiry times of a set of storage keys.
+
+    The record is a version byte followed by one entry per key: a signed 64-bit
+    expiry epoch, the unsigned 16-bit length of the UTF-8 key and the key itself.
+
+    Parameters:
+    - `entries`: The expiry epoch of each key.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    parts = [bytes([EXPIRY_INDEX_V1])]
+    for key, expires_at in entries.items():
+        encoded_key = key.encode()
+        parts.append(_EXPIRY_INDEX_V1_ENTRY.pack(expires_at, len(encoded_key)))
+        parts.append(encoded_key)
+    return b"".join(parts)
+
+
+def decode_expiry_index(record: bytes) -> dict[str, int]:
+    """
+    Decode an expiry index record written by `encode_expiry_index`.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `entries`: The expiry epoch of each key.
+    """
+    if not record:
+        return {}
+    if record[0] != EXPIRY_INDEX_V1:
+        raise ValueError(f"Unsupported expiry index record version {record[0]}")
+    entries = {}
+    offset = 1
+    while offset < len(record):
+        expires_at, key_length = _EXPIRY_INDEX_V1_ENTRY.unpack_from(record, offset)
+        offset += _EXPIRY_INDEX_V1_ENTRY.size
+        entries[record[offset:offset + key_length].decode()] = expires_at
+        offset += key_length
+    return entries
+
+
+def encode_versioned(version: int, payload: bytes) -> bytes:
+    """
+    Wrap a record in an envelope carrying its version stamp.
+
+    Parameters:
+    - `version`: The version stamp, wrapping around at 2**32.
+    - `payload`: The wrapped record.
+
+    Returns:
+    - `record`: The encoded record.
+    """
+    return _VERSIONED_V1_HEADER.pack(VERSIONED_V1, version & 0xFFFFFFFF) + payload
+
+
+def decode_versioned(record: bytes) -> tuple[int, bytes]:
+    """
+    Unwrap a record written by `encode_versioned`.
+
+    Records without an envelope were written before version stamps were introduced
+    and are reported as version 0.
+
+    Parameters:
+    - `record`: The stored record.
+
+    Returns:
+    - `version`, `payload`: The version stamp and the wrapped record.
+    """
+    if not record or record[0] != VERSIONED_V1:
+        return 0, record
+    _, version = _VERSIONED_V1_HEADER.unpack_from(record)
+    return version, record[_VERSIONED_V1_HEADER.size:]
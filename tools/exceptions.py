@@ -6,16 +6,20 @@ class UsageLimitExceededException(Exception):
         identifier (str): The unique identifier for the resource or user whose limit was exceeded.
         limit (int): The maximum allowed usage for the resource or user.
         current_usage (int): The current usage count that exceeded the limit.
+        retry_after (float | None): The seconds until the next usage is allowed, if known.
         
     """
 
-    def __init__(self, identifier, limit, current_usage):
+    def __init__(self, identifier, limit, current_usage, retry_after=None):
         self.identifier = identifier
         self.limit = limit
         self.current_usage = current_usage
-        super().__init__(
-            f"Usage limit exceeded for {identifier}: {current_usage} messages sent, limit is {limit}"
-        )
+        self.retry_after = retry_after
+        message = (f"Usage limit exceeded for {identifier}: {current_usage} messages sent, "
+                   f"limit is {limit}")
+        if retry_after is not None:
+            message += f", retry after {retry_after} seconds"
+        super().__init__(message)
 
 class FailedToDeleteStorageItemException(Exception):
     """
@@ -30,3 +34,23 @@ class FailedToDeleteStorageItemException(Exception):
         super().__init__(f"Failed to delete usage limit for identifier {identifier}: {original_exception}")
         self.identifier = identifier
         self.original_exception = original_exception
+
+
+class StorageConflictException(Exception):
+    """
+    Exception raised when a storage item was changed concurrently between reading and writing it.
+
+    Attributes:
+        identifier (str): The identifier of the storage item.
+        expected_version (int): The version stamp that was read before the update.
+        actual_version (int): The version stamp found when writing the update.
+    """
+
+    def __init__(self, identifier, expected_version, actual_version):
+        super().__init__(
+            f"Concurrent update of identifier {identifier}: "
+            f"expected version {expected_version}, found {actual_version}"
+        )
+        self.identifier = identifier
+        self.expected_version = expected_version
+        self.actual_version = actual_version
@@ -0,0 +1,181 @@
+# pylint: disable=missing-module-docstring
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any
+
+from tools.cache import RECORD_CACHE
+from tools.encoding import decode_expiry_index, encode_expiry_index
+from tools.storage import WRITE_BEHIND, VersionedStorage, key_lock, retry_on_conflict
+
+# The expiry index is split across this many storage keys by the hash of the indexed key.
+INDEX_KEY_PREFIX = "usage-limit-expiry#"
+INDEX_SHARDS = 16
+# Every SWEEP_INTERVAL invocations, a plugin process sweeps one index shard and
+# deletes up to SWEEP_BATCH expired records.
+SWEEP_INTERVAL = 20
+SWEEP_BATCH = 10
+# Upper bound of index entries remembered per process.
+INDEXED_CACHE_SIZE = 10000
+
+
+def index_key(key: str) -> str:
+    """
+    Return the storage key of the index shard holding the expiry time of `key`.
+    """
+    return f"{INDEX_KEY_PREFIX}{zlib.crc32(key.encode()) % INDEX_SHARDS}"
+
+
+class ExpiryTracker:
+    """
+    Process-wide bookkeeping of the expiry index of usage records.
+
+    Every written usage record is entered into the index with a time after which it no
+    longer affects any usage count. Index entries are extended by a whole record lifetime
+    at a time, and the entries this process already wrote are remembered, so a record that
+    is updated continuously only costs an index write once per lifetime.
+
+    Each process sweeps one index shard every `SWEEP_INTERVAL` invocations, deleting a
+    bounded number of expired records. The number of deleted records and the bytes they
+    occupied are counted for monitoring.
+    """
+
+    def __init__(self, max_entries: int = INDEXED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.sweeps = 0
+        self.expired_records = 0
+        self.reclaimed_bytes = 0
+        self._invocations = 0
+        self._indexed: OrderedDict[str, int] = OrderedDict()
+        # Only held for counter and dictionary operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def touch(self, backend: Any, key: str, expires_at: int, lifetime: int) -> int:
+        """
+        Make sure the index keeps the record of `key` until at least `expires_at`.
+
+        Parameters:
+        - `backend`: The storage backend holding the record and the index.
+        - `key`: The storage key of the record.
+        - `expires_at`: The epoch after which the record no longer affects any usage.
+        - `lifetime`: The seconds the index entry is extended beyond `expires_at`.
+
+        Returns:
+        - `written_bytes`: The bytes the index grew by.
+        """
+        with self._lock:
+            indexed = self._indexed.get(key)
+        if indexed is not None and indexed >= expires_at:
+            return 0
+        storage = VersionedStorage(backend)
+        indexed = retry_on_conflict(
+            index_key(key), self._extend, storage, key, expires_at + lifetime)
+        with self._lock:
+            self._indexed[key] = indexed
+            self._indexed.move_to_end(key)
+            if len(self._indexed) > self.max_entries:
+                self._indexed.popitem(last=False)
+        return storage.written_bytes
+
+    def maybe_sweep(self, backend: Any, now: int) -> tuple[int, int] | None:
+        """
+        Sweep the next index shard if this invocation is due for a sweep.
+
+        Parameters:
+        - `backend`: The storage backend holding the records and the index.
+        - `now`: The current epoch.
+
+        Returns:
+        - `expired_records`, `reclaimed_bytes`: The records deleted by the sweep and the
+           bytes they occupied, or None if no sweep was due.
+        """
+        with self._lock:
+            self._invocations += 1
+            if self._invocations % SWEEP_INTERVAL:
+                return None
+            shard = self._invocations // SWEEP_INTERVAL % INDEX_SHARDS
+        result = self.sweep(backend, shard, now)
+        with self._lock:
+            self.sweeps += 1
+            self.expired_records += result[0]
+            self.reclaimed_bytes += result[1]
+        return result
+
+    def sweep(self, backend: Any, shard: int, now: int,
+              max_deletions: int = SWEEP_BATCH) -> tuple[int, int]:
+        """
+        Delete up to `max_deletions` records of an index shard that expired before `now`.
+
+        Returns:
+        - `expired_records`, `reclaimed_bytes`: The deleted records and the bytes they occupied.
+        """
+        key = f"{INDEX_KEY_PREFIX}{shard}"
+        return retry_on_conflict(
+            key, self._sweep, VersionedStorage(backend), backend, key, now, max_deletions)
+
+    def stats(self) -> dict[str, int]:
+        """Return the sweeps run by this process and the records and bytes they reclaimed."""
+        with self._lock:
+            return {
+                "sweeps": self.sweeps,
+                "expired_records": self.expired_records,
+                "reclaimed_bytes": self.reclaimed_bytes,
+            }
+
+    def clear(self) -> None:
+        """Forget the remembered index entries and reset the counters."""
+        with self._lock:
+            self._indexed.clear()
+            self._invocations = 0
+            self.sweeps = 0
+            self.expired_records = 0
+            self.reclaimed_bytes = 0
+
+    @staticmethod
+    def _read_index(storage: VersionedStorage, key: str) -> dict[str, int]:
+        try:
+            return decode_expiry_index(storage.get(key))
+        # pylint: disable=broad-except
+        except Exception:
+            return {}
+
+    def _extend(self, storage: VersionedStorage, key: str, expires_at: int) -> int:
+        shard_key = index_key(key)
+        entries = self._read_index(storage, shard_key)
+        if entries.get(key, 0) >= expires_at:
+            return entries[key]
+        entries[key] = expires_at
+        storage.set(shard_key, encode_expiry_index(entries))
+        return expires_at
+
+    def _sweep(self, storage: VersionedStorage, backend: Any, key: str,
+               now: int, max_deletions: int) -> tuple[int, int]:
+        entries = self._read_index(storage, key)
+        expired = [record_key for record_key, expires_at in entries.items()
+                   if expires_at < now][:max_deletions]
+        if not expired:
+            return 0, 0
+        deleted = 0
+        reclaimed = 0
+        for record_key in expired:
+            with key_lock(record_key):
+                RECORD_CACHE.invalidate(record_key)
+                WRITE_BEHIND.discard(record_key)
+                try:
+                    size = len(backend.get(record_key))
+                    backend.delete(record_key)
+                    deleted += 1
+                    reclaimed += size
+                # pylint: disable=broad-except
+                except Exception:
+                    # Already deleted, e.g. by the Reset Usage tool
+                    pass
+            del entries[record_key]
+        storage.set(key, encode_expiry_index(entries))
+        with self._lock:
+            for record_key in expired:
+                self._indexed.pop(record_key, None)
+        return deleted, reclaimed
+
+
+EXPIRY = ExpiryTracker()
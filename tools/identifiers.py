@@ -0,0 +1,188 @@
+# pylint: disable=missing-module-docstring
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any
+
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.encoding import decode_expiry_index, encode_expiry_index
+from tools.storage import WRITE_BEHIND, VersionedStorage, key_lock, retry_on_conflict
+
+# The records of every tracking method and app are indexed with the time they were last
+# used, split across this many storage keys by the hash of the record key.
+IDENTIFIER_INDEX_PREFIX = "usage-limit-identifiers#"
+IDENTIFIER_SHARDS = 16
+# The last use of a record is only written to the index once it is this much out of date.
+LAST_USED_RESOLUTION_SECONDS = 600
+# Upper bound of index entries remembered per process.
+INDEXED_CACHE_SIZE = 10000
+# A bulk reset deletes at most RESET_BATCH records and stops deleting after
+# RESET_DEADLINE_SECONDS, well within the 120 second request timeout of the plugin.
+RESET_BATCH = 1000
+RESET_DEADLINE_SECONDS = 60.0
+
+
+def identifier_index_key(tracking_method: str, app_id: str, shard: int) -> str:
+    """
+    Return the storage key of one shard of the index of a tracking method and app.
+    """
+    return f"{IDENTIFIER_INDEX_PREFIX}{tracking_method}#{app_id}#{shard}"
+
+
+def identifier_shard(key: str) -> int:
+    """Return the index shard holding the record key `key`."""
+    return zlib.crc32(key.encode()) % IDENTIFIER_SHARDS
+
+
+class IdentifierIndex:
+    """
+    Process-wide bookkeeping of the index of usage records per tracking method and app.
+
+    Every written usage record is entered into the index of its tracking method and app
+    with the time it was last used, so all records of an app, or those unused for a
+    while, can be reset without knowing their keys. Records tracked per workspace user
+    are indexed under the empty app. The last use is only rewritten once it is
+    `LAST_USED_RESOLUTION_SECONDS` out of date, and the entries this process already
+    wrote are remembered, so a busy record costs an index write at most once per
+    resolution.
+    """
+
+    def __init__(self, max_entries: int = INDEXED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._indexed: OrderedDict[tuple[str, str, str], int] = OrderedDict()
+        # Only held for dictionary operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def touch(self, backend: Any, tracking_method: str, app_id: str, key: str, now: int) -> int:
+        """
+        Record that the record of `key` was used at `now`.
+
+        Parameters:
+        - `backend`: The storage backend holding the record and the index.
+        - `tracking_method`: The tracking method of the record.
+        - `app_id`: The app of the record, or "" for records tracked per workspace user.
+        - `key`: The storage key of the record.
+        - `now`: The current epoch.
+
+        Returns:
+        - `written_bytes`: The bytes the index grew by.
+        """
+        entry = (tracking_method, app_id, key)
+        with self._lock:
+            indexed = self._indexed.get(entry)
+        if indexed is not None and now - indexed < LAST_USED_RESOLUTION_SECONDS:
+            return 0
+        index_key = identifier_index_key(tracking_method, app_id, identifier_shard(key))
+        storage = VersionedStorage(backend)
+        retry_on_conflict(index_key, self._update, storage, index_key, key, now)
+        with self._lock:
+            self._indexed[entry] = now
+            self._indexed.move_to_end(entry)
+            if len(self._indexed) > self.max_entries:
+                self._indexed.popitem(last=False)
+        return storage.written_bytes
+
+    def reset(
+        self,
+        backend: Any,
+        tracking_method: str,
+        app_id: str,
+        now: int,
+        older_than_seconds: int | None = None,
+        max_deletions: int = RESET_BATCH,
+        measure: bool = False
+    ) -> tuple[int, int, int]:
+        """
+        Delete the indexed records of a tracking method and app, a bounded batch at a time.
+
+        Parameters:
+        - `backend`: The storage backend holding the records and the index.
+        - `tracking_method`: The tracking method of the records.
+        - `app_id`: The app of the records, or "" for records tracked per workspace user.
+        - `now`: The current epoch.
+        - `older_than_seconds` (optional): Only delete records unused for this long. The
+           last use is known to `LAST_USED_RESOLUTION_SECONDS`.
+        - `max_deletions`: The maximum number of records deleted by this call.
+        - `measure`: Whether the size of every record is read before it is deleted.
+
+        Returns:
+        - `deleted_records`: The records deleted by this call.
+        - `freed_bytes`: The bytes the deleted records and their index entries occupied,
+           if measured.
+        - `remaining_records`: The matching records left for the next call.
+        """
+        deadline = time.monotonic() + RESET_DEADLINE_SECONDS
+        cutoff = None if older_than_seconds is None else now - older_than_seconds
+        deleted = freed = remaining = 0
+        for shard in range(IDENTIFIER_SHARDS):
+            # Out of time or budget, the remaining shards are only counted
+            budget = max_deletions - deleted if time.monotonic() < deadline else 0
+            storage = VersionedStorage(backend)
+            shard_deleted, shard_freed, shard_remaining = retry_on_conflict(
+                identifier_index_key(tracking_method, app_id, shard), self._reset_shard,
+                storage, backend, (tracking_method, app_id, shard),
+                cutoff, budget, deadline, measure)
+            deleted += shard_deleted
+            # The index shard shrank by the entries of the deleted records
+            freed += shard_freed - (storage.written_bytes if measure else 0)
+            remaining += shard_remaining
+        return deleted, freed, remaining
+
+    def clear(self) -> None:
+        """Forget the remembered index entries."""
+        with self._lock:
+            self._indexed.clear()
+
+    @staticmethod
+    def _read_index(storage: VersionedStorage, key: str) -> dict[str, int]:
+        try:
+            return decode_expiry_index(storage.get(key))
+        # pylint: disable=broad-except
+        except Exception:
+            return {}
+
+    def _update(self, storage: VersionedStorage, index_key: str, key: str, now: int) -> None:
+        entries = self._read_index(storage, index_key)
+        if now - entries.get(key, 0) < LAST_USED_RESOLUTION_SECONDS:
+            return
+        entries[key] = now
+        storage.set(index_key, encode_expiry_index(entries))
+
+    def _reset_shard(self, storage: VersionedStorage, backend: Any, scope: tuple[str, str, int],
+                     cutoff: int | None, budget: int, deadline: float,
+                     measure: bool) -> tuple[int, int, int]:
+        tracking_method, app_id, shard = scope
+        index_key = identifier_index_key(tracking_method, app_id, shard)
+        entries = self._read_index(storage, index_key)
+        matching = [key for key, last_used in entries.items()
+                    if cutoff is None or last_used <= cutoff]
+        deleted = freed = 0
+        removed = []
+        for key in matching[:budget]:
+            if time.monotonic() >= deadline:
+                break
+            with key_lock(key):
+                RECORD_CACHE.invalidate(key)
+                DENY_CACHE.invalidate(key)
+                WRITE_BEHIND.discard(key)
+                try:
+                    size = len(backend.get(key)) if measure else 0
+                    backend.delete(key)
+                    deleted += 1
+                    freed += size
+                # pylint: disable=broad-except
+                except Exception:
+                    # Already deleted, e.g. by the Reset Usage tool or an expiry sweep
+                    pass
+            removed.append(key)
+            del entries[key]
+        if removed:
+            storage.set(index_key, encode_expiry_index(entries))
+            with self._lock:
+                for key in removed:
+                    self._indexed.pop((tracking_method, app_id, key), None)
+        return deleted, freed, len(matching) - len(removed)
+
+
+IDENTIFIERS = IdentifierIndex()
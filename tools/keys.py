@@ -0,0 +1,77 @@
+# pylint: disable=missing-module-docstring
+from hashlib import blake2b
+from typing import Any
+from urllib.parse import quote
+
+KEY_FORMATS = ("plain", "namespaced", "hashed")
+# Prefix of every namespaced and hashed key, so they never collide with plain keys,
+# which start with an app, user or conversation ID.
+KEY_PREFIX = "ul"
+KEY_SEPARATOR = ":"
+# Hashed keys are the prefix, the separator and 32 hex digits.
+KEY_DIGEST_SIZE = 16
+
+
+def identifier_parts(session: Any, user_id: str, tracking_method: str) -> list[str]:
+    """
+    Return the IDs that identify the usage tracked by a tracking method.
+
+    Parameters:
+    - `session`: The session of the invocation.
+    - `user_id`: The unique identifier of the user.
+    - `tracking_method`: The method to use for tracking usage.
+
+    Returns:
+    - `parts`: The app, user or conversation IDs. Joined, they form the plain identifier.
+    """
+    if tracking_method == "workspace-user":
+        return [user_id]
+    if tracking_method == "app-user":
+        return [f"{session.app_id}", user_id]
+    if tracking_method == "app":
+        return [f"{session.app_id}"]
+    if tracking_method == "conversation":
+        return [session.conversation_id]
+    raise ValueError("Invalid tracking method")
+
+
+def storage_key(
+    parts: list[str],
+    tracking_method: str,
+    limit_strategy: str,
+    duration_seconds: int | str,
+    key_format: str = "plain"
+) -> str:
+    """
+    Derive the storage key of the usage record of an identifier.
+
+    Plain keys are the joined identifier parts, as written by earlier versions of the
+    plugin. Namespaced keys prefix the strategy, window and tracking method, so nodes
+    with different strategies or windows on the same identifier keep separate records,
+    and percent-encode every part, so separators inside IDs cannot make two
+    identifiers share a key. Hashed keys are the BLAKE2b-128 digest of the namespaced
+    key and have a fixed length regardless of the IDs.
+
+    Parameters:
+    - `parts`: The identifier parts returned by `identifier_parts`.
+    - `tracking_method`: The method to use for tracking usage.
+    - `limit_strategy`: The windowing strategy of the record.
+    - `duration_seconds`: The duration of the window in seconds, or of a millisecond window
+       such as "500ms".
+    - `key_format`: The key format, "plain", "namespaced" or "hashed". Default is "plain".
+
+    Returns:
+    - `key`: The storage key.
+    """
+    if key_format == "plain":
+        return "".join(parts)
+    if key_format not in KEY_FORMATS:
+        raise ValueError("Invalid key format")
+    key = KEY_SEPARATOR.join([
+        KEY_PREFIX, limit_strategy, str(duration_seconds), tracking_method,
+        *(quote(part, safe="") for part in parts)
+    ])
+    if key_format == "hashed":
+        digest = blake2b(key.encode(), digest_size=KEY_DIGEST_SIZE).hexdigest()
+        return f"{KEY_PREFIX}{KEY_SEPARATOR}{digest}"
+    return key
@@ -0,0 +1,201 @@
+# pylint: disable=missing-module-docstring
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, TypeVar
+
+from dify_plugin.config.logger_format import plugin_logger_handler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(plugin_logger_handler)
+
+T = TypeVar("T")
+
+# Upper bounds of the histogram buckets, in seconds and bytes.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+# How often the collected metrics are written to the plugin log.
+LOG_INTERVAL_SECONDS = 60.0
+
+# The type and help text of every exported metric.
+METRIC_TYPES = {
+    "usage_limit_decisions_total": (
+        "counter", "Usages evaluated, by mode, tracking method, strategy and decision."),
+    "usage_limit_denials_total": (
+        "counter", "Denied usages, by tracking method and reason."),
+    "usage_limit_strategy_seconds": (
+        "histogram", "Time spent evaluating a limit strategy."),
+    "usage_limit_storage_seconds": (
+        "histogram", "Latency of storage operations, by operation."),
+    "usage_limit_record_bytes": (
+        "histogram", "Size of the usage records read and written, by operation."),
+    "usage_limit_record_cache_total": (
+        "counter", "Record cache lookups, by result."),
+}
+
+Labels = tuple[tuple[str, str], ...]
+# The bucket bounds, the count per bucket and the sum of a histogram
+Histogram = tuple[tuple[float, ...], list[int], list[float]]
+
+
+class Metrics:
+    """
+    Process-wide counters and histograms of the Usage Limit tool.
+
+    Metrics are only collected by invocations that enable them, and every hook in
+    the hot path is skipped with a single check otherwise. Histograms have fixed
+    buckets, so observing a value is a bisection and two additions. The metrics
+    are exported in the Prometheus text format by `render` and written to the plugin
+    log every `LOG_INTERVAL_SECONDS` by `maybe_log`.
+    """
+
+    def __init__(self):
+        self._counters: dict[tuple[str, Labels], float] = {}
+        self._histograms: dict[tuple[str, Labels], Histogram] = {}
+        self._next_log = 0.0
+        # Only held for dictionary operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, labels: dict[str, str] | None = None, amount: float = 1) -> None:
+        """
+        Add `amount` to a counter.
+
+        Parameters:
+        - `name`: The name of the counter.
+        - `labels` (optional): The labels of the counter.
+        - `amount`: The amount to add. Default is 1.
+        """
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...],
+                labels: dict[str, str] | None = None) -> None:
+        """
+        Record a value in a histogram.
+
+        Parameters:
+        - `name`: The name of the histogram.
+        - `value`: The observed value.
+        - `buckets`: The upper bounds of the histogram buckets, ascending.
+        - `labels` (optional): The labels of the histogram.
+        """
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        bucket = bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # The last bucket counts the values above every bound
+                histogram = self._histograms[key] = (buckets, [0] * (len(buckets) + 1), [0.0])
+            histogram[1][bucket] += 1
+            histogram[2][0] += value
+
+    def timed(self, operation: str, func: Callable[..., T], *args: Any) -> T:
+        """
+        Call a storage operation and record its latency.
+
+        Parameters:
+        - `operation`: The name of the operation, e.g. "get".
+        - `func`: The storage method to call.
+        - `args`: The arguments of the storage method.
+
+        Returns:
+        - `result`: The result of the storage method.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.observe("usage_limit_storage_seconds", time.perf_counter() - start,
+                         LATENCY_BUCKETS, {"operation": operation})
+
+    def render(self) -> str:
+        """Return the collected metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (buckets, list(counts), sums[0])
+                          for key, (buckets, counts, sums) in self._histograms.items()}
+        lines = []
+        for name, (metric_type, description) in METRIC_TYPES.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for (metric, labels), (buckets, counts, total) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, float("inf")), counts):
+                    cumulative += count
+                    bucket_labels = (*labels, ("le", _format_value(bound)))
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        Return the collected metrics as a JSON-serializable summary.
+
+        Returns:
+        - `metrics`: The value of every counter, and the count and sum of every histogram,
+           keyed by name and labels.
+        """
+        with self._lock:
+            counters = {_series(key): value for key, value in self._counters.items()}
+            histograms = {_series(key): {"count": sum(counts), "sum": sums[0]}
+                          for key, (_, counts, sums) in self._histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def maybe_log(self, now: float) -> bool:
+        """
+        Write a snapshot of the metrics to the plugin log if the last one is
+        `LOG_INTERVAL_SECONDS` old.
+
+        Parameters:
+        - `now`: The current time in seconds, e.g. of `time.monotonic`.
+
+        Returns:
+        - `logged`: Whether a snapshot was written.
+        """
+        with self._lock:
+            if now < self._next_log:
+                return False
+            self._next_log = now + LOG_INTERVAL_SECONDS
+        logger.info("usage-limit metrics %s", json.dumps(self.snapshot(), sort_keys=True))
+        return True
+
+    def clear(self) -> None:
+        """Forget all collected metrics."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._next_log = 0.0
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _series(key: tuple[str, Labels]) -> str:
+    name, labels = key
+    return name + _format_labels(labels)
+
+
+METRICS = Metrics()
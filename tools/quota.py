@@ -0,0 +1,133 @@
+# pylint: disable=missing-module-docstring
+import threading
+import time
+from typing import Any
+
+from tools.storage import VersionedStorage, retry_on_conflict
+
+# The plugin storage size granted in manifest.yaml.
+STORAGE_QUOTA_BYTES = 1_048_576
+# Storage key of the byte total shared by all plugin processes.
+QUOTA_KEY = "usage-limit-quota"
+# Byte changes are added to the shared total once they reach this size, and the
+# total written by other processes is re-read after QUOTA_REFRESH_SECONDS.
+QUOTA_FLUSH_BYTES = 1024
+QUOTA_REFRESH_SECONDS = 60.0
+# Compact records are used from PRESSURE_RATIO of the quota until the usage falls
+# below RELIEF_RATIO again.
+PRESSURE_RATIO = 0.8
+RELIEF_RATIO = 0.6
+
+
+class StorageQuota:
+    """
+    Running total of the bytes the plugin stored in the plugin storage.
+
+    Every process adds the size changes of the records it writes and deletes to a
+    local delta, and adds the delta to a total shared through the storage once it
+    reaches `QUOTA_FLUSH_BYTES`, so the total costs a storage write every few hundred
+    invocations instead of one per invocation. The total only covers records written
+    while accounting was enabled, and lags behind other processes by their unflushed
+    deltas.
+
+    The quota is under pressure from `PRESSURE_RATIO` of the capacity until the total
+    falls below `RELIEF_RATIO` again, so identifiers do not switch representation on
+    every write near the threshold.
+    """
+
+    def __init__(self, capacity: int = STORAGE_QUOTA_BYTES):
+        self.capacity = capacity
+        self._stored_total = 0
+        self._pending = 0
+        self._refreshed_at: float | None = None
+        self._under_pressure = False
+        # Only held for counter operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def used_bytes(self, backend: Any) -> int:
+        """
+        Return the bytes used by the plugin, re-reading the shared total when it is stale.
+
+        Parameters:
+        - `backend`: The plugin storage.
+
+        Returns:
+        - `used_bytes`: The shared total plus the changes not yet added to it.
+        """
+        with self._lock:
+            refreshed_at = self._refreshed_at
+        if refreshed_at is None or time.monotonic() - refreshed_at >= QUOTA_REFRESH_SECONDS:
+            stored_total = self._read_total(VersionedStorage(backend))
+            with self._lock:
+                self._stored_total = stored_total
+                self._refreshed_at = time.monotonic()
+        with self._lock:
+            return max(0, self._stored_total + self._pending)
+
+    def under_pressure(self, backend: Any) -> bool:
+        """Return whether records should be stored in their compact representation."""
+        used_bytes = self.used_bytes(backend)
+        with self._lock:
+            if used_bytes >= PRESSURE_RATIO * self.capacity:
+                self._under_pressure = True
+            elif used_bytes < RELIEF_RATIO * self.capacity:
+                self._under_pressure = False
+            return self._under_pressure
+
+    def record(self, backend: Any, delta: int) -> None:
+        """
+        Account for records that grew by `delta` bytes, or shrank if it is negative.
+
+        Parameters:
+        - `backend`: The plugin storage.
+        - `delta`: The change of the stored bytes.
+        """
+        with self._lock:
+            self._pending += delta
+            pending = self._pending
+            if abs(pending) < QUOTA_FLUSH_BYTES:
+                return
+            self._pending = 0
+        try:
+            stored_total = retry_on_conflict(
+                QUOTA_KEY, self._add, VersionedStorage(backend), pending)
+        except Exception:
+            with self._lock:
+                self._pending += pending
+            raise
+        with self._lock:
+            self._stored_total = stored_total
+            self._refreshed_at = time.monotonic()
+
+    def stats(self) -> dict[str, Any]:
+        """Return the last known byte total, the capacity and whether it is under pressure."""
+        with self._lock:
+            return {
+                "used_bytes": max(0, self._stored_total + self._pending),
+                "capacity_bytes": self.capacity,
+                "under_pressure": self._under_pressure,
+            }
+
+    def clear(self) -> None:
+        """Forget the known total and the unflushed changes."""
+        with self._lock:
+            self._stored_total = 0
+            self._pending = 0
+            self._refreshed_at = None
+            self._under_pressure = False
+
+    @staticmethod
+    def _read_total(storage: VersionedStorage) -> int:
+        try:
+            return int(storage.get(QUOTA_KEY))
+        # pylint: disable=broad-except
+        except Exception:
+            return 0
+
+    def _add(self, storage: VersionedStorage, delta: int) -> int:
+        total = max(0, self._read_total(storage) + delta)
+        storage.set(QUOTA_KEY, str(total).encode())
+        return total
+
+
+QUOTA = StorageQuota()
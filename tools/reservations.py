@@ -0,0 +1,95 @@
+# pylint: disable=missing-module-docstring
+import uuid
+
+from tools.encoding import decode_expiry_index, encode_expiry_index
+from tools.storage import VersionedStorage
+
+# Prefix of the storage key of the reservations committed against a usage record.
+RESERVATIONS_KEY_PREFIX = "usage-limit-reservations#"
+# Default lifetime of a reservation handed out by a peek.
+RESERVATION_SECONDS = 600
+# Longest lifetime of a reservation, which also bounds how long the reservations record
+# of a usage record is kept.
+MAX_RESERVATION_SECONDS = 86400
+RESERVATION_SEPARATOR = "."
+
+
+def new_reservation_id(expires_at: int) -> str:
+    """
+    Create a reservation ID that can be committed until `expires_at`.
+
+    The expiry is part of the ID, so handing out a reservation does not write storage.
+
+    Parameters:
+    - `expires_at`: The epoch after which the reservation can no longer be committed.
+
+    Returns:
+    - `reservation_id`: The expiry and a random nonce.
+    """
+    return f"{expires_at}{RESERVATION_SEPARATOR}{uuid.uuid4().hex}"
+
+
+def reservation_expiry(reservation_id: str) -> int:
+    """
+    Return the epoch after which a reservation can no longer be committed.
+
+    Parameters:
+    - `reservation_id`: The ID returned by `new_reservation_id`.
+
+    Returns:
+    - `expires_at`: The expiry of the reservation.
+    """
+    expires_at, separator, nonce = reservation_id.partition(RESERVATION_SEPARATOR)
+    if not separator or not nonce or not expires_at.isdigit():
+        raise ValueError("Invalid reservation ID")
+    return int(expires_at)
+
+
+def reservations_key(key: str) -> str:
+    """Return the storage key of the reservations committed against a usage record."""
+    return f"{RESERVATIONS_KEY_PREFIX}{key}"
+
+
+def claim_reservation(
+    storage: VersionedStorage,
+    key: str,
+    reservation_id: str,
+    now: int
+) -> int | None:
+    """
+    Record that a reservation was committed against the usage record `key`.
+
+    The committed reservations of a record are kept in one record until they expire,
+    so committing the same reservation again, e.g. when a node is retried, is detected
+    and the usage is not counted twice. Run it with `retry_on_conflict`, so two
+    concurrent commits of the same reservation cannot both claim it. The expiry in the
+    ID is capped at `MAX_RESERVATION_SECONDS` from now, so a forged ID cannot keep the
+    record indefinitely.
+
+    Parameters:
+    - `storage`: The storage of the usage records.
+    - `key`: The storage key of the usage record.
+    - `reservation_id`: The ID returned by `new_reservation_id`.
+    - `now`: The current epoch.
+
+    Returns:
+    - `expires_at`: The latest expiry of the committed reservations of the record once
+       the reservation was claimed, or None if it was committed before.
+    """
+    expires_at = min(reservation_expiry(reservation_id), now + MAX_RESERVATION_SECONDS)
+    if expires_at <= now:
+        raise ValueError("Reservation expired")
+    try:
+        committed = decode_expiry_index(storage.get(reservations_key(key)))
+    # pylint: disable=broad-except
+    except Exception:
+        committed = {}
+    if reservation_id in committed:
+        return None
+    committed = {
+        committed_id: committed_expiry
+        for committed_id, committed_expiry in committed.items() if committed_expiry > now
+    }
+    committed[reservation_id] = expires_at
+    storage.set(reservations_key(key), encode_expiry_index(committed))
+    return max(committed.values())
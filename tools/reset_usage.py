@@ -4,7 +4,15 @@ from collections.abc import Generator
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
+from tools.backends import StorageBackend, backend_from_parameters, runtime_credentials
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.clock import SYSTEM_CLOCK, Clock
 from tools.exceptions import FailedToDeleteStorageItemException
+from tools.identifiers import IDENTIFIERS
+from tools.keys import identifier_parts, storage_key
+from tools.quota import QUOTA
+from tools.sharding import SHARD_COUNTS, shard_key
+from tools.storage import WRITE_BEHIND
 
 
 class ResetUsageTool(Tool):
@@ -15,31 +23,161 @@ class ResetUsageTool(Tool):
     The tool is invoked with the following parameters:
     - `user_id`: The unique identifier of the user.
     - `tracking_method`: The tracking method to use for identifying usage limits.
+    - `shard_count` (optional): The number of shards the usage of the identifier is split
+       across. Default is 1.
+    - `storage_backend` (optional): The storage backend holding the usage records,
+       "session", "sqlite" or "redis", the server of the `redis_url` provider credential.
+       Default is "session".
+    - `storage_path` (optional): The database file of the "sqlite" backend.
+    - `key_format` (optional): The key format of the Usage Limit tool, "plain",
+       "namespaced" or "hashed". Default is "plain".
+    - `limit_strategy` (optional): The strategy of the Usage Limit tool, part of namespaced
+       and hashed keys. Default is "sliding".
+    - `duration_seconds` (optional): The window of the Usage Limit tool, part of namespaced
+       and hashed keys. Default is 3600 seconds.
+    - `duration_milliseconds` (optional): The millisecond window of the Usage Limit tool,
+       part of namespaced and hashed keys instead of `duration_seconds`.
+    - `quota_accounting` (optional): Whether the freed bytes are subtracted from the
+       plugin storage usage counted by the Usage Limit tool. Default is false.
+    - `reset_scope` (optional): "identifier" resets the identifier of `user_id`. "all" resets
+       every record the Usage Limit tool indexed under the tracking method and the app of
+       the session, up to `RESET_BATCH` records per invocation, and reports how many are
+       left. Default is "identifier".
+    - `older_than_seconds` (optional): With the "all" scope, only reset records that were
+       not used for this many seconds.
+
+    The current time is read from `clock`.
     """
 
+    clock: Clock = SYSTEM_CLOCK
+
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
+        reset_scope = tool_parameters.get("reset_scope") or "identifier"
+        if reset_scope == "all":
+            yield self.create_json_message(self._reset_all(tool_parameters))
+            return
+        if reset_scope != "identifier":
+            raise ValueError("Invalid reset scope")
         user_id = tool_parameters["user_id"]
         tracking_method = tool_parameters["tracking_method"]
+        shard_count = int(tool_parameters.get("shard_count") or 1)
+        storage = backend_from_parameters(
+            self.session, tool_parameters, runtime_credentials(self.runtime))
+        quota_accounting = bool(tool_parameters.get("quota_accounting")) and (
+            tool_parameters.get("storage_backend") or "session") == "session"
 
-        identifier = user_id
-        if tracking_method == "workspace-user":
-            identifier = user_id
-        elif tracking_method == "app-user":
-            identifier = f"{self.session.app_id}{user_id}"
-        elif tracking_method == "app":
-            identifier = f"{self.session.app_id}"
-        elif tracking_method == "conversation":
-            identifier = self.session.conversation_id
-        elif tracking_method is not None:
-            raise ValueError("Invalid tracking method")
+        if tracking_method is None:
+            identifier = key = user_id
+        else:
+            parts = identifier_parts(self.session, user_id, tracking_method)
+            identifier = "".join(parts)
+            duration_milliseconds = tool_parameters.get("duration_milliseconds")
+            window = f"{int(duration_milliseconds)}ms" if duration_milliseconds not in (
+                None, "") else int(tool_parameters.get("duration_seconds") or 3600)
+            key = storage_key(
+                parts, tracking_method, tool_parameters.get("limit_strategy") or "sliding",
+                window, tool_parameters.get("key_format") or "plain")
 
-        try:
-            self.session.storage.delete(identifier)
-        except Exception as e:
-            # Log the exception, ignore because it could be that the entry does not exist.
-            raise FailedToDeleteStorageItemException(identifier, e) from e
+        DENY_CACHE.invalidate(key)
+        freed_bytes = 0
+        if quota_accounting:
+            record_keys = [shard_key(key, shard) for shard in range(shard_count)] \
+                if shard_count > 1 else [key]
+            freed_bytes = sum(self._stored_size(storage, record_key) for record_key in record_keys)
+        if shard_count > 1:
+            self._delete_shards(storage, key, shard_count)
+        else:
+            RECORD_CACHE.invalidate(key)
+            # A record that was not written yet is reset by dropping it
+            pending = WRITE_BEHIND.discard(key)
+            try:
+                storage.delete(key)
+            except Exception as e:
+                # Log the exception, ignore because it could be that the entry does not exist.
+                if not pending:
+                    raise FailedToDeleteStorageItemException(identifier, e) from e
+        if quota_accounting:
+            QUOTA.record(storage, -freed_bytes)
 
         yield self.create_json_message({
             "identifier": identifier,
             "status": "Reset successfully completed"
         })
+
+    def _reset_all(self, tool_parameters: dict[str, Any]) -> dict[str, Any]:
+        """
+        Reset a batch of the records indexed under the tracking method and the app of the
+        session, optionally only those unused for `older_than_seconds`.
+
+        Parameters:
+        - `tool_parameters`: The tool parameters selecting the records and the backend.
+
+        Returns:
+        - `message`: The JSON message reporting the deleted and remaining records.
+        """
+        tracking_method = tool_parameters["tracking_method"]
+        if tracking_method not in ("workspace-user", "app-user", "app", "conversation"):
+            raise ValueError("Invalid tracking method")
+        older_than_seconds = tool_parameters.get("older_than_seconds")
+        older_than_seconds = None if older_than_seconds in (None, "") else int(older_than_seconds)
+        if older_than_seconds is not None and older_than_seconds < 0:
+            raise ValueError("Invalid older than seconds")
+        storage = backend_from_parameters(
+            self.session, tool_parameters, runtime_credentials(self.runtime))
+        quota_accounting = bool(tool_parameters.get("quota_accounting")) and (
+            tool_parameters.get("storage_backend") or "session") == "session"
+        app_id = "" if tracking_method == "workspace-user" else f"{self.session.app_id}"
+
+        deleted, freed_bytes, remaining = IDENTIFIERS.reset(
+            storage, tracking_method, app_id, int(self.clock.time()), older_than_seconds,
+            measure=quota_accounting)
+        if quota_accounting:
+            QUOTA.record(storage, -freed_bytes)
+        return {
+            "tracking_method": tracking_method,
+            "deleted_keys": deleted,
+            "remaining_keys": remaining,
+            "complete": not remaining,
+            "status": "Reset successfully completed" if not remaining
+            else "Reset in progress, invoke again to continue",
+        }
+
+    def _stored_size(self, storage: StorageBackend, key: str) -> int:
+        """
+        Return the size of a stored record in bytes, or 0 if it does not exist.
+        """
+        try:
+            return len(storage.get(key))
+        # pylint: disable=broad-except
+        except Exception:
+            return 0
+
+    def _delete_shards(self, storage: StorageBackend, identifier: str, shard_count: int) -> None:
+        """
+        Delete all shards of a sharded identifier.
+
+        Shards that never received a usage do not exist, so individual failures are
+        ignored as long as at least one shard was deleted.
+
+        Parameters:
+        - `storage`: The storage backend holding the shards.
+        - `identifier`: The sharded identifier.
+        - `shard_count`: The number of shards of the identifier.
+        """
+        SHARD_COUNTS.invalidate(identifier)
+        deleted = 0
+        error = None
+        for shard in range(shard_count):
+            RECORD_CACHE.invalidate(shard_key(identifier, shard))
+            pending = WRITE_BEHIND.discard(shard_key(identifier, shard))
+            try:
+                storage.delete(shard_key(identifier, shard))
+                deleted += 1
+            # pylint: disable=broad-except
+            except Exception as e:
+                if pending:
+                    deleted += 1
+                else:
+                    error = e
+        if not deleted:
+            raise FailedToDeleteStorageItemException(identifier, error) from error
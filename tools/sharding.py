@@ -0,0 +1,78 @@
+# pylint: disable=missing-module-docstring
+import random
+import time
+import zlib
+
+# Upper bound of sharded identifiers whose aggregate is cached per process.
+SHARD_CACHE_SIZE = 1024
+
+
+def shard_key(identifier: str, shard: int) -> str:
+    """
+    Return the storage key of one shard of a sharded identifier.
+    """
+    return f"{identifier}#{shard}"
+
+
+def choose_shard(user_id: str, shard_count: int, shard_by: str) -> int:
+    """
+    Choose the shard that receives the usage of this invocation.
+
+    Parameters:
+    - `user_id`: The unique identifier of the user.
+    - `shard_count`: The number of shards of the identifier.
+    - `shard_by`: "user" to always pick the same shard for a user, or "random"
+       to spread every write evenly across all shards.
+
+    Returns:
+    - `shard`: The chosen shard.
+    """
+    if shard_by == "user":
+        return zlib.crc32(user_id.encode()) % shard_count
+    if shard_by == "random":
+        return random.randrange(shard_count)
+    raise ValueError("Invalid shard selection")
+
+
+class ShardCountCache:
+    """
+    Process-wide cache of the per-shard counts of sharded identifiers.
+
+    Counts are cached together with the fixed window they belong to, so a cached
+    aggregate is never used across a window reset.
+    """
+
+    def __init__(self, max_entries: int = SHARD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: dict[str, tuple[int, float, dict[int, int]]] = {}
+
+    def get(self, identifier: str, window_start: int, max_age: float) -> dict[int, int] | None:
+        """Return the cached counts if they are for `window_start` and younger than `max_age`."""
+        entry = self._entries.get(identifier)
+        if entry is None:
+            return None
+        cached_window, fetched_at, counts = entry
+        if cached_window != window_start or time.monotonic() - fetched_at > max_age:
+            return None
+        return counts
+
+    def put(self, identifier: str, window_start: int, counts: dict[int, int]) -> None:
+        """Cache freshly read counts."""
+        self._entries.pop(identifier, None)
+        if len(self._entries) >= self.max_entries:
+            # Evict the entry that was refreshed least recently
+            del self._entries[next(iter(self._entries))]
+        self._entries[identifier] = (window_start, time.monotonic(), counts)
+
+    def update(self, identifier: str, window_start: int, shard: int, count: int) -> None:
+        """Write the count of a shard through to a cached aggregate of the same window."""
+        entry = self._entries.get(identifier)
+        if entry is not None and entry[0] == window_start:
+            entry[2][shard] = count
+
+    def invalidate(self, identifier: str) -> None:
+        """Drop the cached counts of an identifier."""
+        self._entries.pop(identifier, None)
+
+
+SHARD_COUNTS = ShardCountCache()
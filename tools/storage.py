@@ -0,0 +1,530 @@
+# pylint: disable=missing-module-docstring
+import atexit
+import itertools
+import random
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import ExitStack, contextmanager
+from typing import Any, Callable, TypeVar
+
+from tools.backends import RedisStorage, SQLiteStorage
+from tools.cache import RecordCache
+from tools.encoding import decode_versioned, encode_versioned
+from tools.exceptions import StorageConflictException
+from tools.metrics import SIZE_BUCKETS, Metrics
+
+T = TypeVar("T")
+
+# Number of attempts and bounds of the exponential backoff between them when a
+# usage update loses the race against a concurrent update of the same record.
+CONFLICT_ATTEMPTS = 8
+CONFLICT_BACKOFF_SECONDS = 0.002
+CONFLICT_MAX_BACKOFF_SECONDS = 0.05
+
+# Records written behind are flushed at most WRITE_BEHIND_BATCH at a time, and the
+# flusher looks for due records every WRITE_BEHIND_TICK_SECONDS. At most
+# WRITE_BEHIND_MAX_PENDING records are held per process, further writes are written
+# synchronously. Draining the queue at shutdown gives up after WRITE_BEHIND_DRAIN_SECONDS.
+WRITE_BEHIND_BATCH = 500
+WRITE_BEHIND_TICK_SECONDS = 0.05
+WRITE_BEHIND_MAX_PENDING = 10000
+WRITE_BEHIND_DRAIN_SECONDS = 10.0
+
+_KEY_LOCKS: list[Any] = [None] * 64
+_KEY_LOCKS_GUARD = threading.Lock()
+
+
+def key_lock(key: str) -> Any:
+    """
+    Return the process-wide lock that serializes updates of a storage key.
+
+    Keys are mapped onto a fixed set of locks, so memory does not grow with the
+    number of identifiers.
+    """
+    index = hash(key) % len(_KEY_LOCKS)
+    lock = _KEY_LOCKS[index]
+    if lock is None:
+        # Locks are created on first use so they honour the gevent monkey
+        # patching applied by dify_plugin, which may happen after this import.
+        with _KEY_LOCKS_GUARD:
+            lock = _KEY_LOCKS[index]
+            if lock is None:
+                lock = _KEY_LOCKS[index] = threading.RLock()
+    return lock
+
+
+@contextmanager
+def keys_lock(keys: list[str]) -> Iterator[None]:
+    """
+    Hold the locks of several storage keys.
+
+    The locks are always acquired in the same order, so two callers locking
+    overlapping keys cannot deadlock.
+    """
+    locks = {id(lock): lock for lock in map(key_lock, keys)}
+    with ExitStack() as stack:
+        for _, lock in sorted(locks.items()):
+            stack.enter_context(lock)
+        yield
+
+
+def retry_on_conflict(key: str | list[str], operation: Callable[..., T], *args: Any) -> T:
+    """
+    Run a read-modify-write operation on a storage key until it wins the race.
+
+    Each attempt holds the lock of `key`, so updates from the same plugin process
+    never conflict. Updates from other processes are detected by `VersionedStorage`,
+    in which case the operation is re-run on the fresh record after a randomized,
+    exponentially growing backoff.
+
+    Parameters:
+    - `key`: The storage key updated by the operation, or a list of keys.
+    - `operation`: The operation to run.
+    - `args`: The arguments passed to the operation.
+
+    Returns:
+    - The return value of the operation.
+    """
+    attempt = 0
+    while True:
+        try:
+            with key_lock(key) if isinstance(key, str) else keys_lock(key):
+                return operation(*args)
+        except StorageConflictException:
+            attempt += 1
+            if attempt >= CONFLICT_ATTEMPTS:
+                raise
+        time.sleep(random.uniform(
+            0, min(CONFLICT_MAX_BACKOFF_SECONDS, CONFLICT_BACKOFF_SECONDS * 2 ** attempt)))
+
+
+def stored_version(backend: Any, key: str, metrics: Metrics | None = None) -> tuple[int, int]:
+    """
+    Read the version stamp of a stored record.
+
+    Parameters:
+    - `backend`: The storage backend holding the record.
+    - `key`: The storage key of the record.
+    - `metrics` (optional): The metrics the latency of the read is recorded in.
+
+    Returns:
+    - `version`, `size`: The version stamp and the size of the record, 0 if it does not
+       exist or is unreadable, which is overwritten like on the first read.
+    """
+    try:
+        if metrics is None:
+            record = backend.get(key)
+        else:
+            record = metrics.timed("get", backend.get, key)
+    # pylint: disable=broad-except
+    except Exception:
+        return 0, 0
+    try:
+        return decode_versioned(record)[0], len(record)
+    # pylint: disable=broad-except
+    except Exception:
+        return 0, len(record)
+
+
+def compare_and_set(backend: Any, records: dict[str, tuple[int, bytes]],
+                    metrics: Metrics | None = None,
+                    sizes: dict[str, int] | None = None) -> dict[str, int]:
+    """
+    Write versioned records if every stored record still carries the expected version.
+
+    The SQLite and Redis backends check and write all records atomically. The plugin
+    session storage has no conditional write, so its versions are read before the
+    records are written, and a write of another process between the two is lost.
+
+    Parameters:
+    - `backend`: The storage backend holding the records.
+    - `records`: The expected version stamp and the new versioned record of every key.
+    - `metrics` (optional): The metrics the latency of the storage operations is
+       recorded in.
+    - `sizes` (optional): Filled with the size of the stored record of every key
+       missing from it.
+
+    Returns:
+    - `conflicts`: The version stamp found under every key that did not carry the
+       expected one. Nothing was written if it is not empty.
+    """
+    if isinstance(backend, (SQLiteStorage, RedisStorage)):
+        if sizes is not None:
+            for key in records.keys() - sizes.keys():
+                sizes[key] = stored_version(backend, key, metrics)[1]
+        if metrics is None:
+            return backend.compare_and_set(records)
+        return metrics.timed("set", backend.compare_and_set, records)
+    conflicts = {}
+    for key, (expected_version, _) in records.items():
+        version, size = stored_version(backend, key, metrics)
+        if sizes is not None:
+            sizes.setdefault(key, size)
+        if version != expected_version:
+            conflicts[key] = version
+    if conflicts:
+        return conflicts
+    for key, (_, record) in records.items():
+        if metrics is None:
+            backend.set(key, record)
+        else:
+            metrics.timed("set", backend.set, key, record)
+    return conflicts
+
+
+class WriteBehindQueue:
+    """
+    Process-wide queue of usage records that are written after their usage was decided.
+
+    A queued record replaces the pending record of its key, so every usage of an
+    identifier within the delay is merged into a single write. Records are flushed by a
+    background thread once their delay has passed since the first usage merged into
+    them, `WRITE_BEHIND_BATCH` records at a time, and the queue is drained when the
+    process exits. Reads of `VersionedStorage` return the pending record, so the usages
+    decided by this process are never lost to its own later decisions.
+
+    A flush writes the record with `compare_and_set` like `VersionedStorage.set`. If
+    another process wrote the record since it was read, the stored record wins and the
+    usages merged into the pending record are dropped, which is counted in `conflicts`.
+    """
+
+    def __init__(self, max_pending: int = WRITE_BEHIND_MAX_PENDING,
+                 batch: int = WRITE_BEHIND_BATCH):
+        self.max_pending = max_pending
+        self.batch = batch
+        self.queued = 0
+        self.merged = 0
+        self.flushed = 0
+        self.conflicts = 0
+        self.failed = 0
+        # The backend, record cache, versioned record and flush time of every pending key
+        self._pending: dict[str, tuple[Any, RecordCache | None, bytes, float]] = {}
+        self._flusher: threading.Thread | None = None
+        # Only held for dictionary operations that never yield to another greenlet
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        """Return the pending versioned record of `key`, if any."""
+        entry = self._pending.get(key)
+        return None if entry is None else entry[2]
+
+    def put(self, key: str, backend: Any, cache: RecordCache | None, record: bytes,
+            delay_seconds: float) -> bool:
+        """
+        Queue a versioned record to be written to `backend` after `delay_seconds`.
+
+        Parameters:
+        - `key`: The storage key of the record.
+        - `backend`: The storage backend the record is written to.
+        - `cache` (optional): The record cache invalidated once the record is flushed.
+        - `record`: The versioned record, one version ahead of the record it was read from.
+        - `delay_seconds`: The delay before the record is written, unless it merges into a
+           pending record, which keeps its flush time.
+
+        Returns:
+        - `queued`: Whether the record was queued, or the queue is full and the record
+           must be written synchronously.
+        """
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None and len(self._pending) >= self.max_pending:
+                return False
+            flush_at = entry[3] if entry is not None else time.monotonic() + delay_seconds
+            self._pending[key] = (backend, cache, record, flush_at)
+            self.queued += 1
+            self.merged += entry is not None
+            start = self._flusher is None
+            if start:
+                self._flusher = threading.Thread(
+                    target=self._run, name="usage-limit-write-behind", daemon=True)
+        if start:
+            self._flusher.start()
+        return True
+
+    def discard(self, key: str) -> bool:
+        """
+        Drop the pending record of `key`, e.g. because the record is deleted.
+
+        Returns:
+        - `discarded`: Whether a pending record was dropped.
+        """
+        with key_lock(key):
+            with self._lock:
+                return self._pending.pop(key, None) is not None
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Write up to `batch` pending records whose delay has passed.
+
+        Parameters:
+        - `force`: Whether pending records are written before their delay has passed.
+
+        Returns:
+        - `flushed`: The number of pending records written or dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            keys = list(itertools.islice(
+                (key for key, entry in self._pending.items() if force or entry[3] <= now),
+                self.batch))
+        for key in keys:
+            self._flush_key(key)
+        return len(keys)
+
+    def drain(self, timeout_seconds: float = WRITE_BEHIND_DRAIN_SECONDS) -> int:
+        """
+        Write all pending records, e.g. at shutdown.
+
+        Parameters:
+        - `timeout_seconds`: The time after which the remaining records are given up.
+
+        Returns:
+        - `remaining`: The number of pending records that were not written.
+        """
+        deadline = time.monotonic() + timeout_seconds
+        while self._pending and time.monotonic() < deadline:
+            self.flush(force=True)
+        return len(self._pending)
+
+    def clear(self) -> None:
+        """Drop all pending records and reset the counters."""
+        with self._lock:
+            self._pending.clear()
+            self.queued = self.merged = self.flushed = self.conflicts = self.failed = 0
+
+    def stats(self) -> dict[str, int]:
+        """Return the counters and the number of pending records."""
+        with self._lock:
+            return {"queued": self.queued, "merged": self.merged, "flushed": self.flushed,
+                    "conflicts": self.conflicts, "failed": self.failed,
+                    "pending": len(self._pending)}
+
+    def _run(self) -> None:
+        while True:
+            if not self.flush():
+                time.sleep(WRITE_BEHIND_TICK_SECONDS)
+            with self._lock:
+                if not self._pending:
+                    # Started again by the next queued record
+                    self._flusher = None
+                    return
+
+    def _flush_key(self, key: str) -> None:
+        with key_lock(key):
+            entry = self._pending.get(key)
+            if entry is None:
+                # Discarded or flushed since it was selected
+                return
+            backend, cache, record, _ = entry
+            outcome = "flushed"
+            try:
+                if compare_and_set(backend, {key: (decode_versioned(record)[0] - 1, record)}):
+                    # Written by another process since it was read, which wins
+                    outcome = "conflicts"
+            # pylint: disable=broad-except
+            except Exception:
+                outcome = "failed"
+            if cache is not None:
+                cache.invalidate(key)
+            with self._lock:
+                del self._pending[key]
+                setattr(self, outcome, getattr(self, outcome) + 1)
+
+
+WRITE_BEHIND = WriteBehindQueue()
+atexit.register(WRITE_BEHIND.drain)
+
+
+class VersionedStorage:
+    """
+    Optimistic concurrency control on top of the plugin storage.
+
+    Every record is wrapped with a version stamp that is incremented on each write.
+    `get` remembers the version it read, and `set` writes the record with
+    `compare_and_set` and raises `StorageConflictException` instead of overwriting a
+    newer record.
+
+    With a `cache` and a positive `cache_seconds`, `get` is served from records read
+    or written by this process within the last `cache_seconds`. Writes and deletes
+    always go through to the storage and update the cache. The version check of
+    `set` bypasses the cache, so a stale cached record causes a conflict, which
+    evicts it before the update is retried.
+
+    Within `staged()`, writes are buffered and only written once the block completes.
+    Within `discarded()`, they are buffered and dropped. The keys written so far are
+    collected in `written`, and the bytes they grew by in `written_bytes`.
+
+    With `metrics`, the latency of every storage operation and the size of every record
+    read or written are recorded.
+
+    With a `write_behind` queue, `get` returns the records pending in the queue, and
+    writes and deletes drop them. With a positive `write_behind_seconds`, `set` queues
+    the record instead of writing it, without checking its version, which is checked
+    when the queue writes it `write_behind_seconds` later.
+    """
+
+    def __init__(self, storage: Any, cache: RecordCache | None = None, cache_seconds: float = 0,
+                 metrics: Metrics | None = None, write_behind: WriteBehindQueue | None = None,
+                 write_behind_seconds: float = 0):
+        self._storage = storage
+        self.metrics = metrics
+        self.write_behind = write_behind
+        self.write_behind_seconds = write_behind_seconds
+        self._versions: dict[str, int] = {}
+        self.cache = cache
+        self.cache_seconds = cache_seconds
+        self._staged: dict[str, bytes] | None = None
+        self._discarding = False
+        self.written: set[str] = set()
+        self.written_bytes = 0
+        self._sizes: dict[str, int] = {}
+
+    @property
+    def backend(self) -> Any:
+        """The storage backend holding the records."""
+        return self._storage
+
+    @property
+    def discarding(self) -> bool:
+        """Whether writes are dropped by an enclosing `discarded()` block."""
+        return self._discarding
+
+    def get(self, key: str) -> bytes:
+        """Read a record and remember its version for the next `set`."""
+        if self._staged is not None and key in self._staged:
+            return self._staged[key]
+        if self.write_behind is not None:
+            pending = self.write_behind.get(key)
+            if pending is not None:
+                version, payload = decode_versioned(pending)
+                # Flushed only if the stored record is still the one it was read from
+                self._versions[key] = version - 1
+                self._sizes[key] = len(pending)
+                return payload
+        record = None
+        if self.cache is not None and self.cache_seconds > 0:
+            record = self.cache.get(key, self.cache_seconds)
+            if self.metrics is not None:
+                self.metrics.increment("usage_limit_record_cache_total",
+                                       {"result": "miss" if record is None else "hit"})
+        if record is None:
+            if self.metrics is None:
+                record = self._storage.get(key)
+            else:
+                record = self.metrics.timed("get", self._storage.get, key)
+                self.metrics.observe("usage_limit_record_bytes", len(record), SIZE_BUCKETS,
+                                     {"operation": "get"})
+            if self.cache is not None and self.cache_seconds > 0:
+                self.cache.put(key, record)
+        self._sizes[key] = len(record)
+        version, payload = decode_versioned(record)
+        self._versions[key] = version
+        return payload
+
+    def set(self, key: str, value: bytes) -> None:
+        """Write a record if nobody else wrote it since it was read."""
+        if self._staged is not None:
+            self._staged[key] = value
+            return
+        with key_lock(key):
+            if not self._queue(key, value):
+                self._write({key: value})
+
+    @contextmanager
+    def staged(self) -> Iterator[None]:
+        """
+        Buffer the writes of a block and write them together if it completes.
+
+        Writes are discarded if the block raises. All staged records are written with
+        one `compare_and_set`, so a conflict on any record leaves all of them unchanged.
+        Within an enclosing `staged()` or `discarded()` block, the writes are left to the
+        enclosing block.
+        """
+        if self._staged is not None:
+            yield
+            return
+        self._staged = {}
+        try:
+            yield
+            staged = self._staged
+        finally:
+            self._staged = None
+        with keys_lock(list(staged)):
+            staged = {key: value for key, value in staged.items() if not self._queue(key, value)}
+            if staged:
+                self._write(staged)
+
+    @contextmanager
+    def discarded(self) -> Iterator[None]:
+        """
+        Buffer the writes of a block and drop them, so the block never writes storage.
+
+        Reads within the block see the buffered writes, so a usage update can be
+        evaluated without counting the usage.
+        """
+        self._staged = {}
+        self._discarding = True
+        try:
+            yield
+        finally:
+            self._staged = None
+            self._discarding = False
+
+    def delete(self, key: str) -> None:
+        """Delete a record."""
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if self.write_behind is not None:
+            self.write_behind.discard(key)
+        if self.metrics is None:
+            self._storage.delete(key)
+        else:
+            self.metrics.timed("delete", self._storage.delete, key)
+        self._versions.pop(key, None)
+        self.written_bytes -= self._sizes.pop(key, 0)
+
+    def _queue(self, key: str, value: bytes) -> bool:
+        """Queue a record behind the decision if write-behind is enabled and has room."""
+        if self.write_behind is None or self.write_behind_seconds <= 0:
+            return False
+        record = encode_versioned(self._versions.get(key, 0) + 1, value)
+        if not self.write_behind.put(key, self._storage, self.cache, record,
+                                     self.write_behind_seconds):
+            return False
+        self.written.add(key)
+        self.written_bytes += len(record) - self._sizes.get(key, 0)
+        self._sizes[key] = len(record)
+        return True
+
+    def _write(self, values: dict[str, bytes]) -> None:
+        """Write records one version ahead of the ones read, or raise a conflict."""
+        if self.write_behind is not None:
+            for key in values:
+                # Written through, so a pending record of another node is outdated
+                self.write_behind.discard(key)
+        records = {}
+        for key, value in values.items():
+            version = self._versions.get(key, 0)
+            records[key] = (version, encode_versioned(version + 1, value))
+        conflicts = compare_and_set(self._storage, records, self.metrics, self._sizes)
+        if conflicts:
+            if self.cache is not None:
+                for key in conflicts:
+                    self.cache.invalidate(key)
+            key, actual_version = next(iter(conflicts.items()))
+            raise StorageConflictException(key, records[key][0], actual_version)
+        for key, (version, record) in records.items():
+            if self.metrics is not None:
+                self.metrics.observe("usage_limit_record_bytes", len(record), SIZE_BUCKETS,
+                                     {"operation": "set"})
+            if self.cache is not None:
+                if self.cache_seconds > 0:
+                    self.cache.put(key, record)
+                else:
+                    # Keep the records cached for other nodes coherent
+                    self.cache.invalidate(key)
+            self._versions[key] = version + 1
+            self.written.add(key)
+            self.written_bytes += len(record) - self._sizes.get(key, 0)
+            self._sizes[key] = len(record)
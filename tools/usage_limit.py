@@ -1,11 +1,54 @@
 # pylint: disable=missing-module-docstring
+import bisect
+import json
 import time
 from typing import Any, Tuple
 from collections.abc import Generator
 
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
+from tools.backends import RedisStorage, backend_from_parameters, runtime_credentials
+from tools.cache import DENY_CACHE, RECORD_CACHE
+from tools.clock import SYSTEM_CLOCK, Clock
+from tools.encoding import (
+    COUNTER_V1,
+    WEIGHTED_TIMESTAMPS_V1,
+    WEIGHTED_TIMESTAMPS_V2,
+    append_timestamp,
+    decode_arrival_time,
+    decode_buckets,
+    decode_counter,
+    decode_tiers,
+    decode_weighted_timestamps,
+    encode_arrival_time,
+    encode_buckets,
+    encode_counter,
+    encode_tiers,
+    encode_weighted_timestamps,
+    timestamp_offsets,
+)
 from tools.exceptions import UsageLimitExceededException
+from tools.expiry import EXPIRY
+from tools.identifiers import IDENTIFIERS
+from tools.keys import identifier_parts, storage_key
+from tools.metrics import LATENCY_BUCKETS, METRICS
+from tools.quota import QUOTA
+from tools.reservations import (
+    MAX_RESERVATION_SECONDS,
+    RESERVATION_SECONDS,
+    claim_reservation,
+    new_reservation_id,
+    reservations_key,
+)
+from tools.sharding import SHARD_COUNTS, choose_shard, shard_key
+from tools.storage import WRITE_BEHIND, VersionedStorage, retry_on_conflict
+
+MODES = ("consume", "peek", "commit")
+# Limit passed to the strategies when committed usages are counted unconditionally.
+# Redis scripts compute in doubles, which represent every integer up to 2**53.
+UNENFORCED_LIMIT = 2 ** 53
+# Longest millisecond window. Millisecond records store 32-bit offsets, which span 49 days.
+MAX_WINDOW_MILLISECONDS = 86_400_000
 
 
 class UsageLimitTool(Tool):
@@ -13,7 +56,8 @@ class UsageLimitTool(Tool):
     The `UsageLimitTool` class is a Dify node designed to track and manage usage limits for users.
     It operates by identifying usage based on a specified tracking method, either by user, app,
     or conversation session. It checks if the current usage exceeds a predefined limit using
-    either a fixed window or sliding window strategy.
+    a fixed window, sliding window, sliding window counter, bucketed sliding window or
+    generic cell rate algorithm (GCRA) strategy.
 
     The tool is expected to be invoked on each message with the following parameters:
     - `user_id`: The unique identifier of the user.
@@ -21,83 +65,800 @@ class UsageLimitTool(Tool):
        "app", or "conversation".
     - `limit`: The maximum number of times the usage can occur before being limited.
     - `duration_seconds` (optional): The duration of the window in seconds. Default is 3600 seconds.
-    - `limit_strategy` (optional): The windowing strategy to use. Can be "fixed" or "sliding".
-       Default is "sliding".
+    - `duration_milliseconds` (optional): The duration of the window in milliseconds, up to a
+       day, instead of `duration_seconds`. Usages are timed to the millisecond, so short
+       windows such as 5 per 10 seconds protect against floods exactly. Only supported by
+       the "fixed" and "sliding" strategies, and reports `reset_seconds` as a fraction.
+    - `limit_strategy` (optional): The windowing strategy to use. Can be "fixed", "sliding",
+       "sliding-counter", "sliding-buckets" or "gcra". Default is "sliding".
+    - `bucket_count` (optional): The number of buckets the window is divided into by the
+       "sliding-buckets" strategy. Default is 24.
+    - `burst` (optional): The number of usages the "gcra" strategy allows at once.
+       Default is `limit`.
+    - `shard_count` (optional): The number of storage keys the counter of the "fixed"
+       strategy is split across to spread the writes of hot identifiers. Default is 1.
+    - `shard_by` (optional): How the shard of a write is chosen. Can be "user" or "random".
+       Default is "user".
+    - `shard_cache_seconds` (optional): How long the summed usage of the other shards is
+       cached in the plugin process. Default is 0, which reads all shards on every call.
+    - `record_cache_seconds` (optional): How long usage records read or written by the
+       plugin process are served from its cache. Default is 0, which disables the cache.
+    - `write_behind_seconds` (optional): How long updated usage records are held in the
+       plugin process before they are written, merging the usages of an identifier within
+       that time into one write. The usage is reported without waiting for storage.
+       Default is 0, which writes every usage before reporting it.
+    - `deny_cache` (optional): Whether the plugin process remembers denied identifiers and
+       rejects them without reading storage until their usage decreases. Default is false.
+    - `storage_backend` (optional): Where usage records are stored. Can be "session" for the
+       plugin storage, "sqlite" for a database on the plugin host or "redis" for the Redis
+       server of the `redis_url` provider credential. Default is "session".
+    - `storage_path` (optional): The database file of the "sqlite" backend.
+    - `record_expiry` (optional): Whether written records are indexed with the time they
+       expire, so they are deleted by an incremental sweep once they no longer affect any
+       usage. Default is false.
+    - `index_identifiers` (optional): Whether written records are indexed under their tracking
+       method and app with the time they were last used, so the Reset Usage tool can reset
+       all records of an app or those unused for a while. Default is false.
+    - `quota_accounting` (optional): Whether the bytes written to the plugin storage are
+       counted against its quota. Under pressure, sliding windows of users and conversations
+       are stored as constant-size sliding window counters. Default is false.
+    - `tiers` (optional): Further windows of the "sliding-counter" strategy as comma
+       separated `limit/duration_seconds` pairs, e.g. "500/86400, 5000/2592000". All
+       windows are counted in one record, and the usage is only counted if every window
+       allows it.
+    - `key_format` (optional): How the storage keys of the usage records are derived. Can be
+       "plain" for the identifier, "namespaced" for a key per strategy and window or "hashed"
+       for a fixed-length hash of the namespaced key. Default is "plain".
+    - `cost` (optional): The weight of the usage, e.g. the tokens of a request. Usages are
+       denied once their summed weight would exceed the limit. Default is 1.
+    - `mode` (optional): "consume" counts the usage. "peek" only reports the usage and whether
+       a usage would be allowed, without writing storage, and returns a reservation ID.
+       "commit" counts the usage of a reservation ID, even if it exceeds the limit, and
+       counts it only once however often the reservation is committed. Default is "consume".
+    - `reservation_id` (optional): The reservation ID returned by a peek, required by "commit".
+    - `reservation_seconds` (optional): How long the reservation ID of a peek can be committed.
+       Default is 600.
+    - `collect_metrics` (optional): Whether the decisions, strategy timings and storage
+       latencies of the invocation are collected in the process-wide metrics exported by
+       the metrics endpoint and the plugin log. Default is false.
+    - `rules` (optional): A JSON array of further rules evaluated in the same invocation,
+       each with a `limit` and optionally its own `tracking_method`, `duration_seconds`,
+       `limit_strategy`, `bucket_count`, `burst` and `cost`. The usage is only counted if every
+       rule allows it.
+
+    Concurrent invocations for the same identifier are serialized within the plugin
+    process. Records carry a version stamp, so an update that raced with another
+    process is re-read and retried instead of overwriting the other update.
+
+    The current time is read from `clock`, which can be replaced by a `VirtualClock`
+    to evaluate usage at any time.
     """
 
+    clock: Clock = SYSTEM_CLOCK
+
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage, None, None]:
         user_id = tool_parameters["user_id"]
-        tracking_method = tool_parameters["tracking_method"]
-        limit = int(tool_parameters["limit"])
-        duration_seconds = int(tool_parameters.get("duration_seconds", 3600))
-        limit_strategy = tool_parameters.get("limit_strategy", "sliding")
-
-        # Determine identifier based on tracking_method
-        identifier = self._get_identifier(user_id, tracking_method)
-
-        if limit_strategy == "fixed":
-            current_usage, reset_seconds = self._fixed_window_usage(
-                identifier, limit, duration_seconds)
-        elif limit_strategy == "sliding":
-            current_usage, reset_seconds = self._sliding_window_usage(
-                identifier, limit, duration_seconds)
+        rules = [tool_parameters, *self._parse_rules(tool_parameters)]
+        if len(rules) > 1 and any(int(rule.get("shard_count") or 1) > 1 for rule in rules):
+            raise ValueError("Sharding is not supported with rules")
+
+        key_format = tool_parameters.get("key_format") or "plain"
+        mode = tool_parameters.get("mode") or "consume"
+        if mode not in MODES:
+            raise ValueError("Invalid mode")
+        if mode == "commit" and not tool_parameters.get("reservation_id"):
+            raise ValueError("Missing reservation ID")
+        evaluations = []
+        # The identifier reported for each storage key
+        names = {}
+        for rule in rules:
+            limit = int(rule["limit"])
+            duration_milliseconds = self._duration_milliseconds(rule)
+            limit_strategy = rule.get("limit_strategy", "sliding")
+            if duration_milliseconds is None:
+                duration_seconds = int(rule.get("duration_seconds", 3600))
+                window = duration_seconds
+            else:
+                duration_seconds = -(-duration_milliseconds // 1000)
+                window = f"{duration_milliseconds}ms"
+            identifier, key = self._get_storage_key(
+                user_id, rule, limit_strategy, window, key_format)
+            names[key] = identifier
+            evaluations.append((key, limit, duration_seconds, limit_strategy, rule))
+        identifiers = [evaluation[0] for evaluation in evaluations]
+        if len(set(identifiers)) != len(identifiers):
+            if key_format == "plain":
+                raise ValueError("Rules must use different tracking methods")
+            raise ValueError("Rules must use different tracking methods, strategies or windows")
+        # Tool.__init__ is final, so the storage is opened per invocation
+        # pylint: disable=attribute-defined-outside-init
+        self._metrics = METRICS if tool_parameters.get("collect_metrics") else None
+        self._storage = self._open_storage(tool_parameters)
+        # Only the plugin storage has a quota
+        quota_accounting = bool(tool_parameters.get("quota_accounting")) and (
+            tool_parameters.get("storage_backend") or "session") == "session"
+        if quota_accounting and QUOTA.under_pressure(self._storage.backend):
+            # Timestamp records grow with the limit, counters have a constant size
+            evaluations = [
+                (identifier, limit, duration_seconds,
+                 "sliding-counter" if limit_strategy == "sliding"
+                 and rule["tracking_method"] != "app"
+                 and self._duration_milliseconds(rule) is None else limit_strategy, rule)
+                for identifier, limit, duration_seconds, limit_strategy, rule in evaluations
+            ]
+
+        deny_cache = bool(tool_parameters.get("deny_cache"))
+        # Denials only apply to invocations with the same limit configuration
+        deny_scopes = {
+            identifier: (limit_strategy, limit, duration_seconds, rule.get("bucket_count"),
+                         rule.get("burst"), rule.get("shard_count"), rule.get("tiers"),
+                         rule.get("cost"), rule.get("duration_milliseconds"))
+            for identifier, limit, duration_seconds, limit_strategy, rule in evaluations
+        }
+        reservation = None
+        reservations_expiry = None
+        if mode == "commit":
+            # Retried commits of the same reservation report the usage without counting it
+            reservation_id = tool_parameters["reservation_id"]
+            reservations_expiry = retry_on_conflict(
+                reservations_key(identifiers[0]), claim_reservation,
+                self._storage, identifiers[0], reservation_id, int(self.clock.time()))
+            committed = reservations_expiry is not None
+            reservation = {"reservation_id": reservation_id, "committed": committed}
+            if not committed:
+                mode = "peek"
+        elif mode == "peek":
+            reservation_seconds = int(
+                tool_parameters.get("reservation_seconds") or RESERVATION_SECONDS)
+            if not 1 <= reservation_seconds <= MAX_RESERVATION_SECONDS:
+                raise ValueError("Invalid reservation seconds")
+            reservation = {"reservation_id": new_reservation_id(
+                int(self.clock.time()) + reservation_seconds)}
+        if mode == "peek":
+            results = [self._peek_strategy(user_id, *evaluation) for evaluation in evaluations]
+            reservation["allowed"] = all(result[3]["allowed"] for result in results)
+            if self._metrics is not None:
+                for evaluation, result in zip(evaluations, results):
+                    self._count_decision(mode, evaluation, None if result[3]["allowed"] else
+                                         "cost" if result[3]["retry_after"] is None else "limit")
+            if "committed" not in reservation and not reservation["allowed"]:
+                del reservation["reservation_id"]
+        elif mode == "commit":
+            # The usage already happened, so it is counted even if it exceeds the limit
+            if len(evaluations) == 1:
+                results = [self._apply_strategy(user_id, *evaluations[0], enforce=False)]
+            else:
+                results = retry_on_conflict(
+                    identifiers, self._apply_rules, user_id, evaluations, False)
+            if self._metrics is not None:
+                for evaluation in evaluations:
+                    self._count_decision(mode, evaluation)
         else:
-            raise ValueError("Invalid window strategy")
+            results = self._consume(user_id, evaluations, names, deny_scopes, deny_cache)
+        sweep = None
+        # The indexes are written through their own storage, so their bytes are added
+        index_bytes = 0
+        # Peeks never write, not even a sweep
+        if tool_parameters.get("record_expiry") and mode != "peek":
+            sweep, index_bytes = self._expire_records(evaluations, reservations_expiry)
+        if tool_parameters.get("index_identifiers") and mode != "peek":
+            index_bytes += self._index_identifiers(evaluations)
+        if quota_accounting:
+            QUOTA.record(self._storage.backend, self._storage.written_bytes + index_bytes -
+                         (sweep[1] if sweep else 0))
 
-        remaining_usage = max(0, limit - current_usage)
+        messages = []
+        for (identifier, limit, *_), result in zip(evaluations, results):
+            current_usage, reset_seconds, capacity, extra_fields = result
+            messages.append({
+                "identifier": names[identifier],
+                "limit": limit,
+                "current_usage": current_usage,
+                "remaining_usage": max(0, capacity - current_usage),
+                "reset_seconds": reset_seconds,
+                **extra_fields
+            })
+        message = {**messages[0], "rules": messages} if len(messages) > 1 else messages[0]
+        if reservation is not None:
+            message.update(reservation)
+        if sweep is not None:
+            message["expired_records"], message["reclaimed_bytes"] = sweep
+        if quota_accounting:
+            message["storage_quota"] = QUOTA.stats()
+        if self._metrics is not None:
+            self._metrics.maybe_log(time.monotonic())
+        yield self.create_json_message(message)
 
-        yield self.create_json_message({
-            "identifier": identifier,
-            "limit": limit,
-            "current_usage": current_usage,
-            "remaining_usage": remaining_usage,
-            "reset_seconds": reset_seconds
+    def _consume(
+        self,
+        user_id: str,
+        evaluations: list[tuple[str, int, int, str, dict[str, Any]]],
+        names: dict[str, str],
+        deny_scopes: dict[str, tuple],
+        deny_cache: bool
+    ) -> list[Tuple[int, int, int, dict[str, Any]]]:
+        """
+        Count one usage against every rule, consulting and filling the deny cache.
+
+        Parameters:
+        - `user_id`: The unique identifier of the user.
+        - `evaluations`: The identifier, limit, duration, strategy and parameters of each rule.
+        - `names`: The identifier reported for each storage key.
+        - `deny_scopes`: The limit configuration a cached denial of each storage key applies to.
+        - `deny_cache`: Whether denials are cached.
+
+        Returns:
+        - `results`: The result of `_apply_strategy` for each rule.
+        """
+        identifiers = [evaluation[0] for evaluation in evaluations]
+        if deny_cache:
+            for identifier, scope in deny_scopes.items():
+                denial = DENY_CACHE.get(identifier, scope, self.clock.time())
+                if denial is not None:
+                    if self._metrics is not None:
+                        self._count_decision("consume", evaluations[identifiers.index(identifier)],
+                                             "cached")
+                    denied_until, denied_limit, denied_usage = denial
+                    raise UsageLimitExceededException(
+                        names[identifier], denied_limit, denied_usage,
+                        denied_until - self.clock.time())
+
+        try:
+            if len(evaluations) == 1:
+                results = [self._apply_strategy(user_id, *evaluations[0])]
+            else:
+                results = retry_on_conflict(identifiers, self._apply_rules, user_id, evaluations)
+        except UsageLimitExceededException as e:
+            if self._metrics is not None:
+                self._count_decision("consume", evaluations[identifiers.index(e.identifier)],
+                                     "cost" if e.retry_after is None else "limit")
+            if deny_cache and e.retry_after:
+                DENY_CACHE.put(e.identifier, deny_scopes[e.identifier],
+                               self.clock.time() + e.retry_after, e.limit, e.current_usage)
+            if names[e.identifier] == e.identifier:
+                raise
+            raise UsageLimitExceededException(
+                names[e.identifier], e.limit, e.current_usage, e.retry_after) from e
+        if self._metrics is not None:
+            for evaluation in evaluations:
+                self._count_decision("consume", evaluation)
+        return results
+
+    def _count_decision(
+        self,
+        mode: str,
+        evaluation: tuple[str, int, int, str, dict[str, Any]],
+        denial: str | None = None
+    ) -> None:
+        """
+        Count the decision of a rule in the collected metrics.
+
+        Parameters:
+        - `mode`: The mode of the invocation.
+        - `evaluation`: The identifier, limit, duration, strategy and rule of the rule.
+        - `denial` (optional): Why the usage was denied, "limit" if it exceeds the limit,
+           "cost" if its cost exceeds the limit or "cached" if the identifier was denied
+           by the deny cache. None if the usage was allowed.
+        """
+        _, _, _, limit_strategy, rule = evaluation
+        tracking_method = f"{rule.get('tracking_method')}"
+        self._metrics.increment("usage_limit_decisions_total", {
+            "mode": mode,
+            "tracking_method": tracking_method,
+            "strategy": limit_strategy,
+            "decision": "allowed" if denial is None else "denied",
         })
+        if denial is not None:
+            self._metrics.increment("usage_limit_denials_total", {
+                "tracking_method": tracking_method, "reason": denial})
 
-    def _get_identifier(self, user_id: str, tracking_method: str) -> str:
+    def _peek_strategy(
+        self,
+        user_id: str,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        limit_strategy: str,
+        tool_parameters: dict[str, Any]
+    ) -> Tuple[int, int, int, dict[str, Any]]:
         """
-        Determine the identifier based on the tracking method.
+        Report the usage of the identifier and whether a usage would be allowed, without
+        counting it.
+
+        The usage is evaluated as usual with every write discarded, so peeking never
+        writes storage.
 
         Parameters:
         - `user_id`: The unique identifier of the user.
-        - `tracking_method`: The method to use for tracking usage.
-        
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum number of allowed usages.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `limit_strategy`: The windowing strategy to use.
+        - `tool_parameters`: The tool parameters or rule holding strategy specific options.
+
+        Returns:
+        - `current_usage`: The current usage count.
+        - `reset_seconds`: The seconds until the usage decreases.
+        - `capacity`: The usage count at which further usages are denied.
+        - `extra_fields`: Strategy specific fields of the JSON message, whether a usage would
+           be allowed and, if not, the seconds until it is.
+        """
+        try:
+            with self._storage.discarded():
+                current_usage, reset_seconds, capacity, extra_fields = self._apply_strategy(
+                    user_id, identifier, limit, duration_seconds, limit_strategy,
+                    tool_parameters, dry_run=True)
+        except UsageLimitExceededException as e:
+            if e.retry_after is None:
+                # The cost exceeds the limit, so report the usage of a single usage instead
+                current_usage, reset_seconds, capacity, extra_fields = self._peek_strategy(
+                    user_id, identifier, limit, duration_seconds, limit_strategy,
+                    {**tool_parameters, "cost": 1})
+                return current_usage, reset_seconds, capacity, {
+                    **extra_fields, "allowed": False, "retry_after": None}
+            fields = {"limit": e.limit} if e.limit != limit else {}
+            return e.current_usage, -(-e.retry_after // 1), e.limit, {
+                **fields, "allowed": False, "retry_after": e.retry_after}
+
+        cost = int(tool_parameters.get("cost") or 1)
+        current_usage -= cost
+        if "tiers" in extra_fields:
+            extra_fields["tiers"] = [{
+                **tier,
+                "current_usage": tier["current_usage"] - cost,
+                "remaining_usage": max(0, tier["limit"] - tier["current_usage"] + cost),
+            } for tier in extra_fields["tiers"]]
+        if "retry_after" in extra_fields:
+            extra_fields["retry_after"] = 0
+        if current_usage <= 0:
+            return current_usage, 0, capacity, {**extra_fields, "allowed": True}
+        if limit_strategy in ("gcra", "sliding-counter"):
+            # The usage postpones their reset, unlike the oldest usage or window start the
+            # other strategies reset at, so the current usage is evaluated without it
+            with self._storage.discarded():
+                reset_seconds = self._apply_strategy(
+                    user_id, identifier, limit, duration_seconds, limit_strategy,
+                    tool_parameters, dry_run=True, cost=0)[1]
+        return current_usage, reset_seconds, capacity, {**extra_fields, "allowed": True}
+
+    def _parse_rules(self, tool_parameters: dict[str, Any]) -> list[dict[str, Any]]:
+        """
+        Parse the additional rules evaluated together with the rule of the tool parameters.
+
+        Parameters:
+        - `tool_parameters`: The tool parameters holding the `rules` JSON array.
+
+        Returns:
+        - `rules`: The additional rules, which track usage with the tool's tracking method
+           and cost unless they specify their own.
+        """
+        rules = tool_parameters.get("rules")
+        if not rules:
+            return []
+        try:
+            if isinstance(rules, str):
+                rules = json.loads(rules)
+        except ValueError as e:
+            raise ValueError("Invalid rules") from e
+        if not isinstance(rules, list) or not all(
+                isinstance(rule, dict) and "limit" in rule for rule in rules):
+            raise ValueError("Invalid rules")
+        return [{"tracking_method": tool_parameters["tracking_method"],
+                 "cost": tool_parameters.get("cost"), **rule} for rule in rules]
+
+    def _apply_rules(
+        self,
+        user_id: str,
+        evaluations: list[tuple[str, int, int, str, dict[str, Any]]],
+        enforce: bool = True
+    ) -> list[Tuple[int, int, int, dict[str, Any]]]:
+        """
+        Count one usage against every rule, or against none if any rule denies it.
+
+        The updated records are staged and only written once every rule passed, so a
+        denial by one rule does not consume the quota of the others. On Redis, the fixed
+        and sliding windows are checked and counted together by one server-side script
+        instead, so they are never written in another format than single rules write them.
+
+        Parameters:
+        - `user_id`: The unique identifier of the user.
+        - `evaluations`: The identifier, limit, duration, strategy and parameters of each rule.
+        - `enforce`: Whether usages exceeding a limit are denied instead of counted.
+
+        Returns:
+        - `results`: The result of `_apply_strategy` for each rule.
+        """
+        redis = self._storage.backend
+        if isinstance(redis, RedisStorage):
+            windows = []
+            for identifier, limit, duration_seconds, limit_strategy, rule in evaluations:
+                shard_count, window, milliseconds, cost, capacity, _ = self._strategy_options(
+                    identifier, limit, duration_seconds, limit_strategy, rule, enforce)
+                if limit_strategy in ("fixed", "sliding") and shard_count == 1:
+                    windows.append((identifier, limit_strategy,
+                                    limit if enforce else UNENFORCED_LIMIT, window, cost,
+                                    milliseconds))
+            if len(windows) == len(evaluations):
+                metrics = self._metrics
+                started = time.perf_counter() if metrics is not None else 0.0
+                try:
+                    results = self._redis_window_usage(redis, windows)
+                finally:
+                    if metrics is not None:
+                        # Every rule waits for the same round-trip
+                        for _, _, _, limit_strategy, _ in evaluations:
+                            metrics.observe("usage_limit_strategy_seconds",
+                                            time.perf_counter() - started, LATENCY_BUCKETS,
+                                            {"strategy": limit_strategy})
+                return [(current_usage, reset_seconds, capacity, {})
+                        for (current_usage, reset_seconds), (_, capacity, _, _, _)
+                        in zip(results, evaluations)]
+            if windows:
+                raise ValueError("Rules on the Redis backend cannot combine fixed or sliding "
+                                 "windows with other strategies")
+        with self._storage.staged():
+            return [self._apply_strategy(user_id, *evaluation, atomic=False, enforce=enforce)
+                    for evaluation in evaluations]
+
+    def _strategy_options(
+        self,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        limit_strategy: str,
+        tool_parameters: dict[str, Any],
+        enforce: bool = True,
+        cost: int | None = None
+    ) -> tuple[int, int, bool, int, int, list[tuple[int, int]] | None]:
+        """
+        Parse and validate the strategy specific options of a rule.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum number of allowed usages.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `limit_strategy`: The windowing strategy to use.
+        - `tool_parameters`: The tool parameters or rule holding strategy specific options.
+        - `enforce`: Whether usages exceeding the limit are denied instead of counted.
+        - `cost` (optional): The weight of the usage instead of the validated `cost` of
+           `tool_parameters`, e.g. 0 to evaluate the current usage.
+
+        Returns:
+        - `shard_count`: The number of shards of the fixed window.
+        - `window`: The duration of the window in seconds, or in milliseconds with
+           `milliseconds`.
+        - `milliseconds`: Whether the window is timed in milliseconds.
+        - `cost`: The weight of the usage.
+        - `capacity`: The usage count at which further usages are denied.
+        - `tiers`: The limit and duration of every tier, or None.
+        """
+        shard_count = int(tool_parameters.get("shard_count") or 1)
+        if shard_count < 1:
+            raise ValueError("Invalid shard count")
+        if shard_count > 1 and limit_strategy != "fixed":
+            raise ValueError("Sharding is only supported by the fixed strategy")
+        if tool_parameters.get("tiers") and limit_strategy != "sliding-counter":
+            raise ValueError("Tiers are only supported by the sliding-counter strategy")
+        duration_milliseconds = self._duration_milliseconds(tool_parameters)
+        milliseconds = duration_milliseconds is not None
+        if milliseconds and limit_strategy not in ("fixed", "sliding"):
+            raise ValueError(
+                "Millisecond windows are only supported by the fixed and sliding strategies")
+        if milliseconds and shard_count > 1:
+            raise ValueError("Sharding is not supported by millisecond windows")
+        # The fixed and sliding windows are counted in the unit of their duration
+        window = duration_milliseconds if milliseconds else duration_seconds
+
+        if cost is None:
+            cost = tool_parameters.get("cost")
+            cost = 1 if cost in (None, "") else int(cost)
+            if cost < 1:
+                raise ValueError("Invalid cost")
+            if cost != 1 and milliseconds and limit_strategy == "sliding":
+                raise ValueError(
+                    "Weighted usage is not supported by millisecond sliding windows")
+        capacity = limit
+        if limit_strategy == "gcra":
+            capacity = int(tool_parameters.get("burst") or limit)
+            if capacity < 1:
+                raise ValueError("Invalid burst")
+        tiers = None
+        if limit_strategy == "sliding-counter" and tool_parameters.get("tiers"):
+            tiers = self._parse_tiers(limit, duration_seconds, tool_parameters["tiers"])
+        max_cost = min(tier[0] for tier in tiers) if tiers else capacity
+        if cost > max_cost and enforce:
+            # Denied however long the caller waits
+            raise UsageLimitExceededException(identifier, max_cost, cost)
+        return shard_count, window, milliseconds, cost, capacity, tiers
+
+    def _apply_strategy(
+        self,
+        user_id: str,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        limit_strategy: str,
+        tool_parameters: dict[str, Any],
+        atomic: bool = True,
+        dry_run: bool = False,
+        enforce: bool = True,
+        cost: int | None = None
+    ) -> Tuple[int, int, int, dict[str, Any]]:
+        """
+        Count one usage of the identifier with the configured limit strategy.
+
+        Parameters:
+        - `user_id`: The unique identifier of the user.
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum number of allowed usages.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `limit_strategy`: The windowing strategy to use.
+        - `tool_parameters`: The tool parameters or rule holding strategy specific options.
+        - `atomic`: Whether backends with server-side updates may write the usage immediately.
+        - `dry_run`: Whether backends with server-side updates only evaluate the usage. Writes
+           to the other backends are discarded by the caller.
+        - `enforce`: Whether usages exceeding the limit are denied instead of counted.
+        - `cost` (optional): The weight of the usage instead of the `cost` of
+           `tool_parameters`.
+
+        Returns:
+        - `current_usage`: The current usage count after incrementing.
+        - `reset_seconds`: The seconds until the usage decreases.
+        - `capacity`: The usage count at which further usages are denied.
+        - `extra_fields`: Strategy specific fields of the JSON message.
+        """
+        shard_count, window, milliseconds, cost, capacity, tiers = self._strategy_options(
+            identifier, limit, duration_seconds, limit_strategy, tool_parameters, enforce, cost)
+        # Usages that already happened are counted against a limit they cannot reach
+        ceiling = limit if enforce else UNENFORCED_LIMIT
+
+        extra_fields = {}
+        metrics = self._metrics
+        started = time.perf_counter() if metrics is not None else 0.0
+        try:
+            redis = self._storage.backend if atomic else None
+            if not isinstance(redis, RedisStorage):
+                redis = None
+            if limit_strategy == "fixed" and shard_count > 1:
+                shard = choose_shard(
+                    user_id, shard_count, tool_parameters.get("shard_by") or "user")
+                other_usage = self._other_shards_usage(
+                    identifier, shard, shard_count, duration_seconds,
+                    float(tool_parameters.get("shard_cache_seconds") or 0))
+                current_usage, reset_seconds = retry_on_conflict(
+                    shard_key(identifier, shard), self._shard_window_usage,
+                    identifier, shard, other_usage, ceiling, duration_seconds, cost, dry_run)
+            elif limit_strategy in ("fixed", "sliding") and redis is not None:
+                [(current_usage, reset_seconds)] = self._redis_window_usage(
+                    redis, [(identifier, limit_strategy, ceiling, window, cost, milliseconds)],
+                    dry_run)
+            elif limit_strategy == "fixed":
+                current_usage, reset_seconds = retry_on_conflict(
+                    identifier, self._fixed_window_usage, identifier, ceiling, window, cost,
+                    milliseconds)
+            elif limit_strategy == "sliding":
+                current_usage, reset_seconds = retry_on_conflict(
+                    identifier, self._sliding_window_usage, identifier, ceiling, window, cost,
+                    milliseconds)
+            elif limit_strategy == "sliding-counter" and tiers:
+                current_usage, reset_seconds, capacity, extra_fields = retry_on_conflict(
+                    identifier, self._tiered_counter_usage, identifier, tiers, cost, enforce)
+            elif limit_strategy == "sliding-counter":
+                current_usage, reset_seconds = retry_on_conflict(
+                    identifier, self._sliding_counter_usage, identifier, ceiling, duration_seconds,
+                    None, cost)
+            elif limit_strategy == "sliding-buckets":
+                bucket_count = int(tool_parameters.get("bucket_count", 24))
+                if bucket_count < 1:
+                    raise ValueError("Invalid bucket count")
+                bucket_seconds = -(-duration_seconds // bucket_count)
+                current_usage, reset_seconds = retry_on_conflict(
+                    identifier, self._bucketed_window_usage,
+                    identifier, ceiling, bucket_seconds, bucket_count, cost)
+                # Usage expires a whole bucket at a time
+                extra_fields["reset_resolution_seconds"] = bucket_seconds
+            elif limit_strategy == "gcra":
+                current_usage, reset_seconds, retry_after = retry_on_conflict(
+                    identifier, self._gcra_usage, identifier, limit, duration_seconds,
+                    capacity if enforce else UNENFORCED_LIMIT, cost)
+                extra_fields["retry_after"] = retry_after
+            else:
+                raise ValueError("Invalid window strategy")
+        finally:
+            if metrics is not None:
+                metrics.observe("usage_limit_strategy_seconds", time.perf_counter() - started,
+                                LATENCY_BUCKETS, {"strategy": limit_strategy})
+
+        return current_usage, reset_seconds, capacity, extra_fields
+
+    def _expire_records(
+        self,
+        evaluations: list[tuple[str, int, int, str, dict[str, Any]]],
+        reservations_expiry: int | None = None
+    ) -> tuple[tuple[int, int] | None, int]:
+        """
+        Index the records written by this invocation with the time they expire, and sweep
+        expired records if this invocation is due for a sweep.
+
+        Parameters:
+        - `evaluations`: The identifier, limit, duration, strategy and rule of every rule.
+        - `reservations_expiry` (optional): The latest expiry of the committed reservations,
+           if this invocation claimed one.
+
+        Returns:
+        - `sweep`: The records deleted by the sweep and the bytes they occupied, or None if
+           no sweep was due.
+        - `written_bytes`: The bytes the expiry index grew by.
+        """
+        backend = self._storage.backend
+        now = int(self.clock.time())
+        lifetime = max(self._record_lifetime(limit, duration_seconds, limit_strategy, rule)
+                       for _, limit, duration_seconds, limit_strategy, rule in evaluations)
+        reservations = reservations_key(evaluations[0][0])
+        written_bytes = 0
+        for key in sorted(self._storage.written):
+            expires_at = now + lifetime
+            if key == reservations and reservations_expiry is not None:
+                # Kept until its reservations can no longer be committed
+                expires_at = max(expires_at, reservations_expiry)
+            written_bytes += EXPIRY.touch(backend, key, expires_at, lifetime)
+        return EXPIRY.maybe_sweep(backend, now), written_bytes
+
+    def _index_identifiers(
+        self,
+        evaluations: list[tuple[str, int, int, str, dict[str, Any]]]
+    ) -> int:
+        """
+        Index the records written by this invocation under the tracking method and app of
+        their rule, so the Reset Usage tool can reset them in bulk.
+
+        Parameters:
+        - `evaluations`: The identifier, limit, duration, strategy and rule of every rule.
+
+        Returns:
+        - `written_bytes`: The bytes the identifier index grew by.
+        """
+        backend = self._storage.backend
+        now = int(self.clock.time())
+        written = sorted(self._storage.written)
+        written_bytes = 0
+        for key, _, _, _, rule in evaluations:
+            record_keys = [
+                written_key for written_key in written
+                if written_key in (key, reservations_key(key)) or written_key.startswith(f"{key}#")
+            ]
+            if isinstance(backend, RedisStorage) and key not in record_keys:
+                # Written by a Redis script instead of the versioned storage
+                record_keys.append(key)
+            tracking_method = rule["tracking_method"]
+            app_id = "" if tracking_method == "workspace-user" else f"{self.session.app_id}"
+            for record_key in record_keys:
+                written_bytes += IDENTIFIERS.touch(
+                    backend, tracking_method, app_id, record_key, now)
+        return written_bytes
+
+    def _record_lifetime(
+        self,
+        limit: int,
+        duration_seconds: int,
+        limit_strategy: str,
+        tool_parameters: dict[str, Any]
+    ) -> int:
+        """
+        Return the seconds after its last update until a record no longer affects the usage.
+
+        Parameters:
+        - `limit`: The maximum number of allowed usages.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `limit_strategy`: The windowing strategy to use.
+        - `tool_parameters`: The tool parameters or rule holding strategy specific options.
+
+        Returns:
+        - `lifetime`: The lifetime of the record in seconds.
+        """
+        if limit_strategy == "sliding-counter":
+            if tool_parameters.get("tiers"):
+                duration_seconds = max(
+                    tier[1] for tier in self._parse_tiers(
+                        limit, duration_seconds, tool_parameters["tiers"]))
+            # The count of the previous window is weighted into the next one
+            return 2 * duration_seconds
+        if limit_strategy == "sliding-buckets":
+            bucket_count = int(tool_parameters.get("bucket_count", 24))
+            bucket_seconds = -(-duration_seconds // bucket_count)
+            return (bucket_count + 1) * bucket_seconds
+        if limit_strategy == "gcra":
+            burst = int(tool_parameters.get("burst") or limit)
+            return -(-burst * duration_seconds // limit) + 1
+        return duration_seconds + 1
+
+    def _open_storage(self, tool_parameters: dict[str, Any]) -> VersionedStorage:
+        """
+        Open the storage backend selected by the tool parameters with optimistic
+        concurrency control.
+
+        Parameters:
+        - `tool_parameters`: The tool parameters selecting the backend and record caching.
+
+        Returns:
+        - `storage`: The versioned storage of the usage records, recording storage metrics
+           if they are collected and writing records behind if enabled.
+        """
+        backend = backend_from_parameters(
+            self.session, tool_parameters, runtime_credentials(self.runtime))
+        write_behind_seconds = float(tool_parameters.get("write_behind_seconds") or 0)
+        if write_behind_seconds < 0:
+            raise ValueError("Invalid write-behind seconds")
+        if (tool_parameters.get("storage_backend") or "session") != "session":
+            # Local backends are read without a round-trip, so their records are not cached
+            return VersionedStorage(backend, metrics=self._metrics, write_behind=WRITE_BEHIND,
+                                    write_behind_seconds=write_behind_seconds)
+        return VersionedStorage(backend, RECORD_CACHE,
+                                float(tool_parameters.get("record_cache_seconds") or 0),
+                                self._metrics, WRITE_BEHIND, write_behind_seconds)
+
+    def _get_storage_key(
+        self,
+        user_id: str,
+        rule: dict[str, Any],
+        limit_strategy: str,
+        duration_seconds: int | str,
+        key_format: str
+    ) -> Tuple[str, str]:
+        """
+        Determine the identifier based on the tracking method, and the key of its record.
+
+        Parameters:
+        - `user_id`: The unique identifier of the user.
+        - `rule`: The tool parameters or rule holding the tracking method.
+        - `limit_strategy`: The windowing strategy to use.
+        - `duration_seconds`: The duration of the window in seconds, or of a millisecond
+           window such as "500ms".
+        - `key_format`: The format of the storage key.
+
         Returns:
         - `identifier`: The computed identifier based on the tracking method.
+        - `key`: The storage key of the usage record.
         """
-        if tracking_method == "workspace-user":
-            identifier = user_id
-        elif tracking_method == "app-user":
-            identifier = f"{self.session.app_id}{user_id}"
-        elif tracking_method == "app":
-            identifier = f"{self.session.app_id}"
-        elif tracking_method == "conversation":
-            identifier = self.session.conversation_id
-        else:
-            raise ValueError("Invalid tracking method")
-        return identifier
+        tracking_method = rule["tracking_method"]
+        parts = identifier_parts(self.session, user_id, tracking_method)
+        return "".join(parts), storage_key(
+            parts, tracking_method, limit_strategy, duration_seconds, key_format)
 
     def _fixed_window_usage(
         self,
         identifier: str,
         limit: int,
-        duration_seconds: int
+        duration_seconds: int,
+        cost: int = 1,
+        milliseconds: bool = False
     ) -> Tuple[int, int]:
         """
         Implement fixed window usage tracking.
 
+        Millisecond windows store the start of the window as fractional seconds, so
+        records of second windows are read as they are, and records of millisecond
+        windows fail to parse as second windows and start a new window.
+
         Parameters:
         - `identifier`: The identifier for tracking usage.
         - `limit`: The maximum number of allowed usages within the window.
-        - `duration_seconds`: The duration of the window in seconds.
+        - `duration_seconds`: The duration of the window in seconds, or in milliseconds
+           with `milliseconds`.
+        - `cost`: The weight of this usage.
+        - `milliseconds`: Whether the window is timed in milliseconds.
 
         Returns:
         - `current_usage`: The current usage count after incrementing.
+        - `reset_seconds`: The seconds until the window resets.
         """
-        current_time = int(time.time())
+        current_time = self._current_time(milliseconds)
         try:
-            current_usage_bytes = self.session.storage.get(identifier)
-            if current_usage_bytes:
+            current_usage_bytes = self._storage.get(identifier)
+            if current_usage_bytes and milliseconds:
+                stored_usage, stored_start = current_usage_bytes.decode().split(':')
+                current_usage, timestamp = int(stored_usage), round(float(stored_start) * 1000)
+            elif current_usage_bytes:
                 current_usage, timestamp = map(
                     int, current_usage_bytes.decode().split(':'))
             else:
@@ -115,19 +876,161 @@ class UsageLimitTool(Tool):
 
         reset_seconds = max(0, duration_seconds - (current_time - timestamp))
 
-        if current_usage >= limit:
-            raise UsageLimitExceededException(identifier, limit, current_usage)
+        if current_usage + cost > limit:
+            # The window expires one unit after its full duration has passed
+            raise UsageLimitExceededException(
+                identifier, limit, current_usage,
+                self._in_seconds(reset_seconds + 1, milliseconds))
 
-        current_usage += 1
-        self.session.storage.set(identifier, f"{current_usage}:{
-                                 timestamp}".encode())
-        return current_usage, reset_seconds
+        current_usage += cost
+        if milliseconds:
+            self._storage.set(identifier, f"{current_usage}:{timestamp / 1000:.3f}".encode())
+        else:
+            self._storage.set(identifier, f"{current_usage}:{
+                                     timestamp}".encode())
+        return current_usage, self._in_seconds(reset_seconds, milliseconds)
+
+    def _redis_window_usage(
+        self,
+        redis: RedisStorage,
+        windows: list[tuple[str, str, int, int, int, bool]],
+        dry_run: bool = False
+    ) -> list[Tuple[int, int]]:
+        """
+        Implement fixed and sliding window usage tracking with one atomic Redis script,
+        which counts the usage in every window or, if any window denies it, in none.
+
+        Parameters:
+        - `redis`: The Redis backend.
+        - `windows`: The identifier, strategy ("fixed" or "sliding"), limit, duration,
+           cost and whether the window is timed in milliseconds of every window. The
+           duration is in seconds, or in milliseconds for millisecond windows.
+        - `dry_run`: Whether the usage is only evaluated instead of counted.
+
+        Returns:
+        - `results`: The current usage count after incrementing and the seconds until the
+           window resets or its oldest usage leaves it, of every window.
+        """
+        current_times = [self._current_time(milliseconds)
+                         for _, _, _, _, _, milliseconds in windows]
+        denied, results = redis.window_usages([
+            (limit_strategy, identifier, limit, duration, current_time, cost, milliseconds)
+            for (identifier, limit_strategy, limit, duration, cost, milliseconds), current_time
+            in zip(windows, current_times)], dry_run)
+        if denied is not None:
+            identifier, limit_strategy, limit, duration, _, milliseconds = windows[denied]
+            [(current_usage, timestamp)] = results
+            current_time = current_times[denied]
+            if limit_strategy == "fixed":
+                retry_after = max(0, duration - (current_time - timestamp)) + 1
+            else:
+                retry_after = timestamp + duration - current_time
+            raise UsageLimitExceededException(
+                identifier, limit, current_usage, self._in_seconds(retry_after, milliseconds))
+        return [(current_usage, self._in_seconds(
+                    max(0, duration - (current_time - timestamp)), milliseconds))
+                for (current_usage, timestamp), (_, _, _, duration, _, milliseconds), current_time
+                in zip(results, windows, current_times)]
+
+    def _other_shards_usage(
+        self,
+        identifier: str,
+        shard: int,
+        shard_count: int,
+        duration_seconds: int,
+        cache_seconds: float
+    ) -> int:
+        """
+        Sum the usage of all shards of an identifier except one.
+
+        Parameters:
+        - `identifier`: The sharded identifier.
+        - `shard`: The shard to leave out.
+        - `shard_count`: The number of shards of the identifier.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `cache_seconds`: How old a cached aggregate may be before the shards are read again.
+
+        Returns:
+        - `other_usage`: The summed usage of the other shards in the current window.
+        """
+        current_time = int(self.clock.time())
+        window_start = current_time - current_time % duration_seconds
+        counts = None
+        if cache_seconds > 0:
+            counts = SHARD_COUNTS.get(identifier, window_start, cache_seconds)
+        if counts is None:
+            counts = {
+                other: self._shard_count(shard_key(identifier, other), window_start)
+                for other in range(shard_count) if other != shard
+            }
+            SHARD_COUNTS.put(identifier, window_start, counts)
+        return sum(count for other, count in counts.items() if other != shard)
+
+    def _shard_count(self, key: str, window_start: int) -> int:
+        """
+        Read the usage count of a shard, or 0 if it belongs to an earlier window.
+        """
+        try:
+            count, timestamp = map(int, self._storage.get(key).decode().split(':'))
+        # pylint: disable=broad-except
+        except Exception:
+            return 0
+        return count if timestamp == window_start else 0
+
+    def _shard_window_usage(
+        self,
+        identifier: str,
+        shard: int,
+        other_usage: int,
+        limit: int,
+        duration_seconds: int,
+        cost: int = 1,
+        dry_run: bool = False
+    ) -> Tuple[int, int]:
+        """
+        Implement fixed window usage tracking for one shard of a sharded identifier.
+
+        All shards share fixed windows aligned to multiples of `duration_seconds`, so
+        their counts can be summed.
+
+        Parameters:
+        - `identifier`: The sharded identifier.
+        - `shard`: The shard receiving this usage.
+        - `other_usage`: The summed usage of the other shards.
+        - `limit`: The maximum number of allowed usages within the window.
+        - `duration_seconds`: The duration of the window in seconds.
+        - `cost`: The weight of this usage.
+        - `dry_run`: Whether the usage is only evaluated, so the cached aggregate is not updated.
+
+        Returns:
+        - `current_usage`: The usage count of all shards after incrementing.
+        - `reset_seconds`: The seconds until the window resets.
+        """
+        current_time = int(self.clock.time())
+        window_start = current_time - current_time % duration_seconds
+        key = shard_key(identifier, shard)
+        count = self._shard_count(key, window_start)
+
+        if count + other_usage + cost > limit:
+            raise UsageLimitExceededException(
+                identifier, limit, count + other_usage,
+                window_start + duration_seconds - current_time)
+
+        count += cost
+        self._storage.set(key, f"{count}:{window_start}".encode())
+        if not dry_run and not self._storage.discarding:
+            SHARD_COUNTS.update(identifier, window_start, shard, count)
+
+        reset_seconds = window_start + duration_seconds - current_time
+        return count + other_usage, reset_seconds
 
     def _sliding_window_usage(
         self,
         identifier: str,
         limit: int,
-        duration_seconds: int
+        duration_seconds: int,
+        cost: int = 1,
+        milliseconds: bool = False
     ) -> Tuple[int, int]:
         """
         Implement sliding window usage tracking.
@@ -135,39 +1038,520 @@ class UsageLimitTool(Tool):
         Parameters:
         - `identifier`: The identifier for tracking usage.
         - `limit`: The maximum number of allowed usages within the window.
-        - `duration_seconds`: The duration of the sliding window in seconds.
+        - `duration_seconds`: The duration of the sliding window in seconds, or in
+           milliseconds with `milliseconds`.
+        - `cost`: The weight of this usage.
+        - `milliseconds`: Whether the window is timed in milliseconds.
 
         Returns:
         - `current_usage`: The current usage count after incrementing.
+        - `reset_seconds`: The seconds until the oldest usage leaves the window.
         """
-        current_time = int(time.time())
+        current_time = self._current_time(milliseconds)
         try:
-            timestamps_bytes = self.session.storage.get(identifier)
-            if timestamps_bytes:
-                timestamps = list(
-                    map(int, timestamps_bytes.decode().split(',')))
-            else:
-                timestamps = []
+            record = self._storage.get(identifier)
+        # pylint: disable=broad-except
+        except Exception:
+            record = b""
+        # Millisecond windows are never compacted or weighted
+        if not milliseconds and record[:1] == bytes([COUNTER_V1]):
+            # Compacted under storage pressure, kept until a whole window passed without usage
+            stored_start = decode_counter(record)[0]
+            if stored_start > current_time - 2 * duration_seconds:
+                return self._sliding_counter_usage(
+                    identifier, limit, duration_seconds, record, cost)
+        if not milliseconds and (cost != 1 or record[:1] in (
+                bytes([WEIGHTED_TIMESTAMPS_V1]), bytes([WEIGHTED_TIMESTAMPS_V2]))):
+            return self._weighted_window_usage(identifier, limit, duration_seconds, record, cost)
+        try:
+            base, offsets = timestamp_offsets(record, milliseconds)
         # pylint: disable=broad-except
         except Exception:
-            timestamps = []
+            record, base, offsets = b"", 0, []
 
-        window_start = current_time - duration_seconds
-        timestamps = [t for t in timestamps if t > window_start]
+        # Timestamps are sorted, so the expired ones are a prefix found by bisection
+        start = bisect.bisect_right(offsets, current_time - duration_seconds - base)
+        in_window = len(offsets) - start
 
-        if len(timestamps) >= limit:
+        if in_window >= limit:
+            # Wait until enough of the oldest timestamps leave the window
             raise UsageLimitExceededException(
-                identifier, limit, len(timestamps))
-
-        timestamps.append(current_time)
+                identifier, limit, in_window, self._in_seconds(
+                    base + offsets[len(offsets) - limit] + duration_seconds - current_time,
+                    milliseconds))
 
-        timestamps_str = ','.join(map(str, timestamps))
-        self.session.storage.set(identifier, timestamps_str.encode())
+        self._storage.set(identifier, append_timestamp(record, start, current_time, milliseconds))
 
-        current_usage = len(timestamps)
+        current_usage = in_window + 1
         # For sliding window, reset when the oldest timestamp exits the window
-        oldest_timestamp = timestamps[0] if timestamps else current_time
+        oldest_timestamp = base + offsets[start] if in_window else current_time
         reset_seconds = max(0, duration_seconds -
                             (current_time - oldest_timestamp))
 
+        return current_usage, self._in_seconds(reset_seconds, milliseconds)
+
+    def _weighted_window_usage(
+        self,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        record: bytes,
+        cost: int
+    ) -> Tuple[int, int]:
+        """
+        Implement sliding window usage tracking of usages with a weight.
+
+        Every usage is stored with its timestamp and weight, and usages of the same second
+        are merged, so the record grows with the number of usages instead of their weight.
+        Records of unweighted usages are converted on the first weighted usage.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum summed weight of the usages within the window.
+        - `duration_seconds`: The duration of the sliding window in seconds.
+        - `record`: The stored record.
+        - `cost`: The weight of this usage.
+
+        Returns:
+        - `current_usage`: The summed weight of the usages after adding this usage.
+        - `reset_seconds`: The seconds until the oldest usage leaves the window.
+        """
+        current_time = int(self.clock.time())
+        try:
+            usages = decode_weighted_timestamps(record)
+        # pylint: disable=broad-except
+        except Exception:
+            usages = []
+
+        window_start = current_time - duration_seconds
+        usages = [usage for usage in usages if usage[0] > window_start]
+        current_usage = sum(weight for _, weight in usages)
+
+        if current_usage + cost > limit:
+            # Wait until enough of the oldest usages leave the window
+            remaining = current_usage
+            for timestamp, weight in usages:
+                remaining -= weight
+                if remaining + cost <= limit:
+                    break
+            raise UsageLimitExceededException(
+                identifier, limit, current_usage, timestamp + duration_seconds - current_time)
+
+        if usages and usages[-1][0] == current_time:
+            usages[-1] = (current_time, usages[-1][1] + cost)
+        else:
+            usages.append((current_time, cost))
+        self._storage.set(identifier, encode_weighted_timestamps(usages))
+
+        reset_seconds = max(0, duration_seconds - (current_time - usages[0][0]))
+        return current_usage + cost, reset_seconds
+
+    def _sliding_counter_usage(
+        self,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        record: bytes | None = None,
+        cost: int = 1
+    ) -> Tuple[int, int]:
+        """
+        Implement sliding window counter usage tracking.
+
+        The usage is approximated from the counts of the current and the previous
+        fixed window, weighting the previous count by how much of it still overlaps
+        the sliding window. The stored record has a constant size regardless of `limit`.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum number of allowed usages within the window.
+        - `duration_seconds`: The duration of the sliding window in seconds.
+        - `record` (optional): The stored record, if it was already read.
+        - `cost`: The weight of this usage.
+
+        Returns:
+        - `current_usage`: The estimated usage count after incrementing.
+        - `reset_seconds`: The seconds until the estimated usage decreases.
+        """
+        current_time = int(self.clock.time())
+        window_start = current_time - current_time % duration_seconds
+        if record is None:
+            try:
+                record = self._storage.get(identifier)
+            # pylint: disable=broad-except
+            except Exception:
+                record = b""
+        try:
+            counter = decode_counter(record)
+        # pylint: disable=broad-except
+        except Exception:
+            # Sliding window records are converted when storage pressure switches to counters
+            counter = self._timestamps_as_counter(record, window_start, duration_seconds)
+
+        counter, usage, retry_after = self._roll_counter(
+            counter, limit, duration_seconds, current_time, cost)
+        if retry_after is not None:
+            raise UsageLimitExceededException(identifier, limit, usage, retry_after)
+
+        window_start, previous_count, current_count = counter
+        counter = (window_start, previous_count, current_count + cost)
+        self._storage.set(identifier, encode_counter(*counter))
+
+        current_usage = usage + cost
+        reset_seconds = self._counter_reset_seconds(counter, duration_seconds, current_time)
         return current_usage, reset_seconds
+
+    def _parse_tiers(
+        self,
+        limit: int,
+        duration_seconds: int,
+        tiers: str
+    ) -> list[Tuple[int, int]]:
+        """
+        Parse the additional windows counted in the same record as the main window.
+
+        Parameters:
+        - `limit`: The limit of the main window.
+        - `duration_seconds`: The duration of the main window in seconds.
+        - `tiers`: Comma separated `limit/duration_seconds` pairs, e.g. "500/86400, 5000/2592000".
+
+        Returns:
+        - `tiers`: The limit and duration of every window including the main window,
+           shortest window first.
+        """
+        parsed = [(limit, duration_seconds)]
+        try:
+            for tier in tiers.split(","):
+                tier_limit, tier_duration = tier.split("/")
+                parsed.append((int(tier_limit), int(tier_duration)))
+        except (AttributeError, ValueError) as e:
+            raise ValueError("Invalid tiers") from e
+        durations = [tier[1] for tier in parsed]
+        if len(set(durations)) != len(durations) or \
+                any(tier_limit < 1 or tier_duration < 1 for tier_limit, tier_duration in parsed):
+            raise ValueError("Invalid tiers")
+        return sorted(parsed, key=lambda tier: tier[1])
+
+    def _duration_milliseconds(self, tool_parameters: dict[str, Any]) -> int | None:
+        """
+        Parse the duration of a millisecond window.
+
+        Parameters:
+        - `tool_parameters`: The parameters of the rule.
+
+        Returns:
+        - `duration_milliseconds`: The duration of the window in milliseconds, or None if
+           the window is timed in seconds.
+        """
+        duration = tool_parameters.get("duration_milliseconds")
+        if duration in (None, ""):
+            return None
+        try:
+            duration = int(duration)
+        except (TypeError, ValueError) as e:
+            raise ValueError("Invalid duration milliseconds") from e
+        if not 1 <= duration <= MAX_WINDOW_MILLISECONDS:
+            raise ValueError("Invalid duration milliseconds")
+        return duration
+
+    def _current_time(self, milliseconds: bool) -> int:
+        """Return the current epoch in seconds, or in milliseconds with `milliseconds`."""
+        if milliseconds:
+            return int(self.clock.time() * 1000)
+        return int(self.clock.time())
+
+    @staticmethod
+    def _in_seconds(value: int, milliseconds: bool) -> int | float:
+        """Convert a duration counted in milliseconds with `milliseconds` to seconds."""
+        return value / 1000 if milliseconds else value
+
+    def _tiered_counter_usage(
+        self,
+        identifier: str,
+        tiers: list[Tuple[int, int]],
+        cost: int = 1,
+        enforce: bool = True
+    ) -> Tuple[int, int, int, dict[str, Any]]:
+        """
+        Implement sliding window counter usage tracking of several windows in one record.
+
+        Every window is counted like the "sliding-counter" strategy, and a usage is only
+        counted if every window allows it. The record holds the counters of all windows,
+        so it is read and written once per usage however many windows are configured.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `tiers`: The limit and duration in seconds of every window.
+        - `cost`: The weight of this usage.
+        - `enforce`: Whether usages exceeding a limit are denied instead of counted.
+
+        Returns:
+        - `current_usage`: The estimated usage count of the binding window after incrementing.
+        - `reset_seconds`: The seconds until the estimated usage of the binding window decreases.
+        - `capacity`: The limit of the binding window.
+        - `extra_fields`: The limit and duration of the binding window, which has the fewest
+           usages remaining, and the usage of every window.
+        """
+        current_time = int(self.clock.time())
+        try:
+            counters = decode_tiers(self._storage.get(identifier))
+        # pylint: disable=broad-except
+        except Exception:
+            counters = {}
+
+        rolled = []
+        denial = None
+        for limit, duration_seconds in tiers:
+            counter, usage, retry_after = self._roll_counter(
+                counters.get(duration_seconds, (0, 0, 0)),
+                limit if enforce else UNENFORCED_LIMIT, duration_seconds, current_time, cost)
+            rolled.append((counter, usage))
+            # The usage is allowed once the last of the exceeded windows allows it
+            if retry_after is not None and (denial is None or retry_after > denial[2]):
+                denial = (limit, usage, retry_after)
+        if denial is not None:
+            raise UsageLimitExceededException(identifier, *denial)
+
+        # Windows that are no longer configured are dropped from the record
+        counters = {
+            duration_seconds: (window_start, previous_count, current_count + cost)
+            for (_, duration_seconds), ((window_start, previous_count, current_count), _)
+            in zip(tiers, rolled)
+        }
+        self._storage.set(identifier, encode_tiers(counters))
+
+        results = [{
+            "limit": limit,
+            "duration_seconds": duration_seconds,
+            "current_usage": usage + cost,
+            "remaining_usage": max(0, limit - usage - cost),
+            "reset_seconds": self._counter_reset_seconds(
+                counters[duration_seconds], duration_seconds, current_time),
+        } for (limit, duration_seconds), (_, usage) in zip(tiers, rolled)]
+        binding = min(results, key=lambda tier: (tier["remaining_usage"], -tier["reset_seconds"]))
+        return binding["current_usage"], binding["reset_seconds"], binding["limit"], {
+            "limit": binding["limit"],
+            "duration_seconds": binding["duration_seconds"],
+            "tiers": results,
+        }
+
+    def _roll_counter(
+        self,
+        counter: Tuple[int, int, int],
+        limit: int,
+        duration_seconds: int,
+        current_time: int,
+        cost: int = 1
+    ) -> Tuple[Tuple[int, int, int], int, int | None]:
+        """
+        Roll a sliding window counter forward to the current window and check its limit.
+
+        Parameters:
+        - `counter`: The stored window start, previous count and current count.
+        - `limit`: The maximum number of allowed usages within the window.
+        - `duration_seconds`: The duration of the sliding window in seconds.
+        - `current_time`: The current epoch.
+        - `cost`: The weight of this usage.
+
+        Returns:
+        - `counter`: The counter of the window containing the current time.
+        - `usage`: The estimated usage count before this usage.
+        - `retry_after`: The seconds until the next usage is allowed, or None if it is
+           allowed now.
+        """
+        stored_start, previous_count, current_count = counter
+        window_start = current_time - current_time % duration_seconds
+        # Roll the counts forward to the window containing the current time
+        if stored_start == window_start - duration_seconds:
+            previous_count, current_count = current_count, 0
+        elif stored_start != window_start:
+            previous_count, current_count = 0, 0
+
+        elapsed = current_time - window_start
+        # Round the weighted previous count up so the estimate never undercounts
+        weighted_previous = -(
+            -previous_count * (duration_seconds - elapsed) // duration_seconds)
+
+        retry_after = None
+        if weighted_previous + current_count + cost > limit:
+            allowed_previous = limit - cost - current_count
+            if allowed_previous >= 0:
+                # The weighted previous count decays far enough within the current window
+                allow_at = duration_seconds - (
+                    allowed_previous * duration_seconds // previous_count)
+                retry_after = allow_at - elapsed
+            else:
+                # Not before the next window, possibly later
+                retry_after = duration_seconds - elapsed
+        return ((window_start, previous_count, current_count),
+                weighted_previous + current_count, retry_after)
+
+    def _counter_reset_seconds(
+        self,
+        counter: Tuple[int, int, int],
+        duration_seconds: int,
+        current_time: int
+    ) -> int:
+        """
+        Return the seconds until the estimated usage of a rolled counter decreases.
+        """
+        window_start, previous_count, current_count = counter
+        elapsed = current_time - window_start
+        weighted_previous = -(
+            -previous_count * (duration_seconds - elapsed) // duration_seconds)
+        if weighted_previous > 0:
+            # The weighted previous count drops by one within the current window
+            decrease_at = duration_seconds - (
+                (weighted_previous - 1) * duration_seconds // previous_count)
+            return decrease_at - elapsed
+        # The current count starts decaying once it becomes the previous count
+        return duration_seconds - elapsed - (-duration_seconds // current_count)
+
+    def _timestamps_as_counter(
+        self,
+        record: bytes,
+        window_start: int,
+        duration_seconds: int
+    ) -> Tuple[int, int, int]:
+        """
+        Count the usages of a sliding window record per fixed window.
+
+        Parameters:
+        - `record`: The stored sliding window record.
+        - `window_start`: The start of the current fixed window.
+        - `duration_seconds`: The duration of the window in seconds.
+
+        Returns:
+        - `window_start`, `previous_count`, `current_count`: The equivalent counter, which
+           is empty if the record is not a sliding window record.
+        """
+        try:
+            usages = decode_weighted_timestamps(record)
+        # pylint: disable=broad-except
+        except Exception:
+            usages = []
+        previous_count = sum(
+            w for t, w in usages if window_start - duration_seconds <= t < window_start)
+        current_count = sum(w for t, w in usages if t >= window_start)
+        return window_start, previous_count, current_count
+
+    def _bucketed_window_usage(
+        self,
+        identifier: str,
+        limit: int,
+        bucket_seconds: int,
+        bucket_count: int,
+        cost: int = 1
+    ) -> Tuple[int, int]:
+        """
+        Implement bucketed sliding window usage tracking.
+
+        Usages are counted in a ring of `bucket_count` buckets of `bucket_seconds` each,
+        so the record size depends on the number of buckets instead of `limit`. The
+        usages of a bucket leave the window together once the whole bucket has expired.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The maximum number of allowed usages within the window.
+        - `bucket_seconds`: The width of each bucket in seconds.
+        - `bucket_count`: The number of buckets spanning the window.
+        - `cost`: The weight of this usage.
+
+        Returns:
+        - `current_usage`: The current usage count after incrementing.
+        - `reset_seconds`: The seconds until the oldest bucket leaves the window.
+        """
+        current_time = int(self.clock.time())
+        current_bucket = current_time // bucket_seconds
+        try:
+            stored_seconds, head_bucket, counts = decode_buckets(
+                self._storage.get(identifier))
+        # pylint: disable=broad-except
+        except Exception:
+            stored_seconds, head_bucket, counts = 0, 0, []
+
+        # Start a new ring if the bucket layout changed
+        if stored_seconds != bucket_seconds or len(counts) != bucket_count:
+            head_bucket, counts = current_bucket, [0] * bucket_count
+
+        # Clear the buckets that rotated out of the window since the last update
+        first_bucket = current_bucket - bucket_count + 1
+        for bucket in range(max(head_bucket + 1, first_bucket), current_bucket + 1):
+            counts[bucket % bucket_count] = 0
+
+        current_usage = sum(counts)
+        if current_usage + cost > limit:
+            # Wait until enough of the oldest buckets leave the window
+            remaining = current_usage
+            for bucket in range(first_bucket, current_bucket + 1):
+                remaining -= counts[bucket % bucket_count]
+                if remaining + cost <= limit:
+                    break
+            raise UsageLimitExceededException(
+                identifier, limit, current_usage,
+                (bucket + bucket_count) * bucket_seconds - current_time)
+
+        counts[current_bucket % bucket_count] += cost
+        self._storage.set(identifier, encode_buckets(
+            bucket_seconds, current_bucket, counts))
+
+        oldest_bucket = next(
+            bucket for bucket in range(first_bucket, current_bucket + 1)
+            if counts[bucket % bucket_count])
+        reset_seconds = (oldest_bucket + bucket_count) * bucket_seconds - current_time
+
+        return current_usage + cost, reset_seconds
+
+    def _gcra_usage(
+        self,
+        identifier: str,
+        limit: int,
+        duration_seconds: int,
+        burst: int,
+        cost: int = 1
+    ) -> Tuple[int, int, float]:
+        """
+        Implement generic cell rate algorithm (GCRA) usage tracking.
+
+        Usages are spaced by an emission interval of `duration_seconds / limit`. The stored
+        theoretical arrival time (TAT) advances by one interval per usage, and a usage is
+        allowed while the TAT stays within `burst` intervals of the current time.
+
+        Parameters:
+        - `identifier`: The identifier for tracking usage.
+        - `limit`: The number of usages allowed per `duration_seconds` on average.
+        - `duration_seconds`: The duration the limit applies to in seconds.
+        - `burst`: The number of usages allowed at once.
+        - `cost`: The weight of this usage, in emission intervals.
+
+        Returns:
+        - `current_usage`: The number of emission intervals the TAT is ahead of the current time.
+        - `reset_seconds`: The seconds until the TAT is reached and the full burst is available.
+        - `retry_after`: The seconds until the next usage is allowed.
+        """
+        current_time = int(self.clock.time() * 1_000_000)
+        # Round the interval up so the average rate never exceeds the limit
+        emission_interval = -(-duration_seconds * 1_000_000 // limit)
+        burst_tolerance = burst * emission_interval
+        try:
+            arrival_time = decode_arrival_time(self._storage.get(identifier))
+        # pylint: disable=broad-except
+        except Exception:
+            arrival_time = current_time
+        arrival_time = max(arrival_time, current_time)
+
+        allow_at = arrival_time + cost * emission_interval - burst_tolerance
+        if allow_at > current_time:
+            raise UsageLimitExceededException(
+                identifier, burst,
+                -(-(arrival_time - current_time) // emission_interval),
+                (allow_at - current_time) / 1_000_000)
+
+        arrival_time += cost * emission_interval
+        self._storage.set(identifier, encode_arrival_time(arrival_time))
+
+        current_usage = -(-(arrival_time - current_time) // emission_interval)
+        reset_seconds = -(-(arrival_time - current_time) // 1_000_000)
+        retry_after = max(
+            0, arrival_time + emission_interval - burst_tolerance - current_time) / 1_000_000
+
+        return current_usage, reset_seconds, retry_after